@@ -0,0 +1,24 @@
+angular.module('app.services').factory('MultiSearch', MultiSearch);
+
+MultiSearch.$inject = ['$http'];
+function MultiSearch($http) {
+    var MultiSearch = {};
+
+    MultiSearch.search = search;
+
+    return MultiSearch;
+
+    ////
+
+    /**
+     * search() executes several searches in one request
+     *
+     * @param searches (array): objects with the parameters of /search/search/ for every search
+     * @returns (promise): resolves with an array with {hits, total, took} for every search
+     */
+    function search(searches) {
+        return $http.post('/search/search/multi/', searches).then(function(response) {
+            return response.data;
+        });
+    }
+}
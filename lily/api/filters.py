@@ -35,11 +35,13 @@ class ElasticSearchFilter(BaseFilterBackend):
                 tenant_id=request.user.tenant_id,
                 model_type=model_type,
                 size=int(limit),
+                use_cache=True,
             )
         else:
             search = LilySearch(
                 tenant_id=request.user.tenant_id,
                 model_type=model_type,
+                use_cache=True,
             )
 
         search.filter_query(' AND '.join(search_terms))
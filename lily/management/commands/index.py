@@ -1,13 +1,17 @@
 from optparse import make_option
 import time
 
+from dateutil.parser import parse
 from django.conf import settings
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
 from elasticsearch.exceptions import NotFoundError
 
 from lily.search.analyzers import get_analyzers
 from lily.search.connections_utils import get_es_client
-from lily.search.indexing import index_objects
+from lily.search.indexing import (get_index_queryset, index_modified_objects, index_objects, index_objects_parallel,
+                                  invalidate_aliases, unindex_tenant)
+from lily.search.models import IndexCheckpoint
 from lily.search.scan_search import ModelMappings
 
 
@@ -32,7 +36,28 @@ or with fully qualified name:
 
     index -t lily.contacts.models.Contact
 
-It is possible to specify multiple models, using comma separation."""
+It is possible to specify multiple models, using comma separation.
+
+To index with multiple processes, each indexing a part of the pk range of a
+model, use:
+
+    index -w 4
+
+The number of rows fetched per query and documents per bulk request can be
+changed with --chunk-size and --bulk-size.
+
+Every run stores a checkpoint per model. To only index the objects modified
+since the last run in the current index, and remove the deleted ones, use:
+
+    index -d
+
+or, to index the objects modified since a specific time:
+
+    index -d -s 2015-08-01T12:00
+
+To remove all documents of a tenant, of all or the targeted models, use:
+
+    index -r 1"""
 
     option_list = BaseCommand.option_list + (
         make_option('-t', '--target',
@@ -57,14 +82,73 @@ It is possible to specify multiple models, using comma separation."""
                     dest='force',
                     help='Force the creation of the new_index alias, removing the old one.'
                     ),
+        make_option('-w', '--workers',
+                    action='store',
+                    dest='workers',
+                    type='int',
+                    default=1,
+                    help='Number of processes to index with.'
+                    ),
+        make_option('--chunk-size',
+                    action='store',
+                    dest='chunk_size',
+                    type='int',
+                    default=None,
+                    help='Number of rows fetched per query, defaults to settings.QUERYSET_ITERATOR_CHUNK_SIZE.'
+                    ),
+        make_option('--bulk-size',
+                    action='store',
+                    dest='bulk_size',
+                    type='int',
+                    default=100,
+                    help='Number of documents per bulk request.'
+                    ),
+        make_option('-e', '--estimate',
+                    action='store_true',
+                    dest='estimate',
+                    help='Show progress against the estimated number of objects, instead of counting them.'
+                    ),
+        make_option('-d', '--delta',
+                    action='store_true',
+                    dest='delta',
+                    help='Only index objects modified since the last run, in the current index.'
+                    ),
+        make_option('-s', '--since',
+                    action='store',
+                    dest='since',
+                    default='',
+                    help='Index objects modified since this time instead of the last run, with "delta" option.'
+                    ),
+        make_option('-r', '--remove-tenant',
+                    action='store',
+                    dest='remove_tenant',
+                    default='',
+                    help='Remove all documents of this tenant from the index.'
+                    ),
     )
 
     def handle(self, *args, **options):
         es = get_es_client()
+        self.workers = max(options['workers'], 1)
+        self.chunk_size = options['chunk_size']
+        self.bulk_size = options['bulk_size']
+        self.estimate = options['estimate']
 
         # Check if specific targets specified to run, or otherwise run all.
         target = options['target']
-        if target:
+        if options['remove_tenant']:
+            mappings = [
+                mapping_class for mapping_class in ModelMappings.get_model_mappings().values()
+                if self.model_targetted(mapping_class.get_model(), target.split(',') if target else None)
+            ]
+            self.stdout.write('Removing documents of tenant %s' % options['remove_tenant'])
+            unindex_tenant(int(options['remove_tenant']), settings.ES_INDEXES['default'], mappings=mappings)
+
+        elif options['delta']:
+            self.index_delta(settings.ES_INDEXES['default'], specific_targets=target.split(',') if target else None,
+                             since=options['since'])
+
+        elif target:
             targets = target.split(',')
             # Check specific IDs.
             if options['id']:
@@ -95,9 +179,31 @@ It is possible to specify multiple models, using comma separation."""
                 index_settings['mappings'].update({model_name: mapping_class.get_mapping()})
 
             new_index = 'index_%s' % (int(time.time()))
+            # Objects modified during the rebuild are indexed by the signals, or else by the next delta run.
+            started = timezone.now()
             self.stdout.write('Creating new index "%s"' % new_index)
             es.indices.create(new_index, body=index_settings)
-            self.index(new_index)
+            # Writes should go to the new index too from now on.
+            invalidate_aliases()
+
+            # Don't refresh or replicate the new index while building it, restore its settings afterwards.
+            original_settings = es.indices.get_settings(index=new_index)[new_index]['settings']['index']
+            es.indices.put_settings(index=new_index, body={
+                'index': {'number_of_replicas': 0, 'refresh_interval': '-1'},
+            })
+            try:
+                self.index(new_index)
+            finally:
+                es.indices.put_settings(index=new_index, body={
+                    'index': {
+                        'number_of_replicas': original_settings['number_of_replicas'],
+                        # Elasticsearch only returns the refresh interval when it isn't the default.
+                        'refresh_interval': original_settings.get('refresh_interval', '1s'),
+                    },
+                })
+            es.indices.refresh(new_index)
+            for mapping_class in ModelMappings.get_model_mappings().values():
+                self.save_checkpoint(mapping_class, started)
 
             # The default index name, (we will use as an alias).
             index_name = settings.ES_INDEXES['default']
@@ -137,6 +243,7 @@ It is possible to specify multiple models, using comma separation."""
                     {'remove': {'index': new_index, 'alias': settings.ES_INDEXES['new_index']}},
                 ]
             })
+            invalidate_aliases()
             # Compensate for the small race condition in the signal handlers:
             # They check if the index exists then updates documents, however when we
             # delete the alias in between these two commands, we can end up with
@@ -182,12 +289,53 @@ It is possible to specify multiple models, using comma separation."""
 
             self.stdout.write('Indexing %s' % self.full_name(model))
 
-            if mapping_class.has_deleted():
-                model_objs = model.objects.filter(is_deleted=False)
+            if self.workers > 1:
+                index_objects_parallel(mapping_class, index_name, self.workers, print_progress=True,
+                                       chunk_size=self.chunk_size, bulk_size=self.bulk_size, estimate=self.estimate)
             else:
-                model_objs = model.objects.all()
+                index_objects(mapping_class, get_index_queryset(mapping_class), index_name, print_progress=True,
+                              chunk_size=self.chunk_size, bulk_size=self.bulk_size, estimate=self.estimate)
+
+    def index_delta(self, index_name, specific_targets=None, since=None):
+        """
+        Index objects from our index-enabled models modified since the
+        checkpoint of the model, or since a given time.
+        """
+        if since:
+            since = parse(since)
+            if timezone.is_naive(since):
+                since = timezone.make_aware(since, timezone.get_current_timezone())
 
-            index_objects(mapping_class, model_objs, index_name, print_progress=True)
+        for mapping_class in ModelMappings.get_model_mappings().values():
+            model = mapping_class.get_model()
+            if not self.model_targetted(model, specific_targets):
+                continue
+            if 'modified' not in model._meta.get_all_field_names():
+                self.stdout.write('Skipping %s, it has no modified field' % self.full_name(model))
+                continue
+
+            started = timezone.now()
+            model_since = since
+            if not model_since:
+                try:
+                    model_since = IndexCheckpoint.objects.get(mapping=mapping_class.get_mapping_type_name()).modified
+                except IndexCheckpoint.DoesNotExist:
+                    raise CommandError('No checkpoint for %s, run a full index or use --since' % self.full_name(model))
+
+            self.stdout.write('Indexing %s modified since %s' % (self.full_name(model), model_since))
+            indexed, removed = index_modified_objects(mapping_class, model_since, index_name, print_progress=True,
+                                                      chunk_size=self.chunk_size, bulk_size=self.bulk_size)
+            self.stdout.write('Indexed %s and removed %s objects' % (indexed, removed))
+            self.save_checkpoint(mapping_class, started)
+
+    def save_checkpoint(self, mapping_class, modified):
+        """
+        Store the time from which the next delta run should index a model.
+        """
+        IndexCheckpoint.objects.update_or_create(
+            mapping=mapping_class.get_mapping_type_name(),
+            defaults={'modified': modified},
+        )
 
     def model_targetted(self, model, specific_targets):
         """
@@ -0,0 +1,35 @@
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from lily.search.result_cache import get_stats, reset_stats
+
+
+class Command(BaseCommand):
+    help = """
+    Print the hits, misses and hit rate of the search result cache, counted by all processes since the counters were
+    reset. Processes add their counts every ES_SEARCH_CACHE_STATS_INTERVAL seconds, so the last ones may be missing.
+    """
+
+    option_list = BaseCommand.option_list + (
+        make_option('-r', '--reset',
+                    action='store_true',
+                    dest='reset',
+                    help='Reset the counters after printing them.'
+                    ),
+    )
+
+    def handle(self, **options):
+        if not settings.ES_SEARCH_CACHE_ENABLED:
+            self.stdout.write('The search result cache is disabled, see ES_SEARCH_CACHE_ENABLED')
+
+        stats = get_stats()
+        self.stdout.write('Hits: %(hits)s, misses: %(misses)s, hit rate: %(hit_rate).1f%%' % dict(
+            stats,
+            hit_rate=stats['hit_rate'] * 100,
+        ))
+
+        if options['reset']:
+            reset_stats()
+            self.stdout.write('Reset the counters')
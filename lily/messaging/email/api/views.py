@@ -11,6 +11,7 @@ from lily.users.models import LilyUser
 
 from .serializers import (EmailLabelSerializer, EmailAccountSerializer, EmailMessageSerializer,
                           EmailTemplateSerializer, SharedEmailConfigSerializer, TemplateVariableSerializer)
+from ..cadence import SyncCadence
 from ..models.models import EmailLabel, EmailAccount, EmailMessage, EmailTemplate, SharedEmailConfig, \
     TemplateVariable
 from ..tasks import (trash_email_message, delete_email_message, archive_email_message, toggle_read_email_message,
@@ -91,6 +92,9 @@ class EmailAccountViewSet(mixins.DestroyModelMixin,
             sharedemailconfig__user=request.user,
         )
 
+        # The user is looking at these accounts, so keep them up to date.
+        SyncCadence().boost([email_account.pk for email_account in email_account_list])
+
         serializer = self.get_serializer(email_account_list, many=True)
 
         return Response(serializer.data)
@@ -213,6 +217,7 @@ class EmailMessageViewSet(mixins.RetrieveModelMixin,
             request.user.tenant_id,
             model_type='email_emailmessage',
             sort='sent_date',
+            use_cache=True,
         )
 
         search.filter_query('thread_id:%s' % email.thread_id)
@@ -0,0 +1,108 @@
+import base64
+import hashlib
+import logging
+import os
+from tempfile import SpooledTemporaryFile
+
+from django.conf import settings
+from django.core.files import File
+from django.core.files.storage import default_storage
+
+from lily.utils.functions import get_redis_connection
+
+
+logger = logging.getLogger(__name__)
+
+# Number of base64 characters decoded at once, must be a multiple of 4.
+DECODE_CHUNK_SIZE = 64 * 1024
+
+# Redis keys per blob path, see lock_attachment_blob and is_attachment_blob_pending.
+BLOB_LOCK_KEY = 'ATTACHMENT_BLOB_LOCK_%s'
+BLOB_PENDING_KEY = 'ATTACHMENT_BLOB_PENDING_%s'
+# Seconds a blob lock is held at most, long enough to upload a large attachment.
+BLOB_LOCK_TIMEOUT = 300
+
+
+def get_attachment_blob_path(tenant_id, content_hash, file_name):
+    """
+    Return the content addressed storage path of an attachment.
+
+    Args:
+        tenant_id (int): id of the tenant, blobs are only shared within a tenant
+        content_hash (string): sha256 hex digest of the content
+        file_name (string): original name, only the extension is used
+
+    Returns:
+        string with the path in default_storage
+    """
+    return settings.EMAIL_ATTACHMENT_BLOB_UPLOAD_TO % {
+        'tenant_id': tenant_id,
+        'prefix': content_hash[:2],
+        'hash': content_hash,
+        'extension': os.path.splitext(file_name)[1].lower()[:10],
+    }
+
+
+def lock_attachment_blob(path):
+    """
+    Return a lock for a blob, since the path contains the content hash all attachments with the same content share it.
+
+    Storing a blob and deleting it when it's unused both check before they act, so they hold the lock to not run at the
+    same time.
+
+    Args:
+        path (string): path of the blob in default_storage
+
+    Returns:
+        redis Lock instance, to use as context manager
+    """
+    return get_redis_connection().lock(BLOB_LOCK_KEY % path, timeout=BLOB_LOCK_TIMEOUT)
+
+
+def is_attachment_blob_pending(path):
+    """
+    Return whether a blob was stored less than settings.EMAIL_ATTACHMENT_DELETE_DELAY seconds ago, so the
+    EmailAttachment that refers to it may not be saved yet.
+    """
+    return bool(get_redis_connection().exists(BLOB_PENDING_KEY % path))
+
+
+def store_attachment_data(tenant_id, data, file_name):
+    """
+    Decode base64url attachment data and store it, unless the same content is stored already.
+
+    The data is decoded in chunks to a spooled temporary file while hashing it, so large attachments aren't kept in
+    memory twice and are written to the storage in chunks. The blob is marked as pending, so it isn't deleted as
+    unused before the EmailAttachment that refers to it is saved.
+
+    Args:
+        tenant_id (int): id of the tenant
+        data (string): base64url encoded content, as returned by the Gmail api
+        file_name (string): original name of the attachment
+
+    Returns:
+        tuple with the storage path, the content hash and the size in bytes
+    """
+    content_hash = hashlib.sha256()
+    size = 0
+    with SpooledTemporaryFile(max_size=settings.EMAIL_ATTACHMENT_SPOOL_SIZE) as spool:
+        data = data.encode('UTF-8')
+        for i in range(0, len(data), DECODE_CHUNK_SIZE):
+            chunk = base64.urlsafe_b64decode(data[i:i + DECODE_CHUNK_SIZE])
+            content_hash.update(chunk)
+            size += len(chunk)
+            spool.write(chunk)
+
+        path = get_attachment_blob_path(tenant_id, content_hash.hexdigest(), file_name)
+        with lock_attachment_blob(path):
+            if default_storage.exists(path):
+                logger.debug('Attachment %s is stored already' % path)
+            else:
+                spool.seek(0)
+                stored_path = default_storage.save(path, File(spool, file_name))
+                if stored_path != path:
+                    # Stored concurrently by another worker, use the first copy.
+                    default_storage.delete(stored_path)
+            get_redis_connection().set(BLOB_PENDING_KEY % path, 1, ex=settings.EMAIL_ATTACHMENT_DELETE_DELAY)
+
+    return path, content_hash.hexdigest(), size
@@ -0,0 +1,231 @@
+import logging
+
+from django.db import transaction, IntegrityError
+
+from lily.search.indexing import update_ids_in_index
+
+from ..models.models import EmailMessage, EmailHeader, EmailAttachment, NoEmailMessageId
+from ..search import EmailMessageMapping
+
+
+logger = logging.getLogger(__name__)
+
+
+class MessageBatchBuilder(object):
+    """
+    Builder to save a batch of parsed messages with bulk queries.
+
+    Every message is parsed by its own MessageBuilder. Instead of calling save() on every builder, the builders are
+    added to the batch and saved at once: messages, headers, attachments and the many to many rows for labels and
+    recipients are inserted with bulk_create in one transaction.
+    """
+    def __init__(self, manager):
+        self.manager = manager
+        self.builders = []
+
+    def add(self, builder):
+        """
+        Add a MessageBuilder with a parsed message to the batch.
+
+        Args:
+            builder (instance): MessageBuilder instance
+        """
+        self.builders.append(builder)
+
+    def __len__(self):
+        return len(self.builders)
+
+    def save(self):
+        """
+        Save all messages in the batch.
+
+        When the bulk insert conflicts with messages stored in the meantime (by another sync), every message is saved
+        on its own, so the IntegrityError handling of MessageBuilder.save is used.
+        """
+        if not self.builders:
+            return
+
+        recipient_cache = self.manager.recipient_cache
+        new_builders = []
+        try:
+            with transaction.atomic():
+                saved_builders = self._bulk_save(new_builders)
+        except IntegrityError:
+            logger.warning('Bulk save failed for account %s, saving messages one by one' % (
+                self.manager.email_account.id,
+            ))
+            # The transaction was rolled back, so the new messages and recipients don't exist.
+            recipient_cache.rollback()
+            for builder in new_builders:
+                builder.message.pk = None
+
+            for builder in self.builders:
+                try:
+                    builder.save()
+                except Exception:
+                    logger.exception('Couldn\'t save message %s for account %s' % (
+                        builder.message.message_id,
+                        self.manager.email_account.id,
+                    ))
+        except Exception:
+            recipient_cache.rollback()
+            raise
+        else:
+            recipient_cache.commit()
+            for builder in saved_builders:
+                self.manager.add_unread_deltas(builder.get_unread_deltas())
+                builder.queue_attachment_downloads()
+            # Bulk inserts and updates don't send post_save signals, so index ourselves.
+            update_ids_in_index(EmailMessageMapping, [builder.message.pk for builder in saved_builders])
+        finally:
+            for builder in self.builders:
+                builder.cleanup()
+            self.builders = []
+
+    def _bulk_save(self, new_builders):
+        """
+        Write the batch with bulk queries, must be called inside a transaction.
+
+        Args:
+            new_builders (list): gets filled with the builders of messages that are inserted
+
+        Returns:
+            list with the builders of the saved EmailMessages
+        """
+        email_account = self.manager.email_account
+
+        # Look up the recipients of all messages at once.
+        recipient_keys = set()
+        for builder in self.builders:
+            recipient_keys |= builder.get_recipient_keys()
+        recipients = self.manager.recipient_cache.resolve(recipient_keys)
+        for builder in self.builders:
+            builder.resolve_recipients(recipients)
+
+        # Dedup on message_id, the last parsed version wins.
+        builders = {}
+        no_email_message_ids = set()
+        for builder in self.builders:
+            if builder.is_email_message():
+                builders[builder.message.message_id] = builder
+            else:
+                no_email_message_ids.add(builder.message.message_id)
+
+        self._save_no_email_message_ids(no_email_message_ids)
+
+        if not builders:
+            return []
+
+        for builder in builders.values():
+            # Check for attachments
+            if builder.attachments or builder.inline_attachments:
+                builder.message.has_attachment = True
+
+        # Update existing messages, insert new messages.
+        existing_builders = []
+        for builder in builders.values():
+            if builder.message.pk:
+                existing_builders.append(builder)
+            else:
+                new_builders.append(builder)
+
+        # Update without post_save, so the messages are indexed once, after their relations are saved too.
+        update_fields = [field for field in EmailMessage._meta.concrete_fields if not field.primary_key]
+        for builder in existing_builders:
+            EmailMessage.objects.filter(pk=builder.message.pk).update(**{
+                field.name: getattr(builder.message, field.attname) for field in update_fields
+            })
+
+        if new_builders:
+            EmailMessage.objects.bulk_create([builder.message for builder in new_builders])
+
+            # Bulk create doesn't set the primary keys, so look them up.
+            message_pks = dict(EmailMessage.objects.filter(
+                account=email_account,
+                message_id__in=[builder.message.message_id for builder in new_builders],
+            ).values_list('message_id', 'pk'))
+            for builder in new_builders:
+                builder.message.pk = message_pks[builder.message.message_id]
+
+        # Remove the relations that are replaced for existing messages.
+        existing_pks = [builder.message.pk for builder in existing_builders]
+        if existing_pks:
+            EmailMessage.received_by.through.objects.filter(
+                emailmessage_id__in=[builder.message.pk for builder in existing_builders if builder.received_by]
+            ).delete()
+            EmailMessage.received_by_cc.through.objects.filter(
+                emailmessage_id__in=[builder.message.pk for builder in existing_builders if builder.received_by_cc]
+            ).delete()
+            EmailMessage.labels.through.objects.filter(emailmessage_id__in=existing_pks).delete()
+            EmailHeader.objects.filter(
+                message_id__in=[builder.message.pk for builder in existing_builders if builder.headers]
+            ).delete()
+            # Queryset delete still sends post_delete, which removes files from storage once they're unused.
+            EmailAttachment.objects.filter(
+                message_id__in=[builder.message.pk for builder in existing_builders if builder.attachments]
+            ).delete()
+
+        received_by = []
+        received_by_cc = []
+        labels = []
+        headers = []
+        attachments = []
+        for builder in builders.values():
+            message = builder.message
+            received_by.extend(EmailMessage.received_by.through(
+                emailmessage_id=message.pk,
+                recipient_id=recipient.pk,
+            ) for recipient in builder.received_by)
+            received_by_cc.extend(EmailMessage.received_by_cc.through(
+                emailmessage_id=message.pk,
+                recipient_id=recipient.pk,
+            ) for recipient in builder.received_by_cc)
+            labels.extend(EmailMessage.labels.through(
+                emailmessage_id=message.pk,
+                emaillabel_id=label_pk,
+            ) for label_pk in set(label.pk for label in builder.labels))
+
+            for header in builder.headers:
+                header.message_id = message.pk
+                headers.append(header)
+
+            for attachment in builder.attachments:
+                attachment.message_id = message.pk
+                attachments.append(attachment)
+
+        EmailMessage.received_by.through.objects.bulk_create(received_by)
+        EmailMessage.received_by_cc.through.objects.bulk_create(received_by_cc)
+        EmailMessage.labels.through.objects.bulk_create(labels)
+        EmailHeader.objects.bulk_create(headers)
+        # Attachment files are in the storage already or are downloaded later.
+        EmailAttachment.objects.bulk_create(attachments)
+
+        return builders.values()
+
+    def _save_no_email_message_ids(self, message_ids):
+        """
+        Store message ids that aren't emails, so they are skipped in the next sync.
+
+        Args:
+            message_ids (set): message ids that aren't emails
+        """
+        if not message_ids:
+            return
+
+        message_ids -= set(NoEmailMessageId.objects.filter(
+            account=self.manager.email_account,
+            message_id__in=message_ids,
+        ).values_list('message_id', flat=True))
+
+        NoEmailMessageId.objects.bulk_create([
+            NoEmailMessageId(message_id=message_id, account=self.manager.email_account) for message_id in message_ids
+        ])
+
+    def cleanup(self):
+        """
+        Cleanup references, to prevent reference cycle
+        """
+        for builder in self.builders:
+            builder.cleanup()
+        self.builders = []
+        self.manager = None
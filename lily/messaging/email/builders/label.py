@@ -1,4 +1,5 @@
-import gc
+import weakref
+
 from django.db import IntegrityError
 
 from ..models.models import EmailLabel
@@ -11,7 +12,8 @@ class LabelBuilder(object):
 
     def __init__(self, manager):
         self.label = None
-        self.manager = manager
+        # Weak reference, so the manager and its builders don't form a reference cycle.
+        self.manager = weakref.proxy(manager)
 
     def get_or_create_label(self, label_dict):
         """
@@ -21,7 +23,8 @@ class LabelBuilder(object):
             label_dict (dict): with label information
 
         Returns:
-            label (instance): unsaved label
+            label (instance): saved label
+            created (boolean): True if label is created
         """
         # Check if it is a system label or not
         label_type = EmailLabel.LABEL_SYSTEM if label_dict['type'] == 'system' else EmailLabel.LABEL_USER
@@ -33,6 +36,7 @@ class LabelBuilder(object):
                 account=self.manager.email_account,
                 label_id=label_dict['id'],
                 label_type=label_type,
+                defaults={'name': label_dict['name']},
             )
         except IntegrityError as e:
             self.label = EmailLabel.objects.get(
@@ -42,10 +46,11 @@ class LabelBuilder(object):
             )
             created = False
 
-        # Name could have changed, always set the name
-        self.label.name = label_dict['name']
-        self.label.save()
-        gc.collect()
+        # Name could have changed, only save if it did
+        if self.label.name != label_dict['name']:
+            self.label.name = label_dict['name']
+            # Only save the name, the unread count is maintained by the manager.
+            self.label.save(update_fields=['name'])
         return self.label, created
 
     def cleanup(self):
@@ -1,27 +1,51 @@
 import base64
+from collections import defaultdict
 import datetime
 import email
-import gc
 import logging
 import re
-import StringIO
+import weakref
 
 from bs4 import BeautifulSoup, UnicodeDammit
 from dateutil.parser import parse
 from django.conf import settings
-from django.core.files import File
 from django.core.urlresolvers import reverse
 from django.db import transaction, IntegrityError
 import pytz
 
-from python_imap.utils import get_extensions_for_type
+from python_imap.utils import convert_html_to_text, get_extensions_for_type
 
-from ..models.models import EmailMessage, EmailHeader, Recipient, EmailAttachment, NoEmailMessageId
+from ..attachments import store_attachment_data
+from ..models.models import EmailMessage, EmailHeader, EmailAttachment, NoEmailMessageId
 
 
 logger = logging.getLogger(__name__)
 
 
+def get_unread_deltas(old_read, old_label_pks, new_read, new_label_pks):
+    """
+    Calculate how the unread count of labels changes when a message changes.
+
+    Args:
+        old_read (boolean): read status before the change
+        old_label_pks (iterable): pks of the labels before the change
+        new_read (boolean): read status after the change
+        new_label_pks (iterable): pks of the labels after the change
+
+    Returns:
+        dict with the change of the unread count per label pk
+    """
+    deltas = defaultdict(int)
+    if not old_read:
+        for label_pk in set(old_label_pks):
+            deltas[label_pk] -= 1
+    if not new_read:
+        for label_pk in set(new_label_pks):
+            deltas[label_pk] += 1
+
+    return {label_pk: delta for label_pk, delta in deltas.items() if delta}
+
+
 class MessageBuilderException(Exception):
     pass
 
@@ -35,14 +59,20 @@ class MessageBuilder(object):
     Builder to get, create or update Messages
     """
     def __init__(self, manager):
-        self.manager = manager
+        # Weak reference, so the manager and its builders don't form a reference cycle.
+        self.manager = weakref.proxy(manager)
         self.message = None
         self.labels = []
         self.headers = []
         self.received_by = None
         self.received_by_cc = None
+        self.sender_key = None
+        self.received_by_keys = set()
+        self.received_by_cc_keys = set()
         self.attachments = []
         self.inline_attachments = {}
+        self.old_read = True
+        self.old_label_pks = []
 
     def get_or_create_message(self, message_dict):
         """
@@ -61,11 +91,13 @@ class MessageBuilder(object):
         self.headers = []
         self.received_by = set()
         self.received_by_cc = set()
+        self.sender_key = None
+        self.received_by_keys = set()
+        self.received_by_cc_keys = set()
         self.attachments = []
         self.inline_attachments = {}
-
-        # Prevent memory leaks
-        gc.collect()
+        self.old_read = True
+        self.old_label_pks = []
 
         # Get or create without save
         created = False
@@ -107,6 +139,8 @@ class MessageBuilder(object):
         """
         Handle the labels for current Message
 
+        Only reads from the database, the labels stored before are replaced when the message is saved.
+
         Args:
             labels (list): of label_identifiers
             message_id (string): message_id of email
@@ -118,9 +152,11 @@ class MessageBuilder(object):
         # TODO: remove snippet sync in label update
         self.message.snippet = message_info['snippet']
 
-        # clear current labels
-        if self.message.pk and self.message.labels:
-            self.message.labels.clear()
+        # Remember the labels the message counts as unread for, the unread counts change when it's saved.
+        if self.message.pk:
+            self.old_read = self.message.read
+            if not self.message.read:
+                self.old_label_pks = list(self.message.labels.values_list('pk', flat=True))
 
         # UNREAD identifier check to see if message is read
         self.message.read = settings.GMAIL_UNREAD_LABEL not in message_info.get('labelIds', [])
@@ -154,6 +190,12 @@ class MessageBuilder(object):
         else:
             self._parse_message_part(payload)
 
+        # Derive the text to search in once, instead of every time the message is indexed.
+        if self.message.body_html and not self.message.body_text:
+            self.message.body_html_text = convert_html_to_text(self.message.body_html, keep_linebreaks=True)
+        else:
+            self.message.body_html_text = ''
+
     def _create_message_headers(self, headers):
         """
         Given header dict, create EmailHeaders for message.
@@ -266,61 +308,76 @@ class MessageBuilder(object):
         if headers and headers.get('content-id', False):
             inline = True
 
-        # Get file data from part or from remote
-        if 'data' in part['body']:
-            file_data = part['body']['data']
-        elif 'attachmentId' in part['body']:
-            file_data = self.manager.get_attachment(self.message.message_id, part['body']['attachmentId'])
-            if file_data:
-                file_data = file_data.get('data')
-            else:
-                logger.warning('No attachment could be downloaded, not storing anything')
-                return
-        else:
-            logger.warning('No attachment, not storing anything')
-            return
-
-        file_data = base64.urlsafe_b64decode(file_data.encode('UTF-8'))
-
-        # create as string file
-        file = StringIO.StringIO(file_data)
         if headers and 'content-type' in headers:
-            file.content_type = headers['content-type'].split(';')[0]
+            content_type = headers['content-type'].split(';')[0]
         else:
-            file.content_type = 'application/octet-stream'
+            content_type = 'application/octet-stream'
 
-        file.size = len(file_data)
-        file.name = part.get('filename', '').rsplit('\\')[-1]
-        if len(file.name) > 200:
-            file.name = None
+        file_name = part.get('filename', '').rsplit('\\')[-1]
+        if len(file_name) > 200:
+            file_name = None
 
         # No filename in part, create a name
-        if not file.name:
-            extensions = get_extensions_for_type(file.content_type)
+        if not file_name:
+            extensions = get_extensions_for_type(content_type)
             if part.get('partId'):
-                file.name = 'attachment-%s%s' % (part.get('partId'), extensions.next())
+                file_name = 'attachment-%s%s' % (part.get('partId'), extensions.next())
             else:
                 logger.warning('No part id, no filename')
-                file.name = 'attachment-%s-%s' % (
+                file_name = 'attachment-%s-%s' % (
                     len(self.attachments) + len(self.inline_attachments),
                     extensions.next()
                 )
 
-        final_file = File(file, file.name)
-
         # Create a EmailAttachment object
         attachment = EmailAttachment()
-        attachment.attachment = final_file
-        attachment.size = file.size
+        attachment.file_name = file_name
         attachment.inline = inline
         attachment.tenant_id = self.manager.email_account.tenant_id
 
+        # Get file data from part or from remote
+        if 'data' in part['body']:
+            file_data = part['body']['data']
+        elif 'attachmentId' in part['body']:
+            attachment.remote_id = part['body']['attachmentId']
+            attachment.size = part['body'].get('size', 0)
+            if settings.GMAIL_ATTACHMENT_DOWNLOAD_ASYNC:
+                # Downloaded by a task after the message is saved, see queue_attachment_downloads
+                file_data = None
+            else:
+                file_data = self.manager.get_attachment(self.message.message_id, attachment.remote_id)
+                if file_data:
+                    file_data = file_data.get('data')
+                else:
+                    logger.warning('No attachment could be downloaded, not storing anything')
+                    return
+        else:
+            logger.warning('No attachment, not storing anything')
+            return
+
+        if file_data is not None:
+            path, attachment.content_hash, attachment.size = store_attachment_data(
+                attachment.tenant_id,
+                file_data,
+                file_name,
+            )
+            # The file is in the storage already, only refer to it.
+            attachment.attachment = path
+
         # Check if inline attachment
         if inline:
             attachment.cid = headers.get('content-id')
 
         self.attachments.append(attachment)
 
+    def queue_attachment_downloads(self):
+        """
+        Start a task to download the attachments that weren't downloaded while parsing the message.
+        """
+        if any(not attachment.is_downloaded for attachment in self.attachments):
+            from ..tasks import download_email_attachments
+            download_email_attachments.apply_async(args=(self.message.pk,))
+
     def _create_body_html(self, body, encoding=None):
         """
         parse string to a correct coded html body part and add to Message.body_html
@@ -396,7 +453,7 @@ class MessageBuilder(object):
 
     def _create_recipients(self, header_name, header_value):
         """
-        Create recipient based on header
+        Store recipients based on header, they are looked up when saving (see resolve_recipients)
 
         Args:
             header_name (string): with name of header
@@ -414,30 +471,60 @@ class MessageBuilder(object):
         recipients = re.sub(r'(\.[A-Z]{2,16}|>)(,)', r'\1;', header_value, flags=re.IGNORECASE).split('; ')
 
         for recipient in recipients:
-            # Get or create recipient
-            email_address = email.utils.parseaddr(recipient)
-            recipient = Recipient.objects.get_or_create(
-                name=email_address[0],
-                email_address=email_address[1],
-            )[0]
+            # (name, email_address)
+            key = email.utils.parseaddr(recipient)
 
             # Set recipient to correct field
             if header_name == 'from':
-                self.message.sender = recipient
+                self.sender_key = key
             elif header_name in ['to', 'delivered-to']:
-                self.received_by.add(recipient)
+                self.received_by_keys.add(key)
             elif header_name == 'cc':
-                self.received_by_cc.add(recipient)
+                self.received_by_cc_keys.add(key)
+
+    def get_recipient_keys(self):
+        """
+        Returns:
+            set with (name, email_address) of all recipients of the message
+        """
+        keys = self.received_by_keys | self.received_by_cc_keys
+        if self.sender_key:
+            keys.add(self.sender_key)
+        return keys
+
+    def resolve_recipients(self, recipients=None):
+        """
+        Set the sender and receivers of the message.
+
+        Args:
+            recipients (dict, optional): Recipient instances by (name, email_address), looked up with the recipient
+                cache of the manager if not given
+        """
+        if recipients is None:
+            recipients = self.manager.recipient_cache.resolve(self.get_recipient_keys())
+
+        if self.sender_key:
+            self.message.sender = recipients[self.sender_key]
+        self.received_by = set(recipients[key] for key in self.received_by_keys)
+        self.received_by_cc = set(recipients[key] for key in self.received_by_cc_keys)
+
+    def is_email_message(self):
+        """
+        Only messages with a sent date and a sender are emails, otherwise it's a chat message.
+        """
+        return bool(self.message.sent_date and self.message.sender_id)
 
     def save(self):
-        # Only save if there is a sent date, otherwise its a chat message
-        if self.message.sent_date and self.message.sender_id:
+        self.resolve_recipients()
+
+        if self.is_email_message():
 
             # Check for attachments
             if self.attachments or self.inline_attachments:
                 self.message.has_attachment = True
 
             # Save before we can add many to many and foreign keys
+            existing = self.message.pk is not None
             try:
                 self.message.save()
             except IntegrityError:
@@ -447,19 +534,24 @@ class MessageBuilder(object):
                 )
                 self.message.id = existing_message.id
                 self.message.save()
+                existing = True
 
-            # Save recipients
+            # Save recipients, they replace the recipients stored before
+            if existing and len(self.received_by):
+                self.message.received_by.clear()
+            if existing and len(self.received_by_cc):
+                self.message.received_by_cc.clear()
             self.message.received_by.add(*self.received_by)
             self.message.received_by_cc.add(*self.received_by_cc)
 
-            # Save labels
-            if len(self.labels):
+            # Save labels, they replace the labels stored before
+            if existing or len(self.labels):
                 with transaction.atomic():
-                    self.message.labels.clear()
-                    self.labels = list(set(self.labels))
-                    for label in self.labels:
-                        label.save()
-                        self.message.labels.add(label)
+                    if existing:
+                        self.message.labels.clear()
+                    if len(self.labels):
+                        self.message.labels.add(*set(self.labels))
+            self.manager.add_unread_deltas(self.get_unread_deltas())
 
             # Save headers
             if len(self.headers):
@@ -473,6 +565,7 @@ class MessageBuilder(object):
 
             for attachment in self.attachments:
                 self.message.attachments.add(attachment)
+            self.queue_attachment_downloads()
 
         else:
             logger.debug('No emailmessage, storing empty ID')
@@ -481,6 +574,18 @@ class MessageBuilder(object):
                 account=self.manager.email_account
             )
 
+    def get_unread_deltas(self):
+        """
+        Return the unread count changes for saving the labels of the message.
+
+        The labels stored before are looked up in store_labels_for_message, the message no longer counts for them.
+
+        Returns:
+            dict with the change of the unread count per label pk
+        """
+        new_label_pks = [label.pk for label in self.labels]
+        return get_unread_deltas(self.old_read, self.old_label_pks, self.message.read, new_label_pks)
+
     def _get_encoding_from_headers(self, headers):
         """
         Try to find encoding from headers
@@ -523,5 +628,10 @@ class MessageBuilder(object):
         self.headers = []
         self.received_by = None
         self.received_by_cc = None
+        self.sender_key = None
+        self.received_by_keys = set()
+        self.received_by_cc_keys = set()
         self.attachments = []
         self.inline_attachments = {}
+        self.old_read = True
+        self.old_label_pks = []
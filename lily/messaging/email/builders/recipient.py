@@ -0,0 +1,194 @@
+from collections import OrderedDict
+import logging
+import threading
+
+from django.conf import settings
+from django.db import transaction, IntegrityError
+
+from ..models.models import Recipient
+
+
+logger = logging.getLogger(__name__)
+
+_worker_cache = None
+
+
+def get_recipient_cache():
+    """
+    Return the RecipientCache to use for a sync.
+
+    By default every sync gets its own cache. With GMAIL_RECIPIENT_CACHE_PER_WORKER enabled all syncs in the worker
+    process share one cache, so addresses stay cached between syncs.
+    """
+    global _worker_cache
+
+    if not settings.GMAIL_RECIPIENT_CACHE_PER_WORKER:
+        return RecipientCache()
+
+    if _worker_cache is None:
+        _worker_cache = RecipientCache()
+    return _worker_cache
+
+
+class RecipientCache(object):
+    """
+    LRU bounded cache of Recipient instances keyed on (name, email_address).
+
+    Recipients that aren't cached are looked up in bulk: one query for all missing keys and one bulk insert for the
+    ones that don't exist yet.
+
+    Recipients looked up inside a transaction may be rolled back with it, so whoever rolls back the transaction must
+    call rollback() to remove them from the cache, and commit() once the transaction is committed.
+
+    Attributes:
+        max_size (int): max number of cached recipients
+        hits (int): number of keys found in the cache
+        misses (int): number of keys looked up in the database
+    """
+    # Max number of (name, email_address) pairs per query.
+    QUERY_CHUNK_SIZE = 500
+
+    def __init__(self, max_size=None):
+        self.max_size = int(max_size or settings.GMAIL_RECIPIENT_CACHE_SIZE)
+        self.hits = 0
+        self.misses = 0
+        self._recipients = OrderedDict()
+        # Parse workers of the sync pipeline share the cache.
+        self._lock = threading.Lock()
+        # Keys cached inside the transaction of the current thread.
+        self._uncommitted = threading.local()
+
+    def get(self, name, email_address):
+        """
+        Get or create a single Recipient.
+
+        Returns:
+            Recipient instance
+        """
+        key = (name, email_address)
+        return self.resolve([key])[key]
+
+    def resolve(self, keys):
+        """
+        Get or create the Recipients for all keys.
+
+        Args:
+            keys (iterable): of (name, email_address) tuples
+
+        Returns:
+            dict with Recipient instances by key
+        """
+        recipients = {}
+        missing = []
+        with self._lock:
+            for key in set(keys):
+                recipient = self._recipients.pop(key, None)
+                if recipient is None:
+                    missing.append(key)
+                else:
+                    # Reinsert to mark as most recently used.
+                    self._recipients[key] = recipient
+                    recipients[key] = recipient
+
+            self.hits += len(recipients)
+            self.misses += len(missing)
+
+        if missing:
+            found = self._get_or_create(missing)
+            recipients.update(found)
+
+            with self._lock:
+                self._recipients.update(found)
+                while len(self._recipients) > self.max_size:
+                    self._recipients.popitem(last=False)
+
+            if self._in_transaction():
+                self._get_uncommitted().update(found)
+
+        return recipients
+
+    def commit(self):
+        """
+        Keep the recipients cached inside the transaction that was committed.
+        """
+        self._get_uncommitted().clear()
+
+    def rollback(self):
+        """
+        Remove the recipients cached inside the transaction that was rolled back, they may not exist anymore.
+        """
+        uncommitted = self._get_uncommitted()
+        with self._lock:
+            for key in uncommitted:
+                self._recipients.pop(key, None)
+        uncommitted.clear()
+
+    def _get_uncommitted(self):
+        if not hasattr(self._uncommitted, 'keys'):
+            self._uncommitted.keys = set()
+        return self._uncommitted.keys
+
+    def _in_transaction(self):
+        return transaction.get_connection().in_atomic_block
+
+    def _get_or_create(self, keys):
+        """
+        Fetch existing Recipients for keys from the database and bulk insert the rest.
+
+        Args:
+            keys (list): of (name, email_address) tuples
+
+        Returns:
+            dict with Recipient instances by key
+        """
+        recipients = self._fetch(keys)
+
+        new_keys = [key for key in keys if key not in recipients]
+        if new_keys:
+            try:
+                with transaction.atomic():
+                    Recipient.objects.bulk_create([
+                        Recipient(name=name, email_address=email_address) for name, email_address in new_keys
+                    ])
+            except IntegrityError:
+                # Another sync created some of them in the meantime.
+                for name, email_address in new_keys:
+                    recipients[(name, email_address)] = Recipient.objects.get_or_create(
+                        name=name,
+                        email_address=email_address,
+                    )[0]
+            else:
+                # Bulk create doesn't set the primary keys, so fetch them.
+                recipients.update(self._fetch(new_keys))
+
+        return recipients
+
+    def _fetch(self, keys):
+        """
+        Fetch existing Recipients for keys with a WHERE (name, email_address) IN (...) query.
+
+        Args:
+            keys (list): of (name, email_address) tuples
+
+        Returns:
+            dict with Recipient instances by key
+        """
+        recipients = {}
+        for i in range(0, len(keys), self.QUERY_CHUNK_SIZE):
+            chunk = tuple(keys[i:i + self.QUERY_CHUNK_SIZE])
+            queryset = Recipient.objects.extra(where=['(name, email_address) IN %s'], params=[chunk])
+            for recipient in queryset:
+                recipients[(recipient.name, recipient.email_address)] = recipient
+        return recipients
+
+    def stats(self):
+        """
+        Return the hit and miss counters, for tuning the cache size.
+        """
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._recipients),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': float(self.hits) / lookups if lookups else 0.0,
+        }
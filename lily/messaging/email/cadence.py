@@ -0,0 +1,130 @@
+import logging
+import random
+import time
+
+from django.conf import settings
+from redis.exceptions import RedisError
+
+from lily.utils.functions import get_redis_connection
+
+
+logger = logging.getLogger(__name__)
+
+
+class SyncCadence(object):
+    """
+    Decide per email account when it should be synced again, based on how often it changes.
+
+    After a sync that found changes the account is synced again after the min interval. After every sync without
+    changes the interval grows by the backoff factor, up to the max interval. Accounts that users are looking at are
+    boosted back to the min interval. Every next sync time is jittered, so accounts that were synced together spread
+    out over time.
+
+    With push notifications enabled, changes trigger syncs by themselves and polling is only a safety net, so the
+    min interval is settings.GMAIL_PUSH_POLL_INTERVAL instead.
+
+    The interval and next sync time of all accounts are stored in two redis hashes.
+    """
+    NEXT_SYNC_KEY = 'GMAIL_SYNC_NEXT'
+    INTERVAL_KEY = 'GMAIL_SYNC_INTERVAL'
+
+    def __init__(self, connection=None):
+        """
+        Args:
+            connection (instance, optional): Redis instance
+        """
+        self.connection = connection or get_redis_connection()
+        self.min_interval = settings.GMAIL_PUSH_POLL_INTERVAL if settings.GMAIL_PUSH_ENABLED else \
+            settings.GMAIL_SYNC_MIN_INTERVAL
+
+    def get_due(self, account_ids, now=None):
+        """
+        Return the accounts that should be synced now, with one round-trip.
+
+        When redis isn't available all accounts are due.
+
+        Args:
+            account_ids (list): ids of EmailAccounts
+            now (float, optional): current timestamp
+
+        Returns:
+            list with the ids of the accounts to sync
+        """
+        if not settings.GMAIL_SYNC_CADENCE_ENABLED or not account_ids:
+            return list(account_ids)
+
+        now = now or time.time()
+        try:
+            next_syncs = self.connection.hmget(self.NEXT_SYNC_KEY, account_ids)
+        except RedisError:
+            logger.exception('Sync cadence unavailable, syncing all accounts')
+            return list(account_ids)
+
+        # The scheduler runs every min interval, so include accounts that are due before its next run.
+        until = now + settings.GMAIL_SYNC_MIN_INTERVAL / 2.0
+        return [
+            account_id for account_id, next_sync in zip(account_ids, next_syncs)
+            if next_sync is None or float(next_sync) <= until
+        ]
+
+    def record_sync(self, account_id, pages):
+        """
+        Set the next sync time of an account after a sync.
+
+        Args:
+            account_id (int): id of the EmailAccount
+            pages (int): number of history pages the sync found
+        """
+        if not settings.GMAIL_SYNC_CADENCE_ENABLED:
+            return
+
+        try:
+            interval = self.connection.hget(self.INTERVAL_KEY, account_id)
+            if pages or interval is None:
+                interval = self.min_interval
+            else:
+                interval = min(float(interval) * settings.GMAIL_SYNC_BACKOFF_FACTOR, settings.GMAIL_SYNC_MAX_INTERVAL)
+            self._set(account_id, interval, time.time() + self.jitter(interval))
+        except RedisError:
+            logger.exception('Sync cadence unavailable, can\'t record sync of %s' % account_id)
+
+    def boost(self, account_ids):
+        """
+        Sync accounts at the next run of the scheduler and reset their interval, for accounts users are looking at.
+
+        Args:
+            account_ids (list): ids of EmailAccounts
+        """
+        if not settings.GMAIL_SYNC_CADENCE_ENABLED or not account_ids:
+            return
+
+        try:
+            pipe = self.connection.pipeline(transaction=False)
+            for account_id in account_ids:
+                pipe.hset(self.INTERVAL_KEY, account_id, self.min_interval)
+            # Only bring the next sync forward, so repeated boosts don't postpone it.
+            pipe.hmget(self.NEXT_SYNC_KEY, account_ids)
+            next_syncs = pipe.execute()[-1]
+
+            now = time.time()
+            boosted = {
+                account_id: now for account_id, next_sync in zip(account_ids, next_syncs)
+                if next_sync is not None and float(next_sync) > now + self.min_interval
+            }
+            if boosted:
+                self.connection.hmset(self.NEXT_SYNC_KEY, boosted)
+        except RedisError:
+            logger.exception('Sync cadence unavailable, can\'t boost %s' % account_ids)
+
+    def _set(self, account_id, interval, next_sync):
+        pipe = self.connection.pipeline(transaction=False)
+        pipe.hset(self.INTERVAL_KEY, account_id, interval)
+        pipe.hset(self.NEXT_SYNC_KEY, account_id, next_sync)
+        pipe.execute()
+
+    @staticmethod
+    def jitter(seconds):
+        """
+        Randomly change a number of seconds by at most settings.GMAIL_SYNC_JITTER (a fraction) of it.
+        """
+        return seconds * (1 + random.uniform(-settings.GMAIL_SYNC_JITTER, settings.GMAIL_SYNC_JITTER))
@@ -9,6 +9,7 @@ from googleapiclient.errors import HttpError
 from googleapiclient.http import BatchHttpRequest, MediaFileUpload, MediaInMemoryUpload
 
 from .credentials import get_credentials, InvalidCredentialsError
+from .ratelimit import RateGovernor
 from .services import build_gmail_service
 
 logger = logging.getLogger(__name__)
@@ -32,6 +33,7 @@ class GmailConnector(object):
     def __init__(self, email_account):
         self.email_account = email_account
         self.history_id = self.email_account.history_id
+        self.governor = RateGovernor(self.email_account.pk)
 
         self.service = self.create_service()
 
@@ -47,18 +49,21 @@ class GmailConnector(object):
         else:
             return build_gmail_service(credentials)
 
-    def execute_service_call(self, service):
+    def execute_service_call(self, service, cost=None):
         """
         Try to execute a service call.
 
-        If the call fails because the rate limit is exceeded, sleep x seconds to try again.
+        Calls are paced by the rate governor. If the call fails because the rate limit is exceeded, the governor
+        lowers the rate and we sleep x seconds to try again.
 
         Args:
             service (instance): service instance
+            cost (int, optional): quota units of the call, see RateGovernor.acquire
         Returns:
             response from service instance
         """
         for n in range(0, 6):
+            self.governor.acquire(cost)
             try:
                 return service.execute()
             except HttpError, e:
@@ -70,11 +75,13 @@ class GmailConnector(object):
                     logger.exception('error %s' % e)
                     error = e
                 if error.get('code') == 403 and error.get('errors')[0].get('reason') in ['rateLimitExceeded', 'userRateLimitExceeded']:
+                    self.governor.backoff(project=error.get('errors')[0].get('reason') == 'rateLimitExceeded')
                     # Apply exponential backoff.
                     sleep_time = (2 ** n) + random.randint(0, 1000) / 1000
                     logger.warning('Limit overrated, sleeping for %s seconds' % sleep_time)
                     time.sleep(sleep_time)
                 elif error.get('code') == 429:
+                    self.governor.backoff()
                     # Apply exponential backoff.
                     sleep_time = (2 ** n) + random.randint(0, 1000) / 1000
                     logger.warning('Too many concurrent requests for user, sleeping for %d seconds' % sleep_time)
@@ -111,30 +118,57 @@ class GmailConnector(object):
 
         return history
 
-    def get_all_message_id_list(self):
+    def watch(self):
         """
-        Fetch all messageIds from the gmail api.
+        Ask the gmail api to push notifications of changes in the mailbox to settings.GMAIL_PUSH_TOPIC.
+
+        A watch expires after 7 days, so it has to be renewed regularly.
 
         Returns:
-            list with messageIds and threadIds
+            dict with the current historyId and the expiration of the watch
         """
-        response = self.execute_service_call(self.service.users().messages().list(userId='me'))
+        return self.execute_service_call(self.service.users().watch(
+            userId='me',
+            body={'topicName': settings.GMAIL_PUSH_TOPIC},
+        ))
 
-        messages = response['messages'] if 'messages' in response else []
+    def iter_message_id_pages(self, page_token=None):
+        """
+        Fetch all messageIds from the gmail api, one page at a time.
 
-        # Check if there are more pages.
-        while 'nextPageToken' in response:
-            page_token = response['nextPageToken']
-            response = self.execute_service_call(self.service.users().messages().list(userId='me', pageToken=page_token))
-            messages.extend(response.get('messages', []))
+        When starting at the first page, the history_id is set from the newest message.
 
-        # Store history_id
-        if messages:
-            message = self.get_message_info(messages[0]['id'])
-            if message['historyId'] > self.history_id:
-                self.history_id = message['historyId']
+        Args:
+            page_token (string, optional): token of the page to start at, to resume an earlier enumeration
 
-        return messages
+        Yields:
+            tuple with a list of messageIds and threadIds and the token of the next page (None after the last page)
+        """
+        first_page = page_token is None
+        while True:
+            if page_token:
+                response = self.execute_service_call(self.service.users().messages().list(
+                    userId='me',
+                    pageToken=page_token,
+                ))
+            else:
+                response = self.execute_service_call(self.service.users().messages().list(userId='me'))
+
+            messages = response.get('messages', [])
+
+            # Store history_id
+            if first_page and messages:
+                first_page = False
+                message = self.get_message_info(messages[0]['id'])
+                if message['historyId'] > self.history_id:
+                    self.history_id = message['historyId']
+
+            page_token = response.get('nextPageToken')
+            yield messages, page_token
+
+            # Check if there are more pages.
+            if not page_token:
+                break
 
     def get_message_info(self, message_id):
         """
@@ -216,15 +250,30 @@ class GmailConnector(object):
                 else:
                     logger.error('404 error: %s' % exception)
 
-        # Setup batch
-        batch = BatchHttpRequest(callback=get_message_info)
-        for message_id in message_ids:
-            batch.add(self.service.users().messages().get(userId='me', id=message_id))
+        for batch_message_ids in self._batch_chunks(message_ids):
+            # Setup batch
+            batch = BatchHttpRequest(callback=get_message_info)
+            for message_id in batch_message_ids:
+                batch.add(self.service.users().messages().get(userId='me', id=message_id))
 
-        self.execute_service_call(batch)
+            self.execute_service_call(batch, cost=len(batch_message_ids) * settings.GMAIL_RATE_DEFAULT_COST)
 
         return messages_info
 
+    def _batch_chunks(self, message_ids):
+        """
+        Split message ids in chunks for batch requests, sized to the current rate of the account.
+
+        Args:
+            message_ids (list): of message_ids
+
+        Returns:
+            generator with lists of message_ids
+        """
+        batch_size = self.governor.batch_size(int(settings.GMAIL_BATCH_REQUEST_SIZE))
+        for i in range(0, len(message_ids), batch_size):
+            yield message_ids[i:i + batch_size]
+
     def get_label_list_info(self, messages_ids):
         """
         Batch fetch label info given message_ids
@@ -246,18 +295,19 @@ class GmailConnector(object):
                 if exception.resp.status != 404:
                     raise exception
 
-        batch = BatchHttpRequest(callback=get_label_info)
+        for batch_message_ids in self._batch_chunks(messages_ids):
+            batch = BatchHttpRequest(callback=get_label_info)
 
-        for message_id in messages_ids:
-            # Temporary add snippet
-            # TODO: remove snippet
-            batch.add(self.service.users().messages().get(
-                userId='me',
-                id=message_id,
-                fields='labelIds,id,threadId,snippet'
-            ))
+            for message_id in batch_message_ids:
+                # Temporary add snippet
+                # TODO: remove snippet
+                batch.add(self.service.users().messages().get(
+                    userId='me',
+                    id=message_id,
+                    fields='labelIds,id,threadId,snippet'
+                ))
 
-        self.execute_service_call(batch)
+            self.execute_service_call(batch, cost=len(batch_message_ids) * settings.GMAIL_RATE_DEFAULT_COST)
 
         return label_info_dict
 
@@ -301,7 +351,8 @@ class GmailConnector(object):
         if thread_id:
             message_dict.update({'threadId': thread_id})
         return self.execute_service_call(
-            self.service.users().messages().send(userId='me', body=message_dict, media_body=media)
+            self.service.users().messages().send(userId='me', body=message_dict, media_body=media),
+            cost=settings.GMAIL_RATE_SEND_COST,
         )
 
     def create_draft_email_message(self, message_string):
@@ -328,3 +379,4 @@ class GmailConnector(object):
         self.service = None
         self.email_account = None
         self.history_id = None
+        self.governor = None
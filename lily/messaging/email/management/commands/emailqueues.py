@@ -0,0 +1,53 @@
+import re
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management import BaseCommand, CommandError
+
+from ...routers import LANES, get_worker_queue_names
+
+
+class Command(BaseCommand):
+    help = """
+    Print the comma separated queues a worker of a lane of email tasks consumes, for the -Q option of celery worker:
+
+        celery worker -Q $(python manage.py emailqueues email_sync --worker=$DYNO --workers=2)
+
+    The shards of the lane are divided between the workers. The worker can be given as number from 1 or as Heroku dyno
+    name, like sync.1. Without shards, the default queue is printed.
+    """
+    args = '<lane>'
+
+    option_list = BaseCommand.option_list + (
+        make_option('-w', '--worker',
+                    action='store',
+                    dest='worker',
+                    default='1',
+                    help='Number of the worker, from 1, or the name of the dyno.'
+                    ),
+        make_option('-n', '--workers',
+                    action='store',
+                    dest='workers',
+                    type='int',
+                    default=1,
+                    help='Number of workers of the lane.'
+                    ),
+    )
+
+    def handle(self, lane=None, **options):
+        if lane not in LANES:
+            raise CommandError('Specify one of the lanes: %s' % ', '.join(LANES))
+
+        match = re.search(r'(\d+)$', options['worker'])
+        if not match:
+            raise CommandError('Invalid worker %s' % options['worker'])
+        worker = int(match.group(1))
+        workers = options['workers']
+        if not 1 <= worker <= workers:
+            # Every worker needs a different number, or some shards aren't consumed.
+            raise CommandError('Worker %s is not one of the %s workers of %s' % (worker, workers, lane))
+        if workers > settings.EMAIL_QUEUE_SHARDS > 0:
+            raise CommandError('More workers than the %s shards of %s' % (settings.EMAIL_QUEUE_SHARDS, lane))
+
+        queue_names = get_worker_queue_names(lane, worker - 1, workers) or [settings.CELERY_DEFAULT_QUEUE]
+        self.stdout.write(','.join(queue_names))
@@ -0,0 +1,73 @@
+import base64
+from optparse import make_option
+
+import anyjson
+from django.conf import settings
+from django.core.management import BaseCommand, CommandError
+from django.core.urlresolvers import reverse
+import requests
+
+from ...models.models import EmailAccount
+
+
+class Command(BaseCommand):
+    help = """
+    Post a fake gmail push notification to the push view, like Cloud Pub/Sub would. Useful to test push triggered
+    syncs locally:
+
+        fakegmailpush user@example.com
+
+    The history id defaults to one more than the history id of the email account, so a sync is started.
+    """
+    args = '<email_address> [history_id]'
+
+    option_list = BaseCommand.option_list + (
+        make_option('-u', '--url',
+                    action='store',
+                    dest='url',
+                    default='http://localhost:8000',
+                    help='Base url of the server to post to.'
+                    ),
+        make_option('-r', '--raw',
+                    action='store_true',
+                    dest='raw',
+                    help='Post the notification itself, instead of wrapped in a Pub/Sub message.'
+                    ),
+    )
+
+    def handle(self, email_address=None, history_id=None, **options):
+        if not email_address:
+            raise CommandError('Specify the email address of an email account')
+
+        if history_id is None:
+            email_account = EmailAccount.objects.filter(email_address=email_address, is_deleted=False).first()
+            if not email_account or not email_account.history_id:
+                raise CommandError('No synced email account for %s, specify the history id' % email_address)
+            history_id = email_account.history_id + 1
+
+        notification = {
+            'emailAddress': email_address,
+            'historyId': str(history_id),
+        }
+        if options['raw']:
+            body = notification
+        else:
+            body = {
+                'message': {
+                    'data': base64.b64encode(anyjson.dumps(notification)),
+                    'message_id': 'fake',
+                },
+                'subscription': 'fake',
+            }
+
+        response = requests.post(
+            '%s%s' % (options['url'].rstrip('/'), reverse('gmail_push')),
+            params={'token': settings.GMAIL_PUSH_TOKEN},
+            data=anyjson.dumps(body),
+            headers={'Content-Type': 'application/json'},
+        )
+        self.stdout.write('Posted notification for %s with history id %s: %s' % (
+            email_address,
+            history_id,
+            response.status_code,
+        ))
@@ -0,0 +1,70 @@
+from optparse import make_option
+
+from django.core.management import BaseCommand
+from django.db import transaction
+from python_imap.utils import convert_html_to_text
+
+from lily.search.indexing import update_ids_in_index
+from lily.utils.querysets import QuerysetIterator
+
+from ...models.models import EmailMessage
+from ...search import EmailMessageMapping
+
+
+class Command(BaseCommand):
+    help = """
+    Fill the plain text version of the html body of email messages without a text body, that were synced before it
+    was stored. Messages are updated per batch, so the command can be stopped and run again at any time.
+    """
+
+    option_list = BaseCommand.option_list + (
+        make_option('-b', '--batch-size',
+                    action='store',
+                    dest='batch_size',
+                    type='int',
+                    default=500,
+                    help='Number of messages updated per transaction.'
+                    ),
+        make_option('-i', '--index',
+                    action='store_true',
+                    dest='index',
+                    help='Index the updated messages, so the text can be searched.'
+                    ),
+    )
+
+    def handle(self, **options):
+        messages = EmailMessage.objects.filter(
+            body_text='',
+            body_html_text='',
+        ).exclude(body_html='').only('id', 'body_html')
+
+        batch = []
+        updated = 0
+        for message in QuerysetIterator(messages, chunk_size=options['batch_size'], print_progress=True):
+            batch.append(message)
+            if len(batch) >= options['batch_size']:
+                updated += self.update(batch, options['index'])
+                batch = []
+        updated += self.update(batch, options['index'])
+
+        self.stdout.write('Filled the html body text of %s messages' % updated)
+
+    def update(self, messages, index=False):
+        """
+        Convert the html bodies of a batch of messages to text and save them in one transaction.
+
+        Returns:
+            int with the number of updated messages
+        """
+        if not messages:
+            return 0
+
+        with transaction.atomic():
+            for message in messages:
+                EmailMessage.objects.filter(pk=message.pk).update(
+                    body_html_text=convert_html_to_text(message.body_html, keep_linebreaks=True),
+                )
+
+        if index:
+            update_ids_in_index(EmailMessageMapping, [message.pk for message in messages])
+        return len(messages)
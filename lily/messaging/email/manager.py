@@ -1,16 +1,26 @@
+from collections import defaultdict
 import logging
-import gc
+import threading
 import traceback
 
 import anyjson
 from django.conf import settings
+from django.db import connection, transaction, IntegrityError
+from django.db.models import Count
 from googleapiclient.errors import HttpError
 
+from lily.search.indexing import update_ids_in_index
+
+from .builders.batch import MessageBatchBuilder
 from .builders.label import LabelBuilder
-from .builders.message import MessageBuilder
+from .builders.message import MessageBuilder, get_unread_deltas
+from .builders.recipient import get_recipient_cache
 from .connector import GmailConnector
 from .credentials import InvalidCredentialsError
+from .memory import MemoryBudget
 from .models.models import EmailLabel, EmailMessage, NoEmailMessageId
+from .search import EmailMessageMapping
+from .sync_pipeline import SyncPipeline
 
 
 logger = logging.getLogger(__name__)
@@ -33,6 +43,10 @@ class GmailManager(object):
         email_account: EmailAccount instance
         message_builder: MessageBuilder instance
         label_builder: LabelBuilder instance
+        recipient_cache: RecipientCache instance
+        memory_budget: MemoryBudget instance
+        labels: dict with EmailLabels of email_account by label_id
+        unread_deltas: dict with unread count changes per label pk that aren't written yet
     """
     def __init__(self, email_account):
         """
@@ -43,6 +57,14 @@ class GmailManager(object):
             ManagerError: if sync is not possible
         """
         self.email_account = email_account
+        # EmailLabels by label_id, see preload_labels
+        self.labels = None
+        # Unread count changes by label pk, see update_unread_count
+        self.unread_deltas = defaultdict(int)
+        # Parse workers of the sync pipeline share the manager.
+        self._label_lock = threading.Lock()
+        self._connector_lock = threading.Lock()
+        self._unread_lock = threading.Lock()
         try:
             self.connector = GmailConnector(self.email_account)
         except InvalidCredentialsError:
@@ -50,6 +72,8 @@ class GmailManager(object):
         else:
             self.message_builder = MessageBuilder(self)
             self.label_builder = LabelBuilder(self)
+            self.recipient_cache = get_recipient_cache()
+            self.memory_budget = MemoryBudget()
 
     def synchronize(self, **kwargs):
         """
@@ -63,15 +87,18 @@ class GmailManager(object):
             SyncLimitReached: if limit is reached, this error is raised
         """
         self.synchronize_messages(**kwargs)
-        self.update_unread_count()
+        self.update_unread_count(full=True)
 
     def synchronize_labels(self):
         """
         Synchronize all labels for email account.
         """
         labels = self.connector.get_label_list()
-        for label in labels:
-            self.label_builder.get_or_create_label(label)
+        with self._label_lock:
+            for label in labels:
+                label = self.label_builder.get_or_create_label(label)[0]
+                if self.labels is not None:
+                    self.labels[label.label_id] = label
 
     def synchronize_messages(self, limit=None, full_sync=False):
         """
@@ -85,6 +112,7 @@ class GmailManager(object):
             SyncLimitReached: if limit is reached, this error is raised
         """
         logger.debug('Syncing messages for %s' % self.email_account.email_address)
+        self.preload_labels()
 
         # Get the message ids from the messages to update
         if not full_sync and self.email_account.history_id:
@@ -93,77 +121,171 @@ class GmailManager(object):
             self.sync_by_message_ids(limit=limit, full_sync=full_sync)
 
     def sync_by_message_ids(self, limit, full_sync):
-        message_ids = self.connector.get_all_message_id_list()
+        """
+        Synchronize messages by going through all message ids of the mailbox.
+
+        Message ids are fetched and compared with the database a page at a time. After every synchronized segment of
+        pages the token of the next page is stored on the EmailAccount, so an interrupted or limited sync resumes
+        where it stopped.
+
+        Arguments:
+            limit (int): maximum number of messages to download
+            full_sync (boolean): if True, the labels of all messages are updated as well
+
+        Raises:
+            SyncLimitReached: if limit is reached, this error is raised
+        """
+        page_token = self.email_account.message_page_token
+        if page_token and not (self.email_account.history_id or self.email_account.temp_history_id):
+            # Without a history id to continue from, changes to the messages
+            # that were already synchronized would be missed, so start over.
+            page_token = None
+        if page_token:
+            logger.debug('Resuming message id enumeration for %s' % self.email_account.email_address)
+
+        sync_labels = None
+        offset = 0
+        pages = self.connector.iter_message_id_pages(page_token)
+        for message_ids_full_download, message_ids_update_labels, page_token in self._message_id_segments(pages):
+            if sync_labels is None:
+                # Store history id in temporary column to make label batch sync quick
+                if limit and not self.email_account.temp_history_id:
+                    self.email_account.temp_history_id = self.connector.history_id
+                    self.email_account.save()
+
+                # If there is a temporary history id, there is no need to sync all
+                # labels, the history sync takes care of label changes.
+                sync_labels = full_sync or not self.email_account.temp_history_id
+
+            # Synchronize full messages in batches
+            message_id_batches = self._full_message_batches(message_ids_full_download, limit, offset)
+            offset += len(message_ids_full_download)
+            if settings.GMAIL_SYNC_PIPELINE_ENABLED:
+                SyncPipeline(self).run(message_id_batches)
+            else:
+                for message_id_batch in message_id_batches:
+                    self._batch_sync_full_messages(message_id_batch)
+
+            if sync_labels:
+                # Synchronize label info in batches
+                batch_size = int(settings.GMAIL_LABEL_UPDATE_BATCH_SIZE)
+                for i in range(0, len(message_ids_update_labels), batch_size):
+                    logger.debug('Batch sync label info (%(i)s/%(total)s to %(iplus)s/%(total)s)' % {
+                        'i': i,
+                        'total': len(message_ids_update_labels),
+                        'iplus': min(i + batch_size, len(message_ids_update_labels)),
+                    })
+                    self._batch_sync_label_info(message_ids_update_labels[i:i + batch_size])
+
+            # Segment is done, continue at the next page when interrupted
+            self.email_account.message_page_token = page_token
+            self.email_account.save(update_fields=['message_page_token'])
 
-        # Store history id in temporary column to make label batch sync quick
-        if limit and not self.email_account.temp_history_id:
-            self.email_account.temp_history_id = self.connector.history_id
+        if not full_sync and self.email_account.temp_history_id:
+            # Set the temporary history id as the new history id.
+            self.email_account.history_id = self.email_account.temp_history_id
+            self.email_account.temp_history_id = None
             self.email_account.save()
+        else:
+            self.connector.save_history_id()
 
-        message_ids_full_download = set()
-        message_ids_update_labels = set()
+        # Only if transaction was successful, we update the history ID
+        logger.debug('Finished syncing, storing history id for %s' % self.email_account.email_address)
+
+    def _message_id_segments(self, pages):
+        """
+        Compare pages of message ids with the database and combine them into segments to synchronize.
+
+        Args:
+            pages (iterable): of (messages, next_page_token), see GmailConnector.iter_message_id_pages
+
+        Yields:
+            tuple with a list of message ids to download, a list of message ids to update the labels for and
+            the token of the page after the segment
+        """
+        segment_size = int(settings.GMAIL_FULL_MESSAGE_BATCH_SIZE)
+        if settings.GMAIL_SYNC_PIPELINE_ENABLED:
+            # Enough messages to keep every fetch worker of the pipeline busy
+            segment_size *= int(settings.GMAIL_SYNC_FETCH_WORKERS)
+        label_segment_size = int(settings.GMAIL_LABEL_UPDATE_BATCH_SIZE)
+
+        message_ids_full_download = []
+        message_ids_update_labels = []
+        for messages, page_token in pages:
+            full_download, update_labels = self._diff_message_ids([message['id'] for message in messages])
+            message_ids_full_download.extend(full_download)
+            message_ids_update_labels.extend(update_labels)
+
+            if (not page_token or len(message_ids_full_download) >= segment_size or
+                    len(message_ids_update_labels) >= label_segment_size):
+                yield message_ids_full_download, message_ids_update_labels, page_token
+                message_ids_full_download = []
+                message_ids_update_labels = []
+
+    def _diff_message_ids(self, message_ids):
+        """
+        Check which message ids of a page are new and which are stored already.
+
+        Args:
+            message_ids (list): message ids of one page
+
+        Returns:
+            tuple with a list of message ids to download and a list of message ids to update the labels for
+        """
+        logger.debug('Check for existing messages, %s messages' % len(message_ids))
         # Check for message_ids that are saved as non email messages
-        no_message_ids_in_db = set(
-            NoEmailMessageId.objects.filter(
-                account=self.email_account
-            ).values_list('message_id', flat='true')
-        )
+        no_message_ids_in_db = set(NoEmailMessageId.objects.filter(
+            account=self.email_account,
+            message_id__in=message_ids,
+        ).values_list('message_id', flat=True))
 
         # Check for message_ids that are saved as email messages
-        message_ids_in_db = set(
-            EmailMessage.objects.filter(
-                account=self.email_account
-            ).values_list('message_id', flat='true')
-        )
+        message_ids_in_db = set(EmailMessage.objects.filter(
+            account=self.email_account,
+            message_id__in=message_ids,
+        ).values_list('message_id', flat=True))
 
+        message_ids_full_download = []
+        message_ids_update_labels = []
         # What do we need to do with every email message?
-        for i, message_dict in enumerate(message_ids):
-            logger.debug('Check for existing messages, %s/%s' % (i, len(message_ids)))
-            if message_dict['id'] in no_message_ids_in_db:
+        for message_id in message_ids:
+            if message_id in no_message_ids_in_db:
                 # Not an email, but chatmessage, skip
                 pass
-            elif message_dict['id'] not in message_ids_in_db:
+            elif message_id not in message_ids_in_db:
                 # If message is new, we need extra info from connector
-                message_ids_full_download.add(message_dict['id'])
+                message_ids_full_download.append(message_id)
             else:
                 # We only need to update the labels for this message
-                message_ids_update_labels.add(message_dict['id'])
+                message_ids_update_labels.append(message_id)
+
+        return message_ids_full_download, message_ids_update_labels
+
+    def _full_message_batches(self, message_ids, limit=None, offset=0):
+        """
+        Split message ids into batches for a full download.
+
+        Arguments:
+            message_ids (list): message ids to download
+            limit (int, optional): maximum number of messages to synchronize
+            offset (int, optional): number of messages downloaded before message_ids in this sync
 
-        message_ids_full_download = list(message_ids_full_download)
-        # Synchronize full messages in batches
-        for i in range(0, len(message_ids_full_download), int(settings.GMAIL_FULL_MESSAGE_BATCH_SIZE)):
+        Raises:
+            SyncLimitReached: if limit is reached, this error is raised
+        """
+        batch_size = int(settings.GMAIL_FULL_MESSAGE_BATCH_SIZE)
+        for i in range(0, len(message_ids), batch_size):
 
             # Check if we hit the limit of how many messages to sync
-            if limit and limit < i:
+            if limit and limit < offset + i:
                 raise SyncLimitReached
 
             logger.debug('Batch sync full messages (%(i)s/%(total)s to %(iplus)s/%(total)s)' % {
                 'i': i,
-                'total': len(message_ids_full_download),
-                'iplus': min(i + int(settings.GMAIL_FULL_MESSAGE_BATCH_SIZE), len(message_ids_full_download)),
+                'total': len(message_ids),
+                'iplus': min(i + batch_size, len(message_ids)),
             })
-            self._batch_sync_full_messages(message_ids_full_download[i:i + int(settings.GMAIL_FULL_MESSAGE_BATCH_SIZE)])
-
-        # If there is a temporary history id, there is no need to sync all
-        # labels, just set the temporary history id as the new history id.
-        if not full_sync and self.email_account.temp_history_id:
-            self.email_account.history_id = self.email_account.temp_history_id
-            self.email_account.temp_history_id = None
-            self.email_account.save()
-        else:
-            # Synchronize label info in batches
-            message_ids_update_labels = list(message_ids_update_labels)
-            for i in range(0, len(message_ids_update_labels), int(settings.GMAIL_LABEL_UPDATE_BATCH_SIZE)):
-                logger.debug('Batch sync label info (%(i)s/%(total)s to %(iplus)s/%(total)s)' % {
-                    'i': i,
-                    'total': len(message_ids_update_labels),
-                    'iplus': min(i + settings.GMAIL_LABEL_UPDATE_BATCH_SIZE, len(message_ids_update_labels)),
-                })
-                self._batch_sync_label_info(message_ids_update_labels[i:i + int(settings.GMAIL_LABEL_UPDATE_BATCH_SIZE)])
-            self.connector.save_history_id()
-
-        # Only if transaction was successful, we update the history ID
-        logger.debug('Finished syncing, storing history id for %s' % self.email_account.email_address)
+            yield message_ids[i:i + batch_size]
 
     def _batch_sync_full_messages(self, message_ids):
         """
@@ -173,9 +295,20 @@ class GmailManager(object):
             message_ids (list): message ids to get info for
         """
         messages_info = self.connector.get_message_list_info(message_ids)
+        batch_builder = MessageBatchBuilder(self)
 
         for message_id in message_ids:
+            self.memory_budget.check()
             if message_id in messages_info:
+                if settings.GMAIL_SYNC_BULK_SAVE_ENABLED:
+                    logger.debug('Parsing message: %s, account %s' % (
+                        message_id, self.email_account.email_address
+                    ))
+                    message_builder = MessageBuilder(self)
+                    message_builder.store_message_info(messages_info[message_id], message_id)
+                    batch_builder.add(message_builder)
+                    continue
+
                 logger.debug('Storing message: %s, account %s' % (
                     message_id, self.email_account.email_address
                 ))
@@ -190,7 +323,10 @@ class GmailManager(object):
                 logger.debug('Deleting message %s, account %s' % (
                     message_id, self.email_account.email_address
                 ))
-                EmailMessage.objects.filter(message_id=message_id).delete()
+                self.delete_messages([message_id])
+
+        logger.debug('Storing %s messages, account %s' % (len(batch_builder), self.email_account.email_address))
+        batch_builder.save()
 
     def _batch_sync_label_info(self, message_ids):
         """
@@ -202,6 +338,7 @@ class GmailManager(object):
         labels_info = self.connector.get_label_list_info(message_ids)
 
         for message_id in message_ids:
+            self.memory_budget.check()
             if message_id in labels_info:
                 logger.debug('Storing label info for message: %s, account %s' % (
                     message_id,
@@ -217,87 +354,363 @@ class GmailManager(object):
                 logger.debug('Deleting message %s, account %s' % (
                     message_id, self.email_account.email_address
                 ))
-                EmailMessage.objects.filter(message_id=message_id).delete()
+                self.delete_messages([message_id])
+
+    def delete_messages(self, message_ids):
+        """
+        Delete messages of the email account and keep track of the unread count.
+
+        Args:
+            message_ids (iterable): message ids of the messages to delete
+        """
+        messages = EmailMessage.objects.filter(account=self.email_account, message_id__in=message_ids)
+        unread_label_pks = EmailMessage.labels.through.objects.filter(
+            emailmessage__in=messages,
+            emailmessage__read=False,
+        ).values_list('emaillabel_id', flat=True)
+
+        deltas = defaultdict(int)
+        for label_pk in unread_label_pks:
+            deltas[label_pk] -= 1
+
+        messages.delete()
+        self.add_unread_deltas(deltas)
 
     def sync_by_history(self, history):
         """
         Synchronize emailaccount by history.
 
-        Fetches the changed from the GMail api and updates the email direct without parsing
+        Fetches the changed from the GMail api and updates the email direct without parsing.
+
+        All history items of the page are coalesced first: new messages are downloaded in batches and label changes
+        are applied as a delta, without asking the Gmail api for the labels of the message again.
+
+        Args:
+            history (list): history items of one page, see GmailConnector.get_history
         """
+        self.preload_labels()
 
+        added_message_ids = []
+        deleted_message_ids = set()
         for history_item in history:
             logger.debug('parsing history %s' % history_item)
-            # Get new messages
-            if 'messagesAdded' in history_item:
-                logger.debug('downloading messages %s' % [item['message']['id'] for item in history_item['messagesAdded']])
-                self._batch_sync_full_messages(
-                    [item['message']['id'] for item in history_item['messagesAdded']]
-                )
-
-            # Remove messages
-            for message in history_item.get('messagesDeleted', []):
-                logger.debug('deleting message %s' % message['message']['id'])
-                EmailMessage.objects.filter(message_id=message['message']['id'], account=self.email_account).delete()
-
-            # Make sure we have all the correct labels for
-            update_labels_for_messages = []
-            update_labels_for_messages.extend(history_item.get('labelsAdded', []))
-            update_labels_for_messages.extend(history_item.get('labelsRemoved', []))
-
-            if len(update_labels_for_messages):
-                self._batch_sync_label_info([message['message']['id'] for message in update_labels_for_messages])
-
-            # TODO: fix sync issues before incremental update of labels
-            # # Add labels to existing messages
-            # for message_dict in history_item.get('labelsAdded', []):
-            #     logger.debug('labels added, message: %s' % message_dict['message']['id'])
-            #     message = EmailMessage.objects.get(message_id=message_dict['message']['id'], account=self.email_account)
-            #     for added_label_id in message_dict['labelIds']:
-            #         if added_label_id == settings.GMAIL_UNREAD_LABEL:
-            #             message.read = False
-            #         else:
-            #             message.labels.add(self.get_label(added_label_id))
-            #     message.save()
-            #
-            # # Remove labels from existing messages
-            # for message_dict in history_item.get('labelsRemoved', []):
-            #     logger.debug('labels removed, message: %s' % message_dict['message']['id'])
-            #     message = EmailMessage.objects.get(message_id=message_dict['message']['id'], account=self.email_account)
-            #     for removed_label_id in message_dict['labelIds']:
-            #         if removed_label_id == settings.GMAIL_UNREAD_LABEL:
-            #             message.read = True
-            #         else:
-            #             message.labels.remove(self.get_label(removed_label_id))
-            #     message.save()
+            for item in history_item.get('messagesAdded', []):
+                if item['message']['id'] not in added_message_ids:
+                    added_message_ids.append(item['message']['id'])
+            for item in history_item.get('messagesDeleted', []):
+                deleted_message_ids.add(item['message']['id'])
+
+        # Get new messages
+        if added_message_ids:
+            logger.debug('downloading messages %s' % added_message_ids)
+            for message_id_batch in self._full_message_batches(added_message_ids):
+                self._batch_sync_full_messages(message_id_batch)
+
+        # Remove messages
+        if deleted_message_ids:
+            logger.debug('deleting messages %s' % list(deleted_message_ids))
+            self.delete_messages(deleted_message_ids)
+
+        # New messages are downloaded with their current labels and deleted
+        # messages don't need labels, so only update the other messages.
+        label_changes = self.coalesce_label_changes(history)
+        for message_id in set(added_message_ids) | deleted_message_ids:
+            label_changes.pop(message_id, None)
+
+        if label_changes:
+            self._apply_label_changes(label_changes)
 
         self.connector.save_history_id()
 
-    def update_unread_count(self):
+    @staticmethod
+    def coalesce_label_changes(history):
+        """
+        Combine the labelsAdded and labelsRemoved of history items to the resulting change per message.
+
+        Args:
+            history (list): history items in chronological order
+
+        Returns:
+            dict with per message_id a dict of label_id: True if the label was added, False if it was removed
+        """
+        label_changes = {}
+        for history_item in history:
+            # Within one history item a label is never both added and removed.
+            for key, added in (('labelsAdded', True), ('labelsRemoved', False)):
+                for message_dict in history_item.get(key, []):
+                    changes = label_changes.setdefault(message_dict['message']['id'], {})
+                    for label_id in message_dict.get('labelIds', []):
+                        # A later change of the same label overrides earlier changes.
+                        changes[label_id] = added
+
+        return label_changes
+
+    def _apply_label_changes(self, label_changes):
+        """
+        Apply label changes straight to the database with set based queries.
+
+        Messages that can't be updated this way (not synced yet, unknown label, conflicting update) fall back to
+        fetching their labels from the Gmail api.
+
+        Args:
+            label_changes (dict): see coalesce_label_changes
+        """
+        messages = {
+            message_id: (pk, read) for message_id, pk, read in EmailMessage.objects.filter(
+                account=self.email_account,
+                message_id__in=label_changes.keys(),
+            ).values_list('message_id', 'pk', 'read')
+        }
+        no_message_ids = set(NoEmailMessageId.objects.filter(
+            account=self.email_account,
+            message_id__in=label_changes.keys(),
+        ).values_list('message_id', flat=True))
+
+        refetch_message_ids = []
+        add_rows = set()
+        remove_rows = set()
+        read_pks = {True: set(), False: set()}
+        for message_id, changes in label_changes.items():
+            if message_id in no_message_ids:
+                # Not an email, but chatmessage, skip
+                continue
+            if message_id not in messages:
+                refetch_message_ids.append(message_id)
+                continue
+
+            message_pk, read = messages[message_id]
+            message_add_rows = set()
+            message_remove_rows = set()
+            try:
+                for label_id, added in changes.items():
+                    if label_id == settings.GMAIL_UNREAD_LABEL:
+                        # UNREAD identifier check to see if message is read
+                        if read == added:
+                            read_pks[not added].add(message_pk)
+                    elif added:
+                        message_add_rows.add((message_pk, self.get_label(label_id).pk))
+                    else:
+                        message_remove_rows.add((message_pk, self.get_label(label_id).pk))
+            except Exception:
+                logger.exception('Couldn\'t apply label changes for message %s, account %s' % (
+                    message_id,
+                    self.email_account.id,
+                ))
+                read_pks[True].discard(message_pk)
+                read_pks[False].discard(message_pk)
+                refetch_message_ids.append(message_id)
+            else:
+                add_rows |= message_add_rows
+                remove_rows |= message_remove_rows
+
+        changed_pks = set(pk for pk, label_pk in add_rows | remove_rows) | read_pks[True] | read_pks[False]
+        if changed_pks:
+            try:
+                with transaction.atomic():
+                    unread_deltas = self._get_label_change_unread_deltas(messages, add_rows, remove_rows, read_pks)
+                    self._update_message_labels(add_rows, remove_rows)
+                    for read, pks in read_pks.items():
+                        if pks:
+                            EmailMessage.objects.filter(pk__in=pks).update(read=read)
+            except IntegrityError:
+                logger.warning('Conflict applying label changes for account %s, fetching labels instead' % (
+                    self.email_account.id
+                ))
+                changed_message_ids = [message_id for message_id, (pk, read) in messages.items() if pk in changed_pks]
+                refetch_message_ids.extend(changed_message_ids)
+            else:
+                self.add_unread_deltas(unread_deltas)
+                # Bulk updates don't send signals, so index ourselves.
+                update_ids_in_index(EmailMessageMapping, list(changed_pks))
+
+        batch_size = int(settings.GMAIL_LABEL_UPDATE_BATCH_SIZE)
+        for i in range(0, len(refetch_message_ids), batch_size):
+            self._batch_sync_label_info(refetch_message_ids[i:i + batch_size])
+
+    def _get_label_change_unread_deltas(self, messages, add_rows, remove_rows, read_pks):
+        """
+        Calculate the unread count changes of label changes, before they are written.
+
+        Args:
+            messages (dict): (pk, read) of the messages by message_id
+            add_rows (set): (message pk, label pk) of labels to add
+            remove_rows (set): (message pk, label pk) of labels to remove
+            read_pks (dict): pks of messages that become read (True) or unread (False)
+
+        Returns:
+            dict with the change of the unread count per label pk
+        """
+        old_read = dict(messages.values())
+        new_read = dict(old_read)
+        for read, pks in read_pks.items():
+            for pk in pks:
+                new_read[pk] = read
+
+        # Read messages don't count, so only look up the labels of messages that are unread before or after.
+        pks = set(pk for pk, label_pk in add_rows | remove_rows) | read_pks[True] | read_pks[False]
+        pks = [pk for pk in pks if not old_read[pk] or not new_read[pk]]
+        if not pks:
+            return {}
+
+        old_labels = defaultdict(set)
+        for message_pk, label_pk in EmailMessage.labels.through.objects.filter(
+            emailmessage_id__in=pks,
+        ).values_list('emailmessage_id', 'emaillabel_id'):
+            old_labels[message_pk].add(label_pk)
+
+        new_labels = defaultdict(set)
+        for pk in pks:
+            new_labels[pk] = set(old_labels[pk])
+        for message_pk, label_pk in add_rows:
+            if message_pk in new_labels:
+                new_labels[message_pk].add(label_pk)
+        for message_pk, label_pk in remove_rows:
+            if message_pk in new_labels:
+                new_labels[message_pk].discard(label_pk)
+
+        deltas = defaultdict(int)
+        for pk in pks:
+            message_deltas = get_unread_deltas(old_read[pk], old_labels[pk], new_read[pk], new_labels[pk])
+            for label_pk, delta in message_deltas.items():
+                deltas[label_pk] += delta
+
+        return deltas
+
+    def _update_message_labels(self, add_rows, remove_rows):
+        """
+        Insert and delete the label relations of messages.
+
+        Args:
+            add_rows (set): (message pk, label pk) of labels to add
+            remove_rows (set): (message pk, label pk) of labels to remove
+        """
+        through = EmailMessage.labels.through
+
+        if add_rows:
+            add_rows -= set(through.objects.filter(
+                emailmessage_id__in=set(message_pk for message_pk, label_pk in add_rows),
+                emaillabel_id__in=set(label_pk for message_pk, label_pk in add_rows),
+            ).values_list('emailmessage_id', 'emaillabel_id'))
+            through.objects.bulk_create([
+                through(emailmessage_id=message_pk, emaillabel_id=label_pk) for message_pk, label_pk in add_rows
+            ])
+
+        remove_by_label = {}
+        for message_pk, label_pk in remove_rows:
+            remove_by_label.setdefault(label_pk, set()).add(message_pk)
+        for label_pk, message_pks in remove_by_label.items():
+            through.objects.filter(emaillabel_id=label_pk, emailmessage_id__in=message_pks).delete()
+
+    def add_unread_deltas(self, deltas):
+        """
+        Keep track of unread count changes, they are written by update_unread_count.
+
+        Args:
+            deltas (dict): change of the unread count per label pk
+        """
+        with self._unread_lock:
+            for label_pk, delta in deltas.items():
+                self.unread_deltas[label_pk] += delta
+
+    def update_unread_count(self, full=False):
         """
         Update unread count on every label.
+
+        With GMAIL_UNREAD_COUNT_INCREMENTAL enabled only the changes collected since the last update are applied,
+        otherwise all unread messages are counted again.
+
+        Args:
+            full (boolean, optional): if True, always count all unread messages
         """
-        logger.debug('Updating unread count for every label, account %s' % self.email_account.email_address)
-        for label in self.email_account.labels.all():
-            unread_count = label.messages.filter(read=False).count()
-            label.unread = unread_count
-            label.save()
+        with self._unread_lock:
+            deltas = {label_pk: delta for label_pk, delta in self.unread_deltas.items() if delta}
+            self.unread_deltas.clear()
+
+        if full or not settings.GMAIL_UNREAD_COUNT_INCREMENTAL:
+            logger.debug('Updating unread count for every label, account %s' % self.email_account.email_address)
+            unread_counts = dict(EmailMessage.labels.through.objects.filter(
+                emaillabel__account=self.email_account,
+                emailmessage__read=False,
+            ).values_list('emaillabel_id').annotate(unread=Count('emailmessage_id')))
+
+            # Only write the labels that changed.
+            changed_counts = {}
+            for label_pk, unread in EmailLabel.objects.filter(account=self.email_account).values_list('pk', 'unread'):
+                if unread_counts.get(label_pk, 0) != unread:
+                    changed_counts[label_pk] = unread_counts.get(label_pk, 0)
+
+            self._write_unread_counts(changed_counts)
+        elif deltas:
+            logger.debug('Updating unread count for %s labels, account %s' % (
+                len(deltas),
+                self.email_account.email_address,
+            ))
+            self._write_unread_counts(deltas, relative=True)
+
+    def _write_unread_counts(self, counts, relative=False):
+        """
+        Write unread counts of labels with a single UPDATE query.
+
+        Args:
+            counts (dict): unread count per label pk
+            relative (boolean, optional): if True, counts are added to the current unread counts
+        """
+        if not counts:
+            return
+
+        table = connection.ops.quote_name(EmailLabel._meta.db_table)
+        if relative:
+            value = 'GREATEST(%s.unread + counts.unread, 0)' % table
+        else:
+            value = 'counts.unread'
+
+        params = []
+        for label_pk, unread in counts.items():
+            params.extend([label_pk, unread])
+
+        cursor = connection.cursor()
+        cursor.execute(
+            'UPDATE %(table)s SET unread = %(value)s '
+            'FROM (VALUES %(values)s) AS counts (id, unread) '
+            'WHERE %(table)s.id = counts.id' % {
+                'table': table,
+                'value': value,
+                'values': ', '.join(['(%s, %s)'] * len(counts)),
+            },
+            params,
+        )
+
+    def preload_labels(self):
+        """
+        Load all labels of the email account, so get_label doesn't need a query per label.
+        """
+        with self._label_lock:
+            self.labels = {
+                label.label_id: label for label in EmailLabel.objects.filter(account=self.email_account)
+            }
 
     def get_label(self, label_id):
         """
         Returns the label given the label_id
 
+        Labels that aren't known yet are fetched from the Gmail api once and then kept in the preloaded labels.
+
         Args:
             label_id (string): label_id of the label
 
         Returns:
             EmailLabel instance
         """
-        try:
-            label = EmailLabel.objects.get(account=self.email_account, label_id=label_id)
-        except EmailLabel.DoesNotExist:
-            label_info = self.connector.get_label_info(label_id)
-            label = self.label_builder.get_or_create_label(label_info)[0]
+        if self.labels is None:
+            self.preload_labels()
+
+        with self._label_lock:
+            label = self.labels.get(label_id)
+            if label is None:
+                with self._connector_lock:
+                    label_info = self.connector.get_label_info(label_id)
+                label = self.label_builder.get_or_create_label(label_info)[0]
+                self.labels[label_id] = label
 
         return label
 
@@ -312,7 +725,8 @@ class GmailManager(object):
         Returns:
             dict with attachment info
         """
-        return self.connector.get_attachment(message_id, attachment_id)
+        with self._connector_lock:
+            return self.connector.get_attachment(message_id, attachment_id)
 
     def add_and_remove_labels_for_message(self, email_message, add_labels=[], remove_labels=[]):
         """
@@ -464,6 +878,20 @@ class GmailManager(object):
         """
         Cleanup references, to prevent reference cycle.
         """
+        logger.debug('Recipient cache stats for %s: %s' % (
+            self.email_account.email_address,
+            self.recipient_cache.stats(),
+        ))
+        logger.debug('Memory budget stats for %s: %s' % (
+            self.email_account.email_address,
+            self.memory_budget.stats(),
+        ))
+        logger.debug('Rate governor stats for %s: %s' % (
+            self.email_account.email_address,
+            self.connector.governor.stats(),
+        ))
+        self.recipient_cache = None
+        self.labels = None
         self.message_builder.cleanup()
         self.message_builder = None
         self.label_builder.cleanup()
@@ -471,5 +899,3 @@ class GmailManager(object):
         self.connector.cleanup()
         self.connector = None
         self.email_account = None
-
-        gc.collect()
@@ -0,0 +1,97 @@
+import gc
+import logging
+import resource
+import threading
+
+from django.conf import settings
+
+
+logger = logging.getLogger(__name__)
+
+
+def get_rss():
+    """
+    Return the resident set size of the current process in bytes.
+
+    Reads /proc/self/statm where available, otherwise falls back to the peak RSS reported by getrusage.
+    """
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize()
+    except (IOError, IndexError, ValueError):
+        # ru_maxrss is in kilobytes on Linux.
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class MemoryBudget(object):
+    """
+    Run the garbage collector during a sync only when memory use grows past a budget.
+
+    Instead of a full collection for every message, check() is called per processed item. Every check_interval
+    calls the RSS and the number of objects tracked by the garbage collector are compared with the values after the
+    last collection, a collection is done when either grew more than its threshold.
+
+    Attributes:
+        rss_threshold (int): max RSS growth in bytes
+        object_threshold (int): max growth of the number of tracked objects
+        check_interval (int): number of check() calls between measurements
+        collections (int): number of collections done
+        collected (int): number of unreachable objects found by those collections
+    """
+    def __init__(self, rss_threshold=None, object_threshold=None, check_interval=None):
+        """
+        Args:
+            rss_threshold (int, optional): in MB, defaults to settings.GMAIL_SYNC_GC_RSS_THRESHOLD
+            object_threshold (int, optional): defaults to settings.GMAIL_SYNC_GC_OBJECT_THRESHOLD
+            check_interval (int, optional): defaults to settings.GMAIL_SYNC_GC_CHECK_INTERVAL
+        """
+        self.rss_threshold = int(rss_threshold or settings.GMAIL_SYNC_GC_RSS_THRESHOLD) * 1024 * 1024
+        self.object_threshold = int(object_threshold or settings.GMAIL_SYNC_GC_OBJECT_THRESHOLD)
+        self.check_interval = max(int(check_interval or settings.GMAIL_SYNC_GC_CHECK_INTERVAL), 1)
+        self.collections = 0
+        self.collected = 0
+        self.checks = 0
+        # Parse workers of the sync pipeline share the budget.
+        self._lock = threading.Lock()
+        self._set_baseline()
+
+    def _set_baseline(self):
+        self.baseline_rss = get_rss()
+        self.baseline_objects = len(gc.get_objects())
+
+    def check(self):
+        """
+        Count a processed item and collect garbage if the budget is exceeded.
+
+        Returns:
+            True if a collection was done
+        """
+        with self._lock:
+            self.checks += 1
+            if self.checks % self.check_interval:
+                return False
+
+            rss_growth = get_rss() - self.baseline_rss
+            object_growth = len(gc.get_objects()) - self.baseline_objects
+            if rss_growth < self.rss_threshold and object_growth < self.object_threshold:
+                return False
+
+            logger.debug('Memory budget exceeded (rss +%s bytes, objects +%s), collecting' % (
+                rss_growth,
+                object_growth,
+            ))
+            self.collected += gc.collect()
+            self.collections += 1
+            self._set_baseline()
+            return True
+
+    def stats(self):
+        """
+        Return the collection counters, for the sync metrics.
+        """
+        return {
+            'checks': self.checks,
+            'collections': self.collections,
+            'collected': self.collected,
+            'rss': get_rss(),
+        }
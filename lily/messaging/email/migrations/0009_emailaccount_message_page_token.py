@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('email', '0008_templatevariable'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='emailaccount',
+            name='message_page_token',
+            field=models.CharField(max_length=255, null=True),
+            preserve_default=True,
+        ),
+    ]
@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import lily.messaging.email.models.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('email', '0009_emailaccount_message_page_token'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='emailattachment',
+            name='content_hash',
+            field=models.CharField(default=b'', max_length=64, db_index=True),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='emailattachment',
+            name='file_name',
+            field=models.CharField(default=b'', max_length=255),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='emailattachment',
+            name='remote_id',
+            field=models.CharField(default=b'', max_length=255),
+            preserve_default=True,
+        ),
+        migrations.AlterField(
+            model_name='emailattachment',
+            name='attachment',
+            field=models.FileField(upload_to=lily.messaging.email.models.models.get_attachment_upload_path, max_length=255, blank=True),
+            preserve_default=True,
+        ),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('email', '0010_emailattachment_content_hash'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='emailmessage',
+            name='body_html_text',
+            field=models.TextField(default=''),
+            preserve_default=True,
+        ),
+    ]
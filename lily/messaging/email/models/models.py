@@ -72,6 +72,8 @@ class EmailAccount(TenantMixin, DeletedMixin):
     # History id is a field to keep track of the sync status of a gmail box
     history_id = models.BigIntegerField(null=True)
     temp_history_id = models.BigIntegerField(null=True)
+    # Token of the next page of message ids, to resume an interrupted sync
+    message_page_token = models.CharField(max_length=255, null=True)
 
     owner = models.ForeignKey(LilyUser, related_name='email_accounts_owned')
     shared_with_users = models.ManyToManyField(
@@ -162,6 +164,8 @@ class EmailMessage(models.Model):
     account = models.ForeignKey(EmailAccount, related_name='messages')
     body_html = models.TextField(default='')
     body_text = models.TextField(default='')
+    # Plain text version of body_html for messages without a text part, so it isn't parsed when indexing.
+    body_html_text = models.TextField(default='')
     draft_id = models.CharField(max_length=50, db_index=True, default='')
     has_attachment = models.BooleanField(default=False)
     is_removed = models.BooleanField(default=False)
@@ -245,19 +249,29 @@ class EmailHeader(models.Model):
 class EmailAttachment(models.Model):
     """
     Email attachment for an EmailMessage
+
+    Synced attachments are stored by content hash, so the file can be shared by attachments of several messages.
+    Attachments that still need to be downloaded from the Gmail api have a remote_id and no file yet.
     """
-    attachment = models.FileField(upload_to=get_attachment_upload_path, max_length=255)
+    attachment = models.FileField(upload_to=get_attachment_upload_path, max_length=255, blank=True)
     cid = models.TextField(default='')
     inline = models.BooleanField(default=False)
     message = models.ForeignKey(EmailMessage, related_name='attachments')
     size = models.PositiveIntegerField(default=0)
+    file_name = models.CharField(max_length=255, default='')
+    content_hash = models.CharField(max_length=64, default='', db_index=True)
+    remote_id = models.CharField(max_length=255, default='')
 
     def __unicode__(self):
-        return self.attachment.name.split('/')[-1]
+        return self.name
 
     @property
     def name(self):
-        return self.attachment.name.split('/')[-1]
+        return self.file_name or self.attachment.name.split('/')[-1]
+
+    @property
+    def is_downloaded(self):
+        return bool(self.attachment)
 
     class Meta:
         app_label = 'email'
@@ -518,5 +532,17 @@ class EmailOutboxAttachment(TenantMixin):
 @receiver(post_delete, sender=EmailAttachment)
 def post_delete_mail_attachment_handler(sender, **kwargs):
     attachment = kwargs['instance']
-    storage, filename = attachment.attachment.storage, attachment.attachment.name
-    storage.delete(filename)
+    if not attachment.attachment:
+        return
+
+    if attachment.content_hash:
+        # The file can be shared, so only remove it when it isn't used any more. Wait a while, so the delete
+        # transaction is done and messages that are saved again can pick up their files.
+        from ..tasks import delete_unused_attachment_file
+        delete_unused_attachment_file.apply_async(
+            args=(attachment.attachment.name, attachment.content_hash),
+            countdown=settings.EMAIL_ATTACHMENT_DELETE_DELAY,
+        )
+    else:
+        storage, filename = attachment.attachment.storage, attachment.attachment.name
+        storage.delete(filename)
@@ -0,0 +1,211 @@
+import logging
+import time
+
+from django.conf import settings
+from redis.exceptions import RedisError
+
+from lily.utils.functions import get_redis_connection
+
+
+logger = logging.getLogger(__name__)
+
+# Take cost from every bucket, refilled at their current rate since the last call. A bucket may go into debt, so calls
+# costing more than the burst size still pass, the calls after it wait until the debt is paid off. The rate of a
+# bucket recovers towards its max rate over time after being lowered by a backoff.
+#
+# KEYS: bucket keys
+# ARGV: now, cost, and max rate and recovery (fraction of max rate per second) for every bucket
+# Returns the seconds to wait before trying again, 0 if the tokens are taken.
+CONSUME_SCRIPT = """
+local now = tonumber(ARGV[1])
+local cost = tonumber(ARGV[2])
+local wait = 0
+local buckets = {}
+for i, key in ipairs(KEYS) do
+    local max_rate = tonumber(ARGV[1 + i * 2])
+    local recovery = tonumber(ARGV[2 + i * 2])
+    local bucket = redis.call('HMGET', key, 'tokens', 'timestamp', 'rate')
+    local tokens = tonumber(bucket[1]) or max_rate
+    local elapsed = math.max(now - (tonumber(bucket[2]) or now), 0)
+    local rate = math.min(max_rate, (tonumber(bucket[3]) or max_rate) + max_rate * recovery * elapsed)
+    -- The burst size is one second of calls.
+    tokens = math.min(rate, tokens + rate * elapsed)
+    if tokens <= 0 then
+        wait = math.max(wait, -tokens / rate)
+    end
+    buckets[i] = {tokens, rate}
+end
+for i, key in ipairs(KEYS) do
+    local tokens = buckets[i][1]
+    if wait == 0 then
+        tokens = tokens - cost
+    end
+    redis.call('HMSET', key, 'tokens', tokens, 'timestamp', now, 'rate', buckets[i][2])
+    redis.call('EXPIRE', key, 3600)
+end
+return tostring(wait)
+"""
+
+# Lower the rate of a bucket.
+#
+# KEYS: bucket key
+# ARGV: max rate, backoff factor, min rate
+# Returns the new rate.
+BACKOFF_SCRIPT = """
+local rate = tonumber(redis.call('HGET', KEYS[1], 'rate')) or tonumber(ARGV[1])
+rate = math.max(tonumber(ARGV[3]), rate * tonumber(ARGV[2]))
+redis.call('HSET', KEYS[1], 'rate', rate)
+redis.call('EXPIRE', KEYS[1], 3600)
+return tostring(rate)
+"""
+
+
+class RateGovernor(object):
+    """
+    Pace Gmail api calls with token buckets in redis, shared by all workers.
+
+    Every call takes quota units from two buckets: one for the email account (the per user limit of the Gmail api)
+    and one for the whole project. When a bucket is empty the call waits, instead of running into rate limit errors.
+    After a rate limit error the rate of the bucket is lowered and then recovers over time.
+
+    The time spent waiting is added to the GMAIL_THROTTLE_WAIT redis counters, in total and per account.
+
+    Attributes:
+        email_account_id (int): id of the EmailAccount
+        wait_time (float): seconds this governor waited
+        throttled (int): number of times this governor waited
+    """
+    PREFIX = 'GMAIL_RATE_'
+    PROJECT = 'PROJECT'
+    ACCOUNT = 'ACCOUNT'
+    WAIT_TIME_KEY = 'GMAIL_THROTTLE_WAIT'
+
+    def __init__(self, email_account_id, connection=None):
+        """
+        Args:
+            email_account_id (int): id of the EmailAccount
+            connection (instance, optional): Redis instance
+        """
+        self.email_account_id = email_account_id
+        self.wait_time = 0.0
+        self.throttled = 0
+        self.max_rates = {
+            self.ACCOUNT: float(settings.GMAIL_RATE_ACCOUNT_UNITS),
+            self.PROJECT: float(settings.GMAIL_RATE_PROJECT_UNITS),
+        }
+        self.keys = {
+            self.ACCOUNT: '%s%s_%s' % (self.PREFIX, self.ACCOUNT, email_account_id),
+            self.PROJECT: '%s%s' % (self.PREFIX, self.PROJECT),
+        }
+
+        self.connection = connection or get_redis_connection()
+        self._consume = self.connection.register_script(CONSUME_SCRIPT)
+        self._backoff = self.connection.register_script(BACKOFF_SCRIPT)
+
+    def acquire(self, cost=None):
+        """
+        Wait until there is quota for a call.
+
+        When redis isn't available calls aren't paced at all.
+
+        Args:
+            cost (int, optional): quota units of the call, defaults to settings.GMAIL_RATE_DEFAULT_COST
+        """
+        if not settings.GMAIL_RATE_GOVERNOR_ENABLED:
+            return
+
+        cost = cost or settings.GMAIL_RATE_DEFAULT_COST
+        args = [time.time(), cost]
+        for bucket in (self.ACCOUNT, self.PROJECT):
+            args.extend([self.max_rates[bucket], settings.GMAIL_RATE_RECOVERY])
+
+        while True:
+            try:
+                wait = float(self._consume(keys=[self.keys[self.ACCOUNT], self.keys[self.PROJECT]], args=args))
+            except RedisError:
+                logger.exception('Rate governor unavailable, not pacing calls for %s' % self.email_account_id)
+                return
+
+            if not wait:
+                return
+
+            logger.debug('Throttling calls for %s, waiting %.2f seconds' % (self.email_account_id, wait))
+            time.sleep(wait)
+            self._add_wait_time(wait)
+            args[0] = time.time()
+
+    def backoff(self, project=False):
+        """
+        Lower the rate after a rate limit error.
+
+        Args:
+            project (boolean, optional): if True, lower the rate of the project instead of the account
+        """
+        if not settings.GMAIL_RATE_GOVERNOR_ENABLED:
+            return
+
+        bucket = self.PROJECT if project else self.ACCOUNT
+        max_rate = self.max_rates[bucket]
+        try:
+            rate = self._backoff(keys=[self.keys[bucket]], args=[
+                max_rate,
+                settings.GMAIL_RATE_BACKOFF_FACTOR,
+                max_rate * settings.GMAIL_RATE_MIN_FACTOR,
+            ])
+        except RedisError:
+            logger.exception('Rate governor unavailable, can\'t lower rate for %s' % self.email_account_id)
+        else:
+            logger.warning('Lowered %s rate for %s to %s units per second' % (
+                bucket.lower(),
+                self.email_account_id,
+                rate,
+            ))
+
+    def get_rate_factor(self):
+        """
+        Return the current rate of the account relative to its max rate.
+        """
+        if not settings.GMAIL_RATE_GOVERNOR_ENABLED:
+            return 1.0
+
+        try:
+            rate = self.connection.hget(self.keys[self.ACCOUNT], 'rate')
+        except RedisError:
+            return 1.0
+
+        if rate is None:
+            return 1.0
+        return min(float(rate) / self.max_rates[self.ACCOUNT], 1.0)
+
+    def batch_size(self, size):
+        """
+        Scale a batch size to the current rate of the account, so lowered rates also lead to smaller batches.
+
+        Args:
+            size (int): batch size at the max rate
+
+        Returns:
+            int with the batch size to use
+        """
+        return max(int(size * self.get_rate_factor()), 1)
+
+    def _add_wait_time(self, wait):
+        self.wait_time += wait
+        self.throttled += 1
+        try:
+            pipe = self.connection.pipeline()
+            pipe.incrbyfloat(self.WAIT_TIME_KEY, wait)
+            pipe.incrbyfloat('%s_%s' % (self.WAIT_TIME_KEY, self.email_account_id), wait)
+            pipe.execute()
+        except RedisError:
+            pass
+
+    def stats(self):
+        """
+        Return the throttle counters of this governor.
+        """
+        return {
+            'throttled': self.throttled,
+            'wait_time': self.wait_time,
+            'rate_factor': self.get_rate_factor(),
+        }
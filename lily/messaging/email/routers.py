@@ -0,0 +1,79 @@
+import zlib
+
+from django.conf import settings
+
+
+# Lanes of email tasks, every lane has settings.EMAIL_QUEUE_SHARDS queues named <lane>_<shard>.
+FIRST_SYNC_LANE = 'email_first_sync'
+SYNC_LANE = 'email_sync'
+ACTIONS_LANE = 'email_actions'
+LANES = (FIRST_SYNC_LANE, SYNC_LANE, ACTIONS_LANE)
+
+TASK_LANES = {
+    'first_synchronize_email_account': FIRST_SYNC_LANE,
+    'synchronize_email_account': SYNC_LANE,
+    'toggle_read_email_message': ACTIONS_LANE,
+    'archive_email_message': ACTIONS_LANE,
+    'trash_email_message': ACTIONS_LANE,
+    'add_and_remove_labels_for_message': ACTIONS_LANE,
+    'delete_email_message': ACTIONS_LANE,
+    'send_message': ACTIONS_LANE,
+    'create_draft_email_message': ACTIONS_LANE,
+    'update_draft_email_message': ACTIONS_LANE,
+}
+
+
+def get_shard(key):
+    """
+    Return the shard of a key, the same key always maps to the same shard.
+
+    Args:
+        key: id to shard on, usually the id of an EmailAccount
+
+    Returns:
+        int with the shard number
+    """
+    return (zlib.crc32(str(key)) & 0xffffffff) % settings.EMAIL_QUEUE_SHARDS
+
+
+def get_queue_name(lane, shard):
+    return '%s_%s' % (lane, shard)
+
+
+def get_worker_queue_names(lane, worker=0, workers=1):
+    """
+    Return the queues of a lane one of the workers of the lane consumes, the shards are divided between the workers.
+
+    Args:
+        lane (string): name of the lane
+        worker (int, optional): number of the worker, from 0 to workers - 1
+        workers (int, optional): number of workers of the lane
+
+    Returns:
+        list with the queue names
+    """
+    return [get_queue_name(lane, shard) for shard in range(settings.EMAIL_QUEUE_SHARDS) if shard % workers == worker]
+
+
+class EmailTaskRouter(object):
+    """
+    Route email tasks to a queue in their lane, by the shard of their first argument.
+
+    Separate lanes keep first syncs from delaying incremental syncs, and user actions from waiting behind either of
+    them. Sync tasks get the account id as first argument, so all syncs of an account go to the same queue and the
+    workers of that queue keep its caches warm. Actions get the id of a message, which spreads them over the shards.
+
+    Returns no route when settings.EMAIL_QUEUE_SHARDS is 0, so the other CELERY_ROUTES apply.
+    """
+
+    def route_for_task(self, task, args=None, kwargs=None):
+        lane = TASK_LANES.get(task)
+        if lane is None or not settings.EMAIL_QUEUE_SHARDS:
+            return None
+
+        key = args[0] if args else (kwargs or {}).get('account_id')
+        queue = get_queue_name(lane, get_shard(key))
+        return {
+            'queue': queue,
+            'routing_key': queue,
+        }
@@ -1,8 +1,6 @@
-from bs4 import BeautifulSoup
 from lily.search.base_mapping import BaseMapping
 
 from .models.models import EmailMessage
-from python_imap.utils import convert_br_to_newline
 
 
 class EmailMessageMapping(BaseMapping):
@@ -114,6 +112,8 @@ class EmailMessageMapping(BaseMapping):
             'account',
         ).select_related(
             'sender',
+        ).defer(
+            'body_html',
         )
 
     @classmethod
@@ -140,7 +140,7 @@ class EmailMessageMapping(BaseMapping):
             'received_by_cc_name': [receiver.name for receiver in obj.received_by_cc.all() if receiver.name],
             'message_id': obj.message_id,
             'thread_id': obj.thread_id,
-            'body': obj.body_text or cls.body_html_parsed(obj),
+            'body': obj.body_text or obj.body_html_text,
             'is_removed': obj.is_removed,
         }
 
@@ -149,7 +149,8 @@ class EmailMessageMapping(BaseMapping):
         return False
 
     @classmethod
-    def body_html_parsed(cls, obj):
-        soup = BeautifulSoup(obj.body_html, 'lxml', from_encoding='utf-8')
-        soup = convert_br_to_newline(soup)
-        return soup.get_text()
+    def get_tenant_ids(cls, ids):
+        """
+        Return a dict with the tenant id of every object.
+        """
+        return dict(cls.get_model().objects.filter(pk__in=ids).values_list('pk', 'account__tenant_id'))
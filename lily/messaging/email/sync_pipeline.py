@@ -0,0 +1,226 @@
+import logging
+import threading
+import time
+from Queue import Queue
+
+from django.conf import settings
+from django.db import connection
+
+from .builders.batch import MessageBatchBuilder
+from .builders.message import MessageBuilder
+from .connector import GmailConnector
+
+
+logger = logging.getLogger(__name__)
+
+# Sentinel that tells a stage worker there is no more work.
+_STOP = object()
+
+
+class SyncPipeline(object):
+    """
+    Pipelined full sync of messages for a GmailManager.
+
+    Fetching (Gmail batch requests), parsing (MessageBuilder) and persisting (database) run as separate stages, each
+    with its own pool of worker threads. The stages are connected by bounded queues, so a slow stage makes the stages
+    before it wait instead of letting fetched messages pile up in memory.
+
+    Attributes:
+        manager: GmailManager instance
+        fetch_workers (int): number of threads doing Gmail batch requests
+        parse_workers (int): number of threads parsing message info
+        save_workers (int): number of threads saving messages to the database
+        stats (dict): number of items and seconds spent per stage
+    """
+    def __init__(self, manager, fetch_workers=None, parse_workers=None, save_workers=None, queue_size=None):
+        """
+        Args:
+            manager (instance): GmailManager instance
+            fetch_workers (int, optional): defaults to settings.GMAIL_SYNC_FETCH_WORKERS
+            parse_workers (int, optional): defaults to settings.GMAIL_SYNC_PARSE_WORKERS
+            save_workers (int, optional): defaults to settings.GMAIL_SYNC_SAVE_WORKERS
+            queue_size (int, optional): max number of messages waiting between stages,
+                defaults to settings.GMAIL_SYNC_QUEUE_SIZE
+        """
+        self.manager = manager
+        self.fetch_workers = max(int(fetch_workers or settings.GMAIL_SYNC_FETCH_WORKERS), 1)
+        self.parse_workers = max(int(parse_workers or settings.GMAIL_SYNC_PARSE_WORKERS), 1)
+        self.save_workers = max(int(save_workers or settings.GMAIL_SYNC_SAVE_WORKERS), 1)
+        queue_size = max(int(queue_size or settings.GMAIL_SYNC_QUEUE_SIZE), 1)
+
+        # Message id batches are big, so only keep one waiting per fetch worker.
+        self.batch_queue = Queue(maxsize=self.fetch_workers)
+        self.parse_queue = Queue(maxsize=queue_size)
+        self.save_queue = Queue(maxsize=queue_size)
+
+        self.aborted = threading.Event()
+        self.errors = []
+        self.stats = {}
+        self._stats_lock = threading.Lock()
+
+    def run(self, message_id_batches):
+        """
+        Download, parse and save all messages.
+
+        Args:
+            message_id_batches (iterable): lists of message ids, every list is fetched with one batch request
+
+        Raises:
+            Any exception raised while iterating message_id_batches (e.g. SyncLimitReached) or the first exception
+            raised by one of the stages.
+        """
+        stages = [
+            (self.batch_queue, self._start_workers(self.fetch_workers, self.batch_queue, self._fetch)),
+            (self.parse_queue, self._start_workers(self.parse_workers, self.parse_queue, self._parse)),
+            (self.save_queue, self._start_workers(self.save_workers, self.save_queue, self._save, self._flush)),
+        ]
+
+        try:
+            for message_ids in message_id_batches:
+                if self.aborted.is_set():
+                    break
+                # Blocks while the fetch workers are busy, which stops us from
+                # enumerating further ahead than the pipeline can handle.
+                self.batch_queue.put(message_ids)
+        finally:
+            # Shut down the stages in order, so every stage is able to hand
+            # off its remaining work to the next one.
+            for queue, workers in stages:
+                for worker in workers:
+                    queue.put(_STOP)
+                for worker in workers:
+                    worker.join()
+
+            logger.debug('Pipeline stats for %s: %s' % (self.manager.email_account.email_address, self.stats))
+
+        if self.errors:
+            raise self.errors[0]
+
+    def _start_workers(self, count, queue, handler, finish=None):
+        workers = []
+        for n in range(count):
+            worker = threading.Thread(
+                target=self._work,
+                args=(queue, handler, finish),
+                name='%s-%s' % (handler.__name__.lstrip('_'), n),
+            )
+            worker.daemon = True
+            worker.start()
+            workers.append(worker)
+        return workers
+
+    def _work(self, queue, handler, finish=None):
+        """
+        Worker loop: take items from queue and process them with handler until told to stop, then call finish.
+
+        After an error in any stage the workers keep draining their queue without processing, so neither the
+        producer nor the other stages can block on a full queue.
+        """
+        context = {}
+        try:
+            while True:
+                item = queue.get()
+                if item is _STOP:
+                    if finish:
+                        self._handle(finish, context)
+                    break
+                self._handle(handler, context, item)
+        finally:
+            if 'connector' in context:
+                context['connector'].cleanup()
+            # Every thread gets its own database connection, don't leave it open.
+            connection.close()
+
+    def _handle(self, handler, context, *args):
+        if self.aborted.is_set():
+            return
+
+        start = time.time()
+        try:
+            handler(context, *args)
+        except Exception as e:
+            logger.exception('Pipeline stage %s failed for account %s' % (
+                handler.__name__,
+                self.manager.email_account.id,
+            ))
+            self.errors.append(e)
+            self.aborted.set()
+        finally:
+            self._add_stats(handler.__name__.lstrip('_'), time.time() - start)
+
+    def _add_stats(self, stage, seconds):
+        with self._stats_lock:
+            count, total = self.stats.get(stage, (0, 0.0))
+            self.stats[stage] = (count + 1, total + seconds)
+
+    def _fetch(self, context, message_ids):
+        """
+        Fetch stage: download message info for a batch of message ids.
+
+        Every fetch worker uses its own connector, the Gmail service isn't thread safe.
+        """
+        if 'connector' not in context:
+            context['connector'] = GmailConnector(self.manager.email_account)
+
+        messages_info = context['connector'].get_message_list_info(message_ids)
+
+        for message_id in message_ids:
+            # Message info is None if the message was deleted in the meantime.
+            self.parse_queue.put((message_id, messages_info.get(message_id)))
+
+    def _parse(self, context, item):
+        """
+        Parse stage: build the message, only reading from the database.
+
+        Everything is written by the save stage, so messages that are parsed but not saved when the pipeline is
+        aborted are left as they are.
+        """
+        message_id, message_info = item
+        if message_info is None:
+            self.save_queue.put((message_id, None))
+            return
+
+        self.manager.memory_budget.check()
+        logger.debug('Parsing message: %s, account %s' % (message_id, self.manager.email_account.email_address))
+        builder = MessageBuilder(self.manager)
+        builder.store_message_info(message_info, message_id)
+        self.save_queue.put((message_id, builder))
+
+    def _save(self, context, item):
+        """
+        Save stage: persist a parsed message or delete a message that no longer exists.
+
+        With bulk saving enabled messages are collected per save worker and written a batch at a time.
+        """
+        message_id, builder = item
+        if builder is None:
+            logger.debug('Deleting message %s, account %s' % (message_id, self.manager.email_account.email_address))
+            self.manager.delete_messages([message_id])
+            return
+
+        if settings.GMAIL_SYNC_BULK_SAVE_ENABLED:
+            if 'batch_builder' not in context:
+                context['batch_builder'] = MessageBatchBuilder(self.manager)
+            context['batch_builder'].add(builder)
+            if len(context['batch_builder']) >= int(settings.GMAIL_FULL_MESSAGE_BATCH_SIZE):
+                self._flush(context)
+            return
+
+        logger.debug('Storing message: %s, account %s' % (message_id, self.manager.email_account.email_address))
+        try:
+            builder.save()
+        except Exception:
+            logger.exception('Couldn\'t save message %s for account %s' % (message_id, self.manager.email_account.id))
+        finally:
+            builder.cleanup()
+
+    def _flush(self, context):
+        """
+        Save the messages collected by a save worker.
+        """
+        if context.get('batch_builder'):
+            logger.debug('Storing %s messages, account %s' % (
+                len(context['batch_builder']),
+                self.manager.email_account.email_address,
+            ))
+            context['batch_builder'].save()
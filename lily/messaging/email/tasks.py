@@ -1,4 +1,5 @@
 import logging
+import random
 import traceback
 
 from celery.task import task
@@ -8,6 +9,11 @@ from django.core.files.storage import default_storage
 from taskmonitor.decorators import monitor_task
 from taskmonitor.utils import lock_task
 
+from .attachments import is_attachment_blob_pending, lock_attachment_blob, store_attachment_data
+from .builders.message import get_unread_deltas
+from .cadence import SyncCadence
+from .connector import GmailConnector
+from .credentials import InvalidCredentialsError
 from .manager import GmailManager, ManagerError, SyncLimitReached
 from .models.models import (EmailAccount, EmailMessage, EmailOutboxMessage, EmailTemplateAttachment,
                             EmailOutboxAttachment, EmailAttachment)
@@ -23,13 +29,23 @@ def synchronize_email_account_scheduler():
     Start new tasks for every active mailbox to start synchronizing.
     """
     delay_timer = 0
-    for email_account in EmailAccount.objects.filter(is_authorized=True, is_deleted=False):
+    email_accounts = list(EmailAccount.objects.filter(is_authorized=True, is_deleted=False))
+
+    # Only sync the accounts that are due according to how often they change.
+    cadence = SyncCadence()
+    due_ids = cadence.get_due([email_account.pk for email_account in email_accounts if email_account.history_id])
+
+    # Take the sync locks of all accounts that aren't syncing at once, so an
+    # account isn't scheduled again before its sync task runs.
+    locked_ids = set(EmailSyncLock.acquire_many(due_ids))
+
+    for email_account in email_accounts:
         logger.debug('Scheduling sync for %s', email_account.email_address)
 
         if not email_account.history_id:
             # First synchronize
             # Lock the task to prevent multiple tasks
-            locked, status = lock_task('first_synchronize_email_account', email_account.pk)
+            locked, lock_id = lock_task('first_synchronize_email_account', email_account.pk)
             if locked:
                 logger.debug('Adding task for first sync for %s', email_account.email_address)
 
@@ -37,34 +53,38 @@ def synchronize_email_account_scheduler():
                     args=(email_account.pk,),
                     max_retries=1,
                     default_retry_delay=100,
-                    kwargs={'status_id': status.pk},
+                    kwargs={'lock_id': lock_id},
                 )
             else:
                 logger.debug('Skipping task first sync for %s, already scheduled', email_account.email_address)
         else:
             logger.debug('Adding task for sync for %s', email_account.email_address)
 
-            lock = EmailSyncLock(email_account.pk)
-
-            if not lock.is_set():
+            if email_account.pk in locked_ids:
                 logger.info('Starting sync for: %s', email_account.email_address)
+                if settings.GMAIL_SYNC_CADENCE_ENABLED:
+                    # Spread the syncs randomly instead of all at the start of the interval.
+                    countdown = random.uniform(0, settings.GMAIL_SYNC_SCHEDULE_SPREAD)
+                else:
+                    countdown = delay_timer
+                    delay_timer += settings.GMAIL_SYNC_DELAY_INTERVAL
                 synchronize_email_account.apply_async(
                     args=(email_account.pk,),
                     max_retries=1,
                     default_retry_delay=100,
-                    countdown=delay_timer,
+                    countdown=countdown,
                 )
-                delay_timer += settings.GMAIL_SYNC_DELAY_INTERVAL
 
 
 @task(name='synchronize_email_account', bind=True)
 @task(logger=logger)
-def synchronize_email_account(account_id):
+def synchronize_email_account(account_id, pages=0):
     """
     Synchronize task for all email accounts that are connected with gmail api.
 
     Args:
         account_id (int): id of the EmailAccount
+        pages (int): number of history pages synced by the previous tasks of this sync
     """
     succes = False
     # Create lock object for account
@@ -73,6 +93,7 @@ def synchronize_email_account(account_id):
         email_account = EmailAccount.objects.get(pk=account_id, is_deleted=False)
     except EmailAccount.DoesNotExist:
         logger.warning('EmailAccount no longer exists: %s', account_id)
+        lock.release()
         return False
 
     if email_account.is_authorized:
@@ -86,6 +107,7 @@ def synchronize_email_account(account_id):
                 manager.update_unread_count()
                 synchronize_email_account.apply_async(
                     args=(account_id,),
+                    kwargs={'pages': pages + 1},
                     max_retries=1,
                     default_retry_delay=100,
                     countdown=1,
@@ -93,6 +115,7 @@ def synchronize_email_account(account_id):
                 logger.info('History page sync done for: %s', email_account)
             else:
                 # Done syncing
+                SyncCadence().record_sync(account_id, pages)
                 # Release the lock for this account
                 lock.release()
                 logger.info('Sync done for: %s', email_account)
@@ -113,6 +136,48 @@ def synchronize_email_account(account_id):
     return succes
 
 
+@task(name='handle_gmail_push_notification')
+def handle_gmail_push_notification(email_address, history_id):
+    """
+    Start a sync for the accounts of a mailbox that changed, according to a push notification.
+
+    Accounts that are synced up to the notified history id already, or that are syncing right now, are skipped. A
+    running sync keeps fetching history pages until there are none left, so it picks up the changes too.
+
+    Args:
+        email_address (string): email address of the mailbox
+        history_id (int): history id of the mailbox after the change
+    """
+    email_accounts = EmailAccount.objects.filter(
+        email_address=email_address,
+        is_authorized=True,
+        is_deleted=False,
+        history_id__lt=history_id,
+    )
+
+    for account_id in EmailSyncLock.acquire_many([email_account.pk for email_account in email_accounts]):
+        logger.info('Starting sync for %s after push notification', account_id)
+        synchronize_email_account.apply_async(
+            args=(account_id,),
+            max_retries=1,
+            default_retry_delay=100,
+        )
+
+
+@task(name='watch_email_accounts')
+def watch_email_accounts():
+    """
+    Start or renew the push notification watch of every authorized account.
+    """
+    for email_account in EmailAccount.objects.filter(is_authorized=True, is_deleted=False):
+        try:
+            response = GmailConnector(email_account).watch()
+        except Exception:
+            logger.exception('Could not watch %s' % email_account.email_address)
+        else:
+            logger.debug('Watching %s until %s' % (email_account.email_address, response.get('expiration')))
+
+
 @task(name='first_synchronize_email_account', bind=True)
 @monitor_task(logger=logger)
 def first_synchronize_email_account(account_id):
@@ -133,6 +198,7 @@ def first_synchronize_email_account(account_id):
             manager.synchronize(limit=int(settings.GMAIL_PARTIAL_SYNC_LIMIT))
         except SyncLimitReached:
             logger.debug('Finished partial sync')
+            manager.update_unread_count(full=True)
         except Exception:
             logger.exception('No sync for account %s' % email_account)
         finally:
@@ -151,6 +217,7 @@ def toggle_read_email_message(email_id, read=True):
     """
     try:
         email_message = EmailMessage.objects.get(pk=email_id)
+        old_read = email_message.read
         email_message.read = read
         email_message.save()
     except EmailMessage.DoesNotExist:
@@ -158,6 +225,10 @@ def toggle_read_email_message(email_id, read=True):
     else:
         manager = GmailManager(email_message.account)
         try:
+            label_pks = email_message.labels.values_list('pk', flat=True)
+            manager.add_unread_deltas(get_unread_deltas(old_read, label_pks, read, label_pks))
+            manager.update_unread_count()
+
             logger.debug('Toggle read: %s', email_message)
             manager.toggle_read_email_message(email_message, read=read)
         except Exception, e:
@@ -177,12 +248,16 @@ def archive_email_message(email_id):
     """
     try:
         email_message = EmailMessage.objects.get(pk=email_id)
+        label_pks = list(email_message.labels.values_list('pk', flat=True))
         email_message.labels.clear()
     except EmailMessage.DoesNotExist:
         logger.warning('EmailMessage no longer exists: %s', email_id)
     else:
         manager = GmailManager(email_message.account)
         try:
+            manager.add_unread_deltas(get_unread_deltas(email_message.read, label_pks, email_message.read, []))
+            manager.update_unread_count()
+
             logger.debug('Archiving: %s', email_message)
             manager.archive_email_message(email_message)
         except Exception, e:
@@ -331,6 +406,10 @@ def send_message(email_outbox_message_id, original_message_id=None):
             except EmailAttachment.DoesNotExist:
                 pass
             else:
+                if not original_attachment.is_downloaded:
+                    download_email_attachments(original_attachment.message_id)
+                    original_attachment = EmailAttachment.objects.get(pk=attachment_id)
+
                 outbox_attachment = EmailOutboxAttachment()
                 outbox_attachment.email_outbox_message = email_outbox_message
                 outbox_attachment.tenant_id = original_attachment.message.tenant_id
@@ -341,7 +420,7 @@ def send_message(email_outbox_message_id, original_message_id=None):
                 file.close()
 
                 file = ContentFile(content)
-                file.name = original_attachment.attachment.name
+                file.name = original_attachment.name
 
                 outbox_attachment.attachment = file
                 outbox_attachment.inline = original_attachment.inline
@@ -456,3 +535,87 @@ def update_draft_email_message(email_outbox_message_id, current_draft_pk):
             manager.cleanup()
 
     return draft_success
+
+
+@task(name='download_email_attachments')
+def download_email_attachments(message_id, attachment_ids=None):
+    """
+    Download the attachments of an EmailMessage that weren't downloaded while syncing.
+
+    Args:
+        message_id (int): id of the EmailMessage
+        attachment_ids (list, optional): only download the EmailAttachments with these ids
+    """
+    attachments = EmailAttachment.objects.filter(
+        message_id=message_id,
+        attachment='',
+    ).exclude(remote_id='').select_related('message__account')
+    if attachment_ids is not None:
+        attachments = attachments.filter(pk__in=attachment_ids)
+    attachments = list(attachments)
+
+    if not attachments:
+        return
+
+    email_message = attachments[0].message
+    try:
+        connector = GmailConnector(email_message.account)
+    except InvalidCredentialsError:
+        logger.warning('Not downloading attachments, no valid credentials for %s', email_message.account)
+        return
+
+    try:
+        for attachment in attachments:
+            logger.debug('Downloading attachment %s for message %s', attachment.pk, email_message.message_id)
+            attachment_data = connector.get_attachment(email_message.message_id, attachment.remote_id)
+            if not attachment_data or 'data' not in attachment_data:
+                logger.warning('No attachment could be downloaded for attachment %s', attachment.pk)
+                continue
+
+            path, content_hash, size = store_attachment_data(
+                email_message.account.tenant_id,
+                attachment_data['data'],
+                attachment.file_name,
+            )
+            EmailAttachment.objects.filter(pk=attachment.pk).update(
+                attachment=path,
+                content_hash=content_hash,
+                size=size,
+            )
+
+            # The file could have been deleted as unused right before the update, store it again in that case.
+            with lock_attachment_blob(path):
+                deleted = not default_storage.exists(path)
+            if deleted:
+                logger.warning('Attachment file %s was deleted while downloading, storing it again', path)
+                store_attachment_data(email_message.account.tenant_id, attachment_data['data'], attachment.file_name)
+    finally:
+        connector.cleanup()
+
+
+@task(name='delete_unused_attachment_file')
+def delete_unused_attachment_file(path, content_hash=None):
+    """
+    Remove an attachment file from storage when no EmailAttachment refers to it any more.
+
+    Args:
+        path (string): path of the file in default_storage
+        content_hash (string, optional): content hash of the file
+    """
+    if content_hash:
+        attachments = EmailAttachment.objects.filter(content_hash=content_hash, attachment=path)
+    else:
+        # Queued before the content hash was passed.
+        attachments = EmailAttachment.objects.filter(attachment=path)
+
+    with lock_attachment_blob(path):
+        if attachments.exists():
+            logger.debug('Attachment file %s is still used', path)
+        elif is_attachment_blob_pending(path):
+            # Stored again for an attachment that isn't saved yet, check again later.
+            delete_unused_attachment_file.apply_async(
+                args=(path, content_hash),
+                countdown=settings.EMAIL_ATTACHMENT_DELETE_DELAY,
+            )
+        else:
+            default_storage.delete(path)
@@ -1,6 +1,984 @@
+import base64
+from collections import defaultdict
+import threading
+import time
 from unittest import TestCase
 
+import anyjson
+import httplib2
+from django.db import IntegrityError
+from django.db.models.signals import post_save
+from django.test import SimpleTestCase, TestCase as DatabaseTestCase
+from django.test.client import RequestFactory
+from django.test.utils import override_settings
+from googleapiclient.errors import HttpError
 from python_imap.utils import convert_html_to_text
+from redis.exceptions import RedisError
+
+from lily.users.factories import LilyUserFactory
+from lily.utils.functions import get_redis_connection
+
+from . import connector, ratelimit, tasks, views
+from .builders.batch import MessageBatchBuilder
+from .builders.message import MessageBuilder, get_unread_deltas
+from .builders.recipient import RecipientCache
+from .cadence import SyncCadence
+from .connector import FailedServiceCallException, GmailConnector
+from .manager import GmailManager
+from .memory import MemoryBudget
+from .models.models import EmailAccount, EmailLabel, EmailMessage, NoEmailMessageId
+from .ratelimit import RateGovernor
+from .routers import EmailTaskRouter, get_worker_queue_names
+from .sync_pipeline import SyncPipeline
+from .utils import get_content_disposition
+
+
+class FakeRecipientCache(RecipientCache):
+    """
+    RecipientCache that creates recipients without the database.
+    """
+    def __init__(self, *args, **kwargs):
+        super(FakeRecipientCache, self).__init__(*args, **kwargs)
+        self.lookups = []
+
+    def _get_or_create(self, keys):
+        self.lookups.append(sorted(keys))
+        return {key: '%s <%s>' % key for key in keys}
+
+
+class RecipientCacheTestCase(TestCase):
+
+    def test_misses_are_looked_up_at_once(self):
+        cache = FakeRecipientCache(max_size=10)
+
+        recipients = cache.resolve([('A', 'a@example.com'), ('B', 'b@example.com'), ('A', 'a@example.com')])
+
+        self.assertEqual(recipients[('A', 'a@example.com')], 'A <a@example.com>')
+        self.assertEqual(cache.lookups, [[('A', 'a@example.com'), ('B', 'b@example.com')]])
+        self.assertEqual((cache.hits, cache.misses), (0, 2))
+
+    def test_hits_are_not_looked_up(self):
+        cache = FakeRecipientCache(max_size=10)
+        cache.resolve([('A', 'a@example.com')])
+
+        self.assertEqual(cache.get('A', 'a@example.com'), 'A <a@example.com>')
+        self.assertEqual(len(cache.lookups), 1)
+        self.assertEqual(cache.stats()['hit_rate'], 0.5)
+
+    def test_least_recently_used_is_evicted(self):
+        cache = FakeRecipientCache(max_size=2)
+        cache.resolve([('A', 'a@example.com')])
+        cache.resolve([('B', 'b@example.com')])
+        # Use A again, so B is the least recently used.
+        cache.resolve([('A', 'a@example.com')])
+        cache.resolve([('C', 'c@example.com')])
+
+        cache.resolve([('A', 'a@example.com'), ('B', 'b@example.com')])
+
+        self.assertEqual(cache.lookups[-1], [('B', 'b@example.com')])
+        self.assertEqual(cache.stats()['size'], 2)
+
+
+class FakeMessageBuilder(object):
+    """
+    MessageBuilder that only looks up its recipients when saved.
+    """
+    def __init__(self, manager, recipient_keys):
+        self.manager = manager
+        self.recipient_keys = recipient_keys
+        self.message = type('FakeMessage', (object,), {'pk': None, 'message_id': 'message'})()
+        self.saved = False
+
+    def get_recipient_keys(self):
+        return set(self.recipient_keys)
+
+    def save(self):
+        self.manager.recipient_cache.resolve(self.recipient_keys)
+        self.saved = True
+
+    def cleanup(self):
+        pass
+
+
+class ConflictingMessageBatchBuilder(MessageBatchBuilder):
+    """
+    MessageBatchBuilder of which the bulk save always conflicts after looking up the recipients.
+    """
+    def _bulk_save(self, new_builders):
+        for builder in self.builders:
+            self.manager.recipient_cache.resolve(builder.get_recipient_keys())
+        raise IntegrityError('duplicate key value violates unique constraint')
+
+
+class MessageBatchBuilderTestCase(TestCase):
+
+    def test_rolled_back_recipients_are_looked_up_again(self):
+        manager = type('FakeManager', (object,), {})()
+        manager.email_account = type('FakeEmailAccount', (object,), {'id': 1})()
+        manager.recipient_cache = FakeRecipientCache(max_size=10)
+        builder = FakeMessageBuilder(manager, [('A', 'a@example.com')])
+
+        batch = ConflictingMessageBatchBuilder(manager)
+        batch.add(builder)
+        batch.save()
+
+        # The recipient looked up in the rolled back transaction isn't used by the fallback.
+        self.assertTrue(builder.saved)
+        self.assertEqual(manager.recipient_cache.lookups, [[('A', 'a@example.com')], [('A', 'a@example.com')]])
+        self.assertEqual(manager.recipient_cache.stats()['size'], 1)
+
+    def test_recipients_are_kept_after_commit(self):
+        cache = FakeRecipientCache(max_size=10)
+        cache._in_transaction = lambda: True
+        cache.resolve([('A', 'a@example.com')])
+        cache.commit()
+        cache.rollback()
+
+        cache.resolve([('A', 'a@example.com')])
+
+        self.assertEqual(len(cache.lookups), 1)
+
+
+class FakeGmailManager(GmailManager):
+    """
+    GmailManager with preloaded labels, that doesn't connect to Gmail.
+    """
+    def __init__(self, email_account, labels):
+        self.email_account = email_account
+        self.labels = {label.label_id: label for label in labels}
+        self.unread_deltas = defaultdict(int)
+        self._label_lock = threading.Lock()
+        self._connector_lock = threading.Lock()
+        self._unread_lock = threading.Lock()
+        self.message_builder = MessageBuilder(self)
+        self.recipient_cache = RecipientCache()
+        self.memory_budget = MemoryBudget()
+
+
+def get_message_info(message_id, label_ids, to='To <to@example.com>', subject='Subject', attachment_id='remote-1',
+                     sender='Sender <sender@example.com>'):
+    """
+    Return the message info of a message like the Gmail api does.
+    """
+    headers = [
+        {'name': 'Date', 'value': 'Mon, 5 Oct 2015 10:00:00 +0200'},
+        {'name': 'Subject', 'value': subject},
+        {'name': 'Thread-Topic', 'value': subject},
+        {'name': 'To', 'value': to},
+        {'name': 'Cc', 'value': 'Cc <cc@example.com>'},
+    ]
+    if sender:
+        headers.append({'name': 'From', 'value': sender})
+
+    parts = [{
+        'mimeType': 'text/plain',
+        'filename': '',
+        'headers': [{'name': 'Content-Type', 'value': 'text/plain; charset="utf-8"'}],
+        'body': {'data': base64.urlsafe_b64encode('Hello')},
+    }]
+    if attachment_id:
+        parts.append({
+            'partId': '1',
+            'mimeType': 'application/pdf',
+            'filename': '%s.pdf' % attachment_id,
+            'headers': [{'name': 'Content-Type', 'value': 'application/pdf'}],
+            'body': {'attachmentId': attachment_id, 'size': 10},
+        })
+
+    return {
+        'id': message_id,
+        'threadId': 'thread',
+        'snippet': 'Hello',
+        'labelIds': label_ids,
+        'payload': {
+            'mimeType': 'multipart/mixed',
+            'headers': headers,
+            'parts': parts,
+        },
+    }
+
+
+@override_settings(ES_DISABLED=True, GMAIL_ATTACHMENT_DOWNLOAD_ASYNC=True)
+class BulkSaveTestCase(DatabaseTestCase):
+    """
+    The bulk save of MessageBatchBuilder stores the same rows as MessageBuilder.save.
+    """
+    def setUp(self):
+        self.original_download_task = tasks.download_email_attachments
+        self.download_task = tasks.download_email_attachments = FakeTask()
+
+        user = LilyUserFactory()
+        self.account = EmailAccount.objects.create(
+            tenant=user.tenant,
+            owner=user,
+            email_address='user@example.com',
+            is_authorized=True,
+        )
+        self.labels = [
+            EmailLabel.objects.create(account=self.account, label_id='INBOX', name='Inbox'),
+            EmailLabel.objects.create(account=self.account, label_id='Label_1', name='Work'),
+        ]
+
+    def tearDown(self):
+        tasks.download_email_attachments = self.original_download_task
+
+    def save(self, manager, bulk, message_info):
+        builder = MessageBuilder(manager)
+        builder.store_message_info(message_info, message_info['id'])
+        if bulk:
+            batch = MessageBatchBuilder(manager)
+            batch.add(builder)
+            batch.save()
+        else:
+            builder.save()
+            builder.cleanup()
+
+    def get_rows(self, message_id):
+        """
+        Return what is stored for a message, without the pks of the rows.
+        """
+        message = EmailMessage.objects.get(account=self.account, message_id=message_id)
+        return {
+            'subject': message.subject,
+            'read': message.read,
+            'has_attachment': message.has_attachment,
+            'sender': message.sender.email_address,
+            'body_text': message.body_text,
+            'labels': sorted(message.labels.values_list('label_id', flat=True)),
+            'received_by': sorted(message.received_by.values_list('email_address', flat=True)),
+            'received_by_cc': sorted(message.received_by_cc.values_list('email_address', flat=True)),
+            'headers': sorted(message.headers.values_list('name', 'value')),
+            'attachments': sorted(message.attachments.values_list('file_name', 'remote_id', 'size')),
+        }
+
+    def get_unread_deltas(self, manager):
+        return {label_pk: delta for label_pk, delta in manager.unread_deltas.items() if delta}
+
+    def test_new_messages(self):
+        manager = FakeGmailManager(self.account, self.labels)
+        bulk_manager = FakeGmailManager(self.account, self.labels)
+
+        self.save(manager, False, get_message_info('m1', ['INBOX', 'Label_1', 'UNREAD']))
+        self.save(bulk_manager, True, get_message_info('m2', ['INBOX', 'Label_1', 'UNREAD']))
+
+        rows = self.get_rows('m1')
+        self.assertEqual(self.get_rows('m2'), rows)
+        self.assertEqual(rows['labels'], ['INBOX', 'Label_1'])
+        self.assertEqual(rows['received_by'], ['to@example.com'])
+        self.assertEqual(rows['received_by_cc'], ['cc@example.com'])
+        self.assertEqual(rows['headers'], [('Thread-Topic', 'Subject')])
+        self.assertEqual(rows['attachments'], [('remote-1.pdf', 'remote-1', 10)])
+        self.assertTrue(rows['has_attachment'])
+        self.assertFalse(rows['read'])
+        self.assertEqual(self.get_unread_deltas(bulk_manager), self.get_unread_deltas(manager))
+        # Both messages have an attachment to download.
+        self.assertEqual(len(self.download_task.calls), 2)
+
+    def test_existing_messages(self):
+        manager = FakeGmailManager(self.account, self.labels)
+        bulk_manager = FakeGmailManager(self.account, self.labels)
+        for message_id in ('m1', 'm2'):
+            self.save(manager, False, get_message_info(message_id, ['INBOX', 'Label_1', 'UNREAD']))
+
+        # Parsing doesn't write anything, the labels are replaced on save.
+        builder = MessageBuilder(bulk_manager)
+        builder.store_message_info(get_message_info('m2', ['INBOX']), 'm2')
+        self.assertEqual(self.get_rows('m2')['labels'], ['INBOX', 'Label_1'])
+        self.assertEqual(self.get_unread_deltas(bulk_manager), {})
+
+        changed = {'to': 'Other <other@example.com>', 'subject': 'Changed', 'attachment_id': 'remote-2'}
+        self.save(manager, False, get_message_info('m1', ['INBOX'], **changed))
+        self.save(bulk_manager, True, get_message_info('m2', ['INBOX'], **changed))
+
+        rows = self.get_rows('m1')
+        self.assertEqual(self.get_rows('m2'), rows)
+        self.assertEqual(rows['subject'], 'Changed')
+        self.assertEqual(rows['labels'], ['INBOX'])
+        self.assertEqual(rows['received_by'], ['other@example.com'])
+        self.assertEqual(rows['headers'], [('Thread-Topic', 'Changed')])
+        self.assertEqual(rows['attachments'], [('remote-2.pdf', 'remote-2', 10)])
+        self.assertTrue(rows['read'])
+        # The message was unread for both labels and is read now.
+        self.assertEqual(self.get_unread_deltas(bulk_manager), {label.pk: -1 for label in self.labels})
+
+    def test_existing_messages_are_updated_without_post_save(self):
+        manager = FakeGmailManager(self.account, self.labels)
+        self.save(manager, False, get_message_info('m1', ['INBOX']))
+
+        saved = []
+
+        def receiver(sender, instance, **kwargs):
+            saved.append(instance.pk)
+
+        post_save.connect(receiver, sender=EmailMessage)
+        try:
+            self.save(manager, True, get_message_info('m1', ['INBOX'], subject='Changed'))
+        finally:
+            post_save.disconnect(receiver, sender=EmailMessage)
+
+        # The batch indexes the message itself, once its relations are saved.
+        self.assertEqual(saved, [])
+        self.assertEqual(self.get_rows('m1')['subject'], 'Changed')
+
+    def test_no_email_messages(self):
+        manager = FakeGmailManager(self.account, self.labels)
+
+        self.save(manager, False, get_message_info('m1', ['INBOX'], sender=None))
+        self.save(manager, True, get_message_info('m2', ['INBOX'], sender=None))
+        self.save(manager, True, get_message_info('m2', ['INBOX'], sender=None))
+
+        self.assertFalse(EmailMessage.objects.filter(account=self.account).exists())
+        self.assertEqual(sorted(NoEmailMessageId.objects.filter(account=self.account).values_list(
+            'message_id',
+            flat=True,
+        )), ['m1', 'm2'])
+
+
+class FakeSyncPipeline(SyncPipeline):
+    """
+    SyncPipeline of which the stages only pass message ids on, and the save stage records them.
+    """
+    def __init__(self, fail_on=None, **kwargs):
+        manager = type('FakeManager', (object,), {})()
+        manager.email_account = type('FakeEmailAccount', (object,), {'id': 1, 'email_address': 'a@example.com'})()
+        super(FakeSyncPipeline, self).__init__(manager, **kwargs)
+        self.fail_on = fail_on
+        self.saved = []
+        self.save_allowed = threading.Event()
+        self.save_allowed.set()
+
+    def _fetch(self, context, message_ids):
+        if self.fail_on in message_ids:
+            raise ValueError('Fetching %s failed' % self.fail_on)
+        for message_id in message_ids:
+            self.parse_queue.put(message_id)
+
+    def _parse(self, context, message_id):
+        self.save_queue.put(message_id)
+
+    def _save(self, context, message_id):
+        self.save_allowed.wait()
+        self.saved.append(message_id)
+
+    def _flush(self, context):
+        pass
+
+
+class SyncPipelineTestCase(TestCase):
+
+    def run_pipeline(self, pipeline, batch_count):
+        """
+        Run the pipeline in a thread with a batch of one message id per batch.
+
+        Returns:
+            tuple with the thread, the list of batches taken from the producer so far and the list of raised errors
+        """
+        produced = []
+        errors = []
+
+        def batches():
+            for n in range(batch_count):
+                produced.append(n)
+                yield ['message-%s' % n]
+
+        def run():
+            try:
+                pipeline.run(batches())
+            except Exception as e:
+                errors.append(e)
+
+        runner = threading.Thread(target=run)
+        runner.daemon = True
+        runner.start()
+        return runner, produced, errors
+
+    def test_messages_are_saved_in_order(self):
+        pipeline = FakeSyncPipeline(fetch_workers=1, parse_workers=1, save_workers=1, queue_size=2)
+
+        runner, produced, errors = self.run_pipeline(pipeline, 20)
+        runner.join(5)
+
+        self.assertFalse(runner.is_alive())
+        self.assertEqual(errors, [])
+        self.assertEqual(pipeline.saved, ['message-%s' % n for n in range(20)])
+        self.assertEqual(pipeline.stats['fetch'][0], 20)
+        self.assertEqual(pipeline.stats['save'][0], 20)
+
+    def test_producer_waits_for_slow_stages(self):
+        pipeline = FakeSyncPipeline(fetch_workers=1, parse_workers=1, save_workers=1, queue_size=1)
+        pipeline.save_allowed.clear()
+
+        runner, produced, errors = self.run_pipeline(pipeline, 100)
+        time.sleep(0.2)
+
+        # Saving is blocked, so the producer stops when every stage and queue holds a message.
+        self.assertLessEqual(len(produced), 7)
+        self.assertEqual(pipeline.saved, [])
+
+        pipeline.save_allowed.set()
+        runner.join(5)
+
+        self.assertFalse(runner.is_alive())
+        self.assertEqual(len(pipeline.saved), 100)
+
+    def test_failing_stage_aborts_and_drains(self):
+        pipeline = FakeSyncPipeline(fail_on='message-5', fetch_workers=1, parse_workers=1, save_workers=1,
+                                    queue_size=1)
+
+        runner, produced, errors = self.run_pipeline(pipeline, 100)
+        runner.join(5)
+
+        # The error is raised once the stages are shut down, without blocking on the queues.
+        self.assertFalse(runner.is_alive())
+        self.assertEqual(len(errors), 1)
+        self.assertIsInstance(errors[0], ValueError)
+        self.assertTrue(pipeline.aborted.is_set())
+        self.assertLess(len(produced), 100)
+        # Messages before the failure may have been saved, nothing is saved after it.
+        self.assertEqual(pipeline.saved, ['message-%s' % n for n in range(len(pipeline.saved))])
+        self.assertLessEqual(len(pipeline.saved), 5)
+
+
+class FakeRedisHashes(object):
+    """
+    Redis connection with only the hash commands SyncCadence uses.
+    """
+    def __init__(self):
+        self.hashes = {}
+
+    def hget(self, name, key):
+        return self.hashes.get(name, {}).get(str(key))
+
+    def hset(self, name, key, value):
+        # Like redis-py, store floats with repr to keep their precision.
+        self.hashes.setdefault(name, {})[str(key)] = repr(value) if isinstance(value, float) else str(value)
+
+    def hmget(self, name, keys):
+        return [self.hget(name, key) for key in keys]
+
+    def hmset(self, name, mapping):
+        for key, value in mapping.items():
+            self.hset(name, key, value)
+
+    def pipeline(self, transaction=True):
+        return FakeHashesPipeline(self)
+
+
+class FakeHashesPipeline(object):
+    def __init__(self, connection):
+        self.connection = connection
+        self.commands = []
+
+    def __getattr__(self, name):
+        return lambda *args: self.commands.append((name, args))
+
+    def execute(self):
+        return [getattr(self.connection, name)(*args) for name, args in self.commands]
+
+
+@override_settings(GMAIL_SYNC_CADENCE_ENABLED=True, GMAIL_PUSH_ENABLED=False, GMAIL_SYNC_MIN_INTERVAL=60,
+                   GMAIL_SYNC_MAX_INTERVAL=300, GMAIL_SYNC_BACKOFF_FACTOR=2, GMAIL_SYNC_JITTER=0)
+class SyncCadenceTestCase(SimpleTestCase):
+
+    def setUp(self):
+        self.connection = FakeRedisHashes()
+        self.cadence = SyncCadence(connection=self.connection)
+
+    def get_interval(self, account_id):
+        return float(self.connection.hget(SyncCadence.INTERVAL_KEY, account_id))
+
+    def get_next_sync(self, account_id):
+        return float(self.connection.hget(SyncCadence.NEXT_SYNC_KEY, account_id))
+
+    def test_interval_backs_off_up_to_max(self):
+        self.cadence.record_sync(1, pages=0)
+        self.assertEqual(self.get_interval(1), 60)
+
+        intervals = []
+        for i in range(4):
+            self.cadence.record_sync(1, pages=0)
+            intervals.append(self.get_interval(1))
+
+        self.assertEqual(intervals, [120, 240, 300, 300])
+        self.assertAlmostEqual(self.get_next_sync(1), time.time() + 300, delta=5)
+
+    def test_changes_reset_interval(self):
+        self.cadence.record_sync(1, pages=0)
+        self.cadence.record_sync(1, pages=0)
+
+        self.cadence.record_sync(1, pages=3)
+
+        self.assertEqual(self.get_interval(1), 60)
+
+    def test_due_accounts(self):
+        now = time.time()
+        self.connection.hset(SyncCadence.NEXT_SYNC_KEY, 1, now - 10)
+        # Due before the next run of the scheduler.
+        self.connection.hset(SyncCadence.NEXT_SYNC_KEY, 2, now + 20)
+        self.connection.hset(SyncCadence.NEXT_SYNC_KEY, 3, now + 200)
+
+        # Accounts that were never synced are due.
+        self.assertEqual(self.cadence.get_due([1, 2, 3, 4], now=now), [1, 2, 4])
+
+    def test_boost_brings_next_sync_forward(self):
+        now = time.time()
+        self.connection.hset(SyncCadence.INTERVAL_KEY, 1, 300)
+        self.connection.hset(SyncCadence.NEXT_SYNC_KEY, 1, now + 300)
+        self.connection.hset(SyncCadence.NEXT_SYNC_KEY, 2, now + 30)
+
+        self.cadence.boost([1, 2])
+
+        self.assertEqual(self.get_interval(1), 60)
+        self.assertLessEqual(self.get_next_sync(1), time.time())
+        # A sync that is due soon isn't moved.
+        self.assertAlmostEqual(self.get_next_sync(2), now + 30)
+        self.assertEqual(self.cadence.get_due([1, 2]), [1, 2])
+
+    def test_disabled(self):
+        with override_settings(GMAIL_SYNC_CADENCE_ENABLED=False):
+            self.cadence.record_sync(1, pages=0)
+            self.assertEqual(self.cadence.get_due([1, 2]), [1, 2])
+        self.assertEqual(self.connection.hashes, {})
+
+
+class CoalesceLabelChangesTestCase(TestCase):
+
+    def test_last_change_of_a_label_wins(self):
+        history = [
+            {'labelsAdded': [{'message': {'id': 'm1'}, 'labelIds': ['UNREAD', 'Label_1']}]},
+            {'labelsRemoved': [{'message': {'id': 'm1'}, 'labelIds': ['UNREAD']}]},
+            {'labelsRemoved': [{'message': {'id': 'm2'}, 'labelIds': ['INBOX']}]},
+        ]
+
+        self.assertEqual(GmailManager.coalesce_label_changes(history), {
+            'm1': {'UNREAD': False, 'Label_1': True},
+            'm2': {'INBOX': False},
+        })
+
+
+class UnreadDeltasTestCase(TestCase):
+
+    def test_read_messages_do_not_count(self):
+        self.assertEqual(get_unread_deltas(True, [1, 2], True, [2, 3]), {})
+
+    def test_label_and_read_changes(self):
+        self.assertEqual(get_unread_deltas(False, [1, 2], False, [2, 3]), {1: -1, 3: 1})
+        self.assertEqual(get_unread_deltas(True, [1], False, [1, 2]), {1: 1, 2: 1})
+        self.assertEqual(get_unread_deltas(False, [1], True, []), {1: -1})
+
+
+class MemoryBudgetTestCase(TestCase):
+
+    def test_only_collects_on_interval_when_over_budget(self):
+        budget = MemoryBudget(rss_threshold=1024, object_threshold=1, check_interval=2)
+
+        self.assertFalse(budget.check())
+        budget.baseline_objects -= 10
+        self.assertTrue(budget.check())
+        self.assertEqual(budget.stats()['collections'], 1)
+
+
+class FakeClock(object):
+    """
+    Replaces the time module, sleeping only moves the clock forward.
+    """
+    def __init__(self, now=1000.0):
+        self.now = now
+        self.sleeps = []
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+class TestRateGovernor(RateGovernor):
+    PREFIX = 'TEST_GMAIL_RATE_'
+    WAIT_TIME_KEY = 'TEST_GMAIL_THROTTLE_WAIT'
+
+
+@override_settings(GMAIL_RATE_GOVERNOR_ENABLED=True, GMAIL_RATE_ACCOUNT_UNITS=10, GMAIL_RATE_PROJECT_UNITS=100,
+                   GMAIL_RATE_DEFAULT_COST=5, GMAIL_RATE_BACKOFF_FACTOR=0.5, GMAIL_RATE_MIN_FACTOR=0.1,
+                   GMAIL_RATE_RECOVERY=0.01)
+class RateGovernorTestCase(SimpleTestCase):
+    """
+    The token buckets are lua scripts, so these tests need a redis server.
+    """
+
+    def setUp(self):
+        self.connection = get_redis_connection()
+        try:
+            self.connection.ping()
+        except RedisError:
+            self.skipTest('Redis is not available')
+        self.cleanup()
+
+        self.original_time = ratelimit.time
+        self.clock = ratelimit.time = FakeClock()
+        self.governor = TestRateGovernor(1, connection=self.connection)
+
+    def tearDown(self):
+        ratelimit.time = self.original_time
+        self.cleanup()
+
+    def cleanup(self):
+        keys = self.connection.keys('TEST_GMAIL_*')
+        if keys:
+            self.connection.delete(*keys)
+
+    def get_tokens(self, governor=None):
+        return float(self.connection.hget((governor or self.governor).keys[RateGovernor.ACCOUNT], 'tokens'))
+
+    def test_bucket_refill(self):
+        # The burst size is one second of calls, so 2 calls empty the bucket. The next call goes into debt.
+        for i in range(3):
+            self.governor.acquire()
+        self.assertEqual(self.clock.sleeps, [])
+        self.assertEqual(self.get_tokens(), -5)
+
+        self.governor.acquire()
+        self.assertEqual(self.clock.sleeps, [0.5])
+        self.assertEqual(self.governor.stats()['throttled'], 1)
+        self.assertEqual(self.governor.stats()['wait_time'], 0.5)
+        self.assertEqual(float(self.connection.get(TestRateGovernor.WAIT_TIME_KEY)), 0.5)
+
+        # Refilled up to the burst size.
+        self.clock.now += 60
+        self.governor.acquire()
+        self.assertEqual(self.clock.sleeps, [0.5])
+        self.assertEqual(self.get_tokens(), 5)
+
+    def test_calls_over_burst_size_pass(self):
+        self.governor.acquire(cost=30)
+        self.assertEqual(self.clock.sleeps, [])
+        self.assertEqual(self.get_tokens(), -20)
+
+        # The next call waits until the debt is paid off.
+        self.governor.acquire()
+        self.assertEqual(self.clock.sleeps, [2.0])
+
+    def test_project_bucket_is_shared(self):
+        self.governor.acquire(cost=100)
+        TestRateGovernor(2, connection=self.connection).acquire(cost=50)
+        self.assertEqual(self.clock.sleeps, [])
+
+        # The account has tokens left, but the project is in debt.
+        other_governor = TestRateGovernor(3, connection=self.connection)
+        other_governor.acquire()
+        self.assertEqual(self.clock.sleeps, [0.5])
+        self.assertEqual(self.get_tokens(other_governor), 5)
+
+    def test_backoff(self):
+        self.governor.acquire()
+
+        factors = []
+        for i in range(5):
+            self.governor.backoff()
+            factors.append(self.governor.get_rate_factor())
+        self.assertEqual(factors, [0.5, 0.25, 0.125, 0.1, 0.1])
+
+        # The project rate is lowered separately.
+        self.governor.backoff(project=True)
+        self.assertEqual(float(self.connection.hget(self.governor.keys[RateGovernor.PROJECT], 'rate')), 50)
+        self.assertEqual(self.governor.get_rate_factor(), 0.1)
+
+    def test_lowered_rate_paces_calls_and_recovers(self):
+        self.governor.acquire()
+        self.governor.backoff()
+
+        self.clock.now += 10
+        self.governor.acquire()
+        self.assertEqual(self.governor.get_rate_factor(), 0.6)
+        self.assertEqual(self.get_tokens(), 1)
+
+        # Tokens are refilled at the lowered rate, so a debt of 4 tokens takes 4/6 of a second.
+        self.governor.acquire()
+        self.governor.acquire()
+        self.assertEqual(len(self.clock.sleeps), 1)
+        self.assertAlmostEqual(self.clock.sleeps[0], 4 / 6.0)
+
+        self.clock.now += 100
+        self.governor.acquire()
+        self.assertEqual(self.governor.get_rate_factor(), 1)
+
+    def test_batch_size(self):
+        self.assertEqual(self.governor.get_rate_factor(), 1)
+        self.assertEqual(self.governor.batch_size(100), 100)
+
+        self.governor.backoff()
+        self.assertEqual(self.governor.batch_size(100), 50)
+
+        for i in range(4):
+            self.governor.backoff()
+        self.assertEqual(self.governor.batch_size(100), 10)
+        self.assertEqual(self.governor.batch_size(5), 1)
+
+    def test_disabled(self):
+        with override_settings(GMAIL_RATE_GOVERNOR_ENABLED=False):
+            self.governor.acquire(cost=1000)
+            self.governor.acquire(cost=1000)
+            self.governor.backoff()
+            self.assertEqual(self.governor.get_rate_factor(), 1)
+
+        self.assertEqual(self.clock.sleeps, [])
+        self.assertEqual(self.connection.keys('TEST_GMAIL_*'), [])
+
+
+class FakeRateGovernor(RateGovernor):
+    """
+    Governor with a fixed rate factor, that only records backoffs.
+    """
+    def __init__(self, rate_factor=1.0):
+        self.rate_factor = rate_factor
+        self.backoffs = []
+
+    def acquire(self, cost=None):
+        pass
+
+    def backoff(self, project=False):
+        self.backoffs.append(project)
+
+    def get_rate_factor(self):
+        return self.rate_factor
+
+
+class FakeGmailConnector(GmailConnector):
+    def __init__(self, governor):
+        self.governor = governor
+
+
+class FakeServiceCall(object):
+    """
+    Service call that raises or returns the given results, one per execute.
+    """
+    def __init__(self, *results):
+        self.results = list(results)
+
+    def execute(self):
+        result = self.results.pop(0)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+
+def get_http_error(status, reason=None):
+    error = {'code': status, 'message': 'Error'}
+    if reason:
+        error['errors'] = [{'domain': 'usageLimits', 'reason': reason}]
+    return HttpError(httplib2.Response({'status': status}), anyjson.dumps({'error': error}))
+
+
+class GmailConnectorTestCase(SimpleTestCase):
+
+    def setUp(self):
+        self.original_time = connector.time
+        self.clock = connector.time = FakeClock()
+        self.governor = FakeRateGovernor()
+        self.connector = FakeGmailConnector(self.governor)
+
+    def tearDown(self):
+        connector.time = self.original_time
+
+    def test_backoff_on_rate_limit_errors(self):
+        service_call = FakeServiceCall(
+            get_http_error(403, 'userRateLimitExceeded'),
+            get_http_error(403, 'rateLimitExceeded'),
+            get_http_error(429, 'rateLimitExceeded'),
+            get_http_error(500),
+            {'id': 'message-1'},
+        )
+
+        self.assertEqual(self.connector.execute_service_call(service_call), {'id': 'message-1'})
+        # Only rate limit errors lower the rate, of the project when its limit is exceeded.
+        self.assertEqual(self.governor.backoffs, [False, True, False])
+        self.assertEqual(len(self.clock.sleeps), 4)
+        for n, sleep in enumerate(self.clock.sleeps):
+            self.assertGreaterEqual(sleep, 2 ** n)
+
+    def test_gives_up_after_retries(self):
+        service_call = FakeServiceCall(*[get_http_error(429, 'rateLimitExceeded')] * 6)
+
+        self.assertRaises(FailedServiceCallException, self.connector.execute_service_call, service_call)
+        self.assertEqual(self.governor.backoffs, [False] * 6)
+
+    def test_other_errors_are_raised(self):
+        service_call = FakeServiceCall(get_http_error(404))
+
+        self.assertRaises(HttpError, self.connector.execute_service_call, service_call)
+        self.assertEqual(self.governor.backoffs, [])
+        self.assertEqual(self.clock.sleeps, [])
+
+    @override_settings(GMAIL_BATCH_REQUEST_SIZE=10)
+    def test_batch_chunks_scale_with_rate(self):
+        message_ids = range(25)
+
+        self.assertEqual([len(chunk) for chunk in self.connector._batch_chunks(message_ids)], [10, 10, 5])
+
+        self.governor.rate_factor = 0.5
+        self.assertEqual([len(chunk) for chunk in self.connector._batch_chunks(message_ids)], [5] * 5)
+
+        self.governor.rate_factor = 0.01
+        chunks = list(self.connector._batch_chunks(message_ids))
+        self.assertEqual(len(chunks), 25)
+        self.assertEqual(sum(chunks, []), message_ids)
+
+
+class EmailTaskRouterTestCase(TestCase):
+
+    def test_lanes(self):
+        router = EmailTaskRouter()
+        with override_settings(EMAIL_QUEUE_SHARDS=4):
+            first_sync = router.route_for_task('first_synchronize_email_account', args=(1,))['queue']
+            sync = router.route_for_task('synchronize_email_account', args=(1,), kwargs={'pages': 2})['queue']
+            action = router.route_for_task('toggle_read_email_message', args=(1, True))['queue']
+            self.assertEqual(first_sync[:-2], 'email_first_sync')
+            self.assertEqual(sync[:-2], 'email_sync')
+            self.assertEqual(action[:-2], 'email_actions')
+            # All syncs of an account go to the same shard.
+            self.assertEqual(first_sync[-1], sync[-1])
+            self.assertIsNone(router.route_for_task('synchronize_email_account_scheduler'))
+
+    def test_disabled(self):
+        with override_settings(EMAIL_QUEUE_SHARDS=0):
+            self.assertIsNone(EmailTaskRouter().route_for_task('synchronize_email_account', args=(1,)))
+
+    def test_workers_divide_shards(self):
+        with override_settings(EMAIL_QUEUE_SHARDS=3):
+            self.assertEqual(get_worker_queue_names('email_sync'), ['email_sync_0', 'email_sync_1', 'email_sync_2'])
+            self.assertEqual(get_worker_queue_names('email_sync', 0, 2), ['email_sync_0', 'email_sync_2'])
+            self.assertEqual(get_worker_queue_names('email_sync', 1, 2), ['email_sync_1'])
+
+
+class ContentDispositionTestCase(TestCase):
+
+    def test_ascii_name_is_quoted(self):
+        self.assertEqual(get_content_disposition('attachment', 'report.pdf'), 'attachment; filename="report.pdf"')
+
+    def test_special_characters_are_removed(self):
+        value = get_content_disposition('inline', 'a;b "c"\r\n.pdf')
+
+        self.assertEqual(value.split('; filename*=')[0], 'inline; filename="a;b _c_.pdf"')
+        self.assertNotIn('\n', value)
+
+    def test_non_ascii_name(self):
+        value = get_content_disposition('attachment', u'r\xe9sum\xe9.pdf')
+
+        self.assertEqual(value, "attachment; filename=\"resume.pdf\"; filename*=UTF-8''r%C3%A9sum%C3%A9.pdf")
+
+
+class FakeTask(object):
+    """
+    Celery task that only records how it's called.
+    """
+    def __init__(self):
+        self.calls = []
+
+    def delay(self, *args):
+        self.calls.append(args)
+
+    def apply_async(self, args=None, **kwargs):
+        self.calls.append(tuple(args))
+
+
+@override_settings(GMAIL_PUSH_ENABLED=True, GMAIL_PUSH_TOKEN='secret')
+class GmailPushViewTestCase(SimpleTestCase):
+
+    def setUp(self):
+        self.original = views.handle_gmail_push_notification
+        self.handle_task = views.handle_gmail_push_notification = FakeTask()
+
+    def tearDown(self):
+        views.handle_gmail_push_notification = self.original
+
+    def post(self, body, token='secret'):
+        url = '/messaging/email/push/' + ('?token=%s' % token if token is not None else '')
+        request = RequestFactory().post(url, data=body, content_type='application/json')
+        return views.GmailPushView.as_view()(request)
+
+    def test_token_is_required(self):
+        notification = anyjson.dumps({'emailAddress': 'user@example.com', 'historyId': '2'})
+
+        self.assertEqual(self.post(notification, token=None).status_code, 403)
+        self.assertEqual(self.post(notification, token='wrong').status_code, 403)
+        self.assertEqual(self.handle_task.calls, [])
+
+    def test_malformed_notifications(self):
+        for body in ['not json', '[]', '{"emailAddress": "user@example.com"}',
+                     '{"emailAddress": "user@example.com", "historyId": "abc"}',
+                     '{"message": {"data": "not base64"}}', '{"message": "data"}']:
+            self.assertEqual(self.post(body).status_code, 400, body)
+        self.assertEqual(self.handle_task.calls, [])
+
+    def test_plain_notification(self):
+        response = self.post(anyjson.dumps({'emailAddress': 'user@example.com', 'historyId': '2'}))
+
+        self.assertEqual(response.status_code, 204)
+        self.assertEqual(self.handle_task.calls, [('user@example.com', 2)])
+
+    def test_pubsub_notification(self):
+        notification = anyjson.dumps({'emailAddress': 'user@example.com', 'historyId': '3'})
+        response = self.post(anyjson.dumps({
+            'message': {'data': base64.b64encode(notification), 'message_id': '1'},
+            'subscription': 'projects/lily/subscriptions/gmail',
+        }))
+
+        self.assertEqual(response.status_code, 204)
+        self.assertEqual(self.handle_task.calls, [('user@example.com', 3)])
+
+
+class FakeEmailSyncLock(object):
+    """
+    EmailSyncLock of which the locks in locked are taken already.
+    """
+    locked = set()
+
+    @classmethod
+    def acquire_many(cls, keys):
+        return [key for key in keys if key not in cls.locked]
+
+
+class HandleGmailPushNotificationTestCase(DatabaseTestCase):
+
+    def setUp(self):
+        self.originals = tasks.synchronize_email_account, tasks.EmailSyncLock
+        self.sync_task = tasks.synchronize_email_account = FakeTask()
+        tasks.EmailSyncLock = FakeEmailSyncLock
+        FakeEmailSyncLock.locked = set()
+
+    def tearDown(self):
+        tasks.synchronize_email_account, tasks.EmailSyncLock = self.originals
+
+    def create_account(self, history_id, **kwargs):
+        user = LilyUserFactory()
+        return EmailAccount.objects.create(
+            tenant=user.tenant,
+            owner=user,
+            email_address='user@example.com',
+            is_authorized=True,
+            history_id=history_id,
+            **kwargs
+        )
+
+    def test_only_accounts_behind_are_synced(self):
+        behind = self.create_account(history_id=1)
+        self.create_account(history_id=5)
+        self.create_account(history_id=1, is_deleted=True)
+        self.create_account(history_id=1, is_authorized=False)
+
+        tasks.handle_gmail_push_notification(email_address='user@example.com', history_id=5)
+
+        self.assertEqual(self.sync_task.calls, [(behind.pk,)])
+
+    def test_syncing_accounts_are_skipped(self):
+        syncing = self.create_account(history_id=1)
+        idle = self.create_account(history_id=1)
+        FakeEmailSyncLock.locked = set([syncing.pk])
+
+        tasks.handle_gmail_push_notification(email_address='user@example.com', history_id=5)
+
+        self.assertEqual(self.sync_task.calls, [(idle.pk,)])
 
 
 class ConvertHTMLToTextTestCase(TestCase):
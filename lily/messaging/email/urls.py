@@ -1,6 +1,6 @@
 from django.conf.urls import patterns, url
 
-from .views import (SetupEmailAuth, OAuth2Callback, EmailAttachmentProxy, EmailTemplateSetDefaultView,
+from .views import (SetupEmailAuth, OAuth2Callback, GmailPushView, EmailAttachmentProxy, EmailTemplateSetDefaultView,
                     EmailTemplateGetDefaultView, EmailMessageHTMLView, EmailAccountUpdateView, EmailTemplateListView,
                     CreateEmailTemplateView, UpdateEmailTemplateView, ParseEmailTemplateView, EmailMessageSendView,
                     EmailTemplateDeleteView, DetailEmailTemplateView, EmailMessageDraftView, EmailMessageReplyView,
@@ -12,6 +12,7 @@ urlpatterns = patterns(
     '',
     url(r'^setup/$', SetupEmailAuth.as_view(), name='messaging_email_account_setup'),
     url(r'^callback/$', OAuth2Callback.as_view(), name='gmail_callback'),
+    url(r'^push/$', GmailPushView.as_view(), name='gmail_push'),
     url(r'^html/(?P<pk>[\d-]+)/$', EmailMessageHTMLView.as_view(), name='messaging_email_html'),
     url(r'^attachment/(?P<pk>[\d-]+)/$', EmailAttachmentProxy.as_view(), name='email_attachment_proxy_view'),
 
@@ -1,13 +1,12 @@
 import logging
-import os
 import re
 import socket
 import mimetypes
 
 from datetime import datetime, timedelta
 from smtplib import SMTPAuthenticationError
-from urllib import unquote
-from urlparse import urlparse
+import unicodedata
+from urllib import quote, unquote
 
 from bs4 import BeautifulSoup
 from celery import signature
@@ -29,10 +28,9 @@ from django.template.loader import get_template_from_string
 from django.template.loader_tags import BlockNode, ExtendsNode
 from django.utils.translation import ugettext_lazy as _
 
-from redis import Redis
-
 from lily.accounts.models import Account
 from lily.contacts.models import Contact
+from lily.utils.functions import get_redis_connection
 
 from python_imap.errors import IMAPConnectionError
 from python_imap.folder import INBOX
@@ -258,6 +256,34 @@ def get_attachment_filename_from_url(url):
     return unquote(url).split('/')[-1]
 
 
+def get_content_disposition(disposition, file_name):
+    """
+    Return a Content-Disposition header value with a file name, which can be any name an email was sent with.
+
+    The quoted filename parameter gets an ASCII version of the name without control characters, quotes and
+    backslashes. Non-ASCII names are added in full as RFC 5987 filename* parameter as well.
+
+    Args:
+        disposition (string): 'attachment' or 'inline'
+        file_name (string): name of the file
+
+    Returns:
+        string with the header value
+    """
+    if isinstance(file_name, str):
+        file_name = file_name.decode('UTF-8', 'replace')
+    # Remove control characters, like newlines, which aren't allowed in headers.
+    file_name = u''.join(char for char in file_name if unicodedata.category(char)[0] != 'C').strip()
+
+    ascii_name = unicodedata.normalize('NFKD', file_name).encode('ascii', 'ignore')
+    ascii_name = ascii_name.replace('\\', '_').replace('"', '_').strip() or 'attachment'
+
+    value = '%s; filename="%s"' % (disposition, ascii_name)
+    if file_name and ascii_name != file_name:
+        value += "; filename*=UTF-8''%s" % quote(file_name.encode('UTF-8'), safe='')
+    return value
+
+
 def render_email_body(html, mapped_attachments, request):
     """
     Update all the target attributes in the <a> tag.
@@ -355,6 +381,12 @@ def replace_cid_and_change_headers(html, pk):
     if soup and attachments:
         inline_images = soup.findAll('img', {'cid': lambda cid: cid})
 
+    if inline_images and any(not attachment.is_downloaded for attachment in attachments):
+        # Attachments that weren't downloaded by the sync yet are needed now.
+        from .tasks import download_email_attachments
+        download_email_attachments(pk)
+        attachments = EmailAttachment.objects.filter(message_id=pk)
+
     if (not soup or soup.get_text() == '') and not inline_images:
         body_html = html
     else:
@@ -368,7 +400,7 @@ def replace_cid_and_change_headers(html, pk):
                     image['src'] = "cid:%s" % image_cid
 
                     storage_file = default_storage._open(attachment.attachment.name)
-                    filename = get_attachment_filename_from_url(attachment.attachment.name)
+                    filename = attachment.name
 
                     if hasattr(storage_file, 'key'):
                         content_type = storage_file.key.content_type
@@ -835,17 +867,39 @@ class EmailSyncLock(object):
         self.expires = expires
         self.connection = self.get_connection()
 
-    def get_connection(self):
-        redis_path = urlparse(os.environ.get('REDISTOGO_URL', 'redis://localhost:6379'))
-        return Redis(redis_path.hostname, port=redis_path.port, password=redis_path.password)
+    @staticmethod
+    def get_connection():
+        # Connections come from a pool shared by all locks.
+        return get_redis_connection()
 
     def get(self):
         return self.connection.get(self.key)
 
     def acquire(self):
         # If the lock already exists it overrides and extends the expire time
-        self.connection.set(self.key, self.value)
-        self.connection.expire(self.key, self.expires)
+        self.connection.set(self.key, self.value, ex=self.expires)
+
+    @classmethod
+    def acquire_many(cls, keys, value=None, expires=settings.GMAIL_SYNC_LOCK_LIFETIME, prefix=DEFAULT_PREFIX):
+        """
+        Take the locks that aren't set yet, with one pipelined round-trip.
+
+        Every lock is taken atomically with SET NX EX, so a lock that is set
+        by someone else in the meantime is never overridden.
+
+        Args:
+            keys (list): names of the locks
+            value (string, optional): extra information about the locks
+            expires (int, optional): lifetime of the locks in seconds
+            prefix (string, optional): prefix for the keys
+
+        Returns:
+            list with the keys of the locks that were taken
+        """
+        pipe = cls.get_connection().pipeline(transaction=False)
+        for key in keys:
+            pipe.set(prefix + str(key), value, ex=expires, nx=True)
+        return [key for key, acquired in zip(keys, pipe.execute()) if acquired]
 
     def release(self):
         self.connection.delete(self.key)
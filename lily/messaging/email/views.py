@@ -1,3 +1,4 @@
+import base64
 from itertools import chain
 import re
 import anyjson
@@ -13,11 +14,14 @@ from django.contrib.messages.views import SuccessMessageMixin
 from django.core.files.storage import default_storage
 from django.core.servers.basehttp import FileWrapper
 from django.core.urlresolvers import reverse
-from django.http import HttpResponseRedirect, HttpResponseBadRequest, Http404, HttpResponse
+from django.http import HttpResponseRedirect, HttpResponseBadRequest, HttpResponseForbidden, Http404, HttpResponse
 from django.template import Context, Template
 from django.template.defaultfilters import linebreaksbr
+from django.utils.crypto import constant_time_compare
+from django.utils.decorators import method_decorator
 from django.utils.safestring import mark_safe
 from django.utils.translation import ugettext_lazy as _
+from django.views.decorators.csrf import csrf_exempt
 from django.views.generic import UpdateView, DeleteView, CreateView, FormView
 from django.views.generic.base import View
 from django.views.generic.detail import DetailView
@@ -35,10 +39,11 @@ from .forms import (EmailAccountCreateUpdateForm, CreateUpdateEmailTemplateForm,
                     EmailTemplateSetDefaultForm, ComposeEmailForm, CreateUpdateTemplateVariableForm)
 from .models.models import (EmailMessage, EmailAttachment, EmailAccount, EmailTemplate, DefaultEmailTemplate,
                             EmailOutboxMessage, EmailOutboxAttachment, TemplateVariable)
-from .utils import (create_account, get_attachment_filename_from_url, get_email_parameter_choices,
-                    create_recipients, render_email_body, replace_cid_in_html, create_reply_body_header)
+from .utils import (create_account, get_attachment_filename_from_url, get_content_disposition,
+                    get_email_parameter_choices, create_recipients, render_email_body, replace_cid_in_html,
+                    create_reply_body_header)
 from .tasks import (send_message, create_draft_email_message, delete_email_message, archive_email_message,
-                    update_draft_email_message)
+                    update_draft_email_message, download_email_attachments, handle_gmail_push_notification)
 
 
 logger = logging.getLogger(__name__)
@@ -72,6 +77,43 @@ class OAuth2Callback(LoginRequiredMixin, View):
         return HttpResponseRedirect('/#/preferences/emailaccounts/edit/%s' % account.pk)
 
 
+class GmailPushView(View):
+    """
+    Receive push notifications of changed mailboxes from the gmail api.
+
+    Accepts the Cloud Pub/Sub push format, with the notification base64
+    encoded in message.data, or the notification itself:
+
+        {"emailAddress": "user@example.com", "historyId": "9876543210"}
+
+    The token query parameter has to match settings.GMAIL_PUSH_TOKEN.
+    """
+    http_method_names = ['post']
+
+    @method_decorator(csrf_exempt)
+    def dispatch(self, request, *args, **kwargs):
+        return super(GmailPushView, self).dispatch(request, *args, **kwargs)
+
+    def post(self, request):
+        if not settings.GMAIL_PUSH_ENABLED or not settings.GMAIL_PUSH_TOKEN or \
+                not constant_time_compare(request.GET.get('token', ''), settings.GMAIL_PUSH_TOKEN):
+            return HttpResponseForbidden()
+
+        try:
+            notification = anyjson.loads(request.body)
+            if 'message' in notification:
+                notification = anyjson.loads(base64.b64decode(str(notification['message']['data'])))
+            email_address = notification['emailAddress']
+            history_id = int(notification['historyId'])
+        except (ValueError, KeyError, TypeError):
+            logger.warning('Invalid push notification: %s' % request.body)
+            return HttpResponseBadRequest()
+
+        handle_gmail_push_notification.delay(email_address, history_id)
+
+        return HttpResponse(status=204)
+
+
 class EmailAccountUpdateView(LoginRequiredMixin, AjaxFormMixin, SuccessMessageMixin, FormActionMixin, StaticContextMixin, UpdateView):
     template_name = 'ajax_form.html'
     model = EmailAccount
@@ -119,6 +161,13 @@ class EmailAttachmentProxy(View):
         except:
             raise Http404()
 
+        if not attachment.is_downloaded:
+            # Not downloaded by the sync yet, so get it now, without the other attachments of the message.
+            download_email_attachments(attachment.message_id, attachment_ids=[attachment.pk])
+            attachment = EmailAttachment.objects.get(pk=attachment.pk)
+            if not attachment.is_downloaded:
+                raise Http404()
+
         s3_file = default_storage._open(attachment.attachment.name)
 
         wrapper = FileWrapper(s3_file)
@@ -133,7 +182,7 @@ class EmailAttachmentProxy(View):
         if attachment.inline:
             inline = 'inline'
 
-        response['Content-Disposition'] = '%s; filename=%s' % (inline, get_attachment_filename_from_url(s3_file.name))
+        response['Content-Disposition'] = get_content_disposition(inline, attachment.name)
         response['Content-Length'] = attachment.size
         return response
 
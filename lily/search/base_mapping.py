@@ -60,3 +60,10 @@ class BaseMapping(MappingType, Indexable):
     @classmethod
     def has_deleted(cls):
         return True
+
+    @classmethod
+    def get_tenant_ids(cls, ids):
+        """
+        Return a dict with the tenant id of every object.
+        """
+        return dict(cls.get_model().objects.filter(pk__in=ids).values_list('pk', 'tenant_id'))
@@ -1,14 +1,25 @@
+from collections import defaultdict
 from datetime import date
 import itertools
 import logging
+import multiprocessing
+import threading
+import time
 import traceback
+import uuid
 
 from django.conf import settings
-from elasticsearch.exceptions import NotFoundError
+from django.core.cache import cache
+from django.db import connection, connections
+from django.db.models import Max, Min
 from elasticutils.contrib.django import tasks
+from redis.exceptions import RedisError, ResponseError
 
+from lily.search import result_cache
 from lily.search.connections_utils import get_es_client
 from lily.utils import logutil
+from lily.utils.functions import get_redis_connection
+from lily.utils.querysets import QuerysetIterator, estimate_count
 
 
 logger = logging.getLogger('search')
@@ -16,12 +27,29 @@ NEW_INDEX = settings.ES_INDEXES['new_index']
 DEFAULT_INDEX = settings.ES_INDEXES['default']
 es = get_es_client(maxsize=1)
 
+# Redis hash with objects to index, see enqueue.
+INDEX_QUEUE_KEY = 'SEARCH_INDEX_QUEUE'
+INDEX_UPDATE = 'update'
+INDEX_REMOVE = 'remove'
+# Sorted set with the queues that are being processed by the time processing started, see process_index_queue.
+INDEX_QUEUE_PROCESSING_KEY = 'SEARCH_INDEX_QUEUE_PROCESSING'
+# Seconds after which a queue that is still being processed is assumed to be abandoned by a crashed worker.
+INDEX_QUEUE_ABANDONED_AFTER = 3600
+_queue_connection = None
+
+# Index queue entries of objects saved in a transaction, kept per thread until the transaction is done, see enqueue.
+_deferred = threading.local()
+
+# Cache key of the aliases of the indexes writes go to, see get_aliases.
+ALIASES_CACHE_KEY = 'SEARCH_ALIASES'
+
 
 def update_in_index(instance, mapping):
     """
     Utility function for signal listeners index to Elasticsearch.
-    Currently uses synchronous tasks. And because of that all exceptions are
-    caught, so failures will not interfere with the regular model updates.
+    With the index queue enabled the instance is only queued, otherwise it is
+    indexed synchronously. And because of that all exceptions are caught, so
+    failures will not interfere with the regular model updates.
     """
     if settings.ES_DISABLED:
         return
@@ -29,71 +57,629 @@ def update_in_index(instance, mapping):
         remove_from_index(instance, mapping)
     else:
         logger.info(u'Updating instance %s: %s' % (instance.__class__.__name__, instance.pk))
-        # Extract all aliases available.
-        aliases = list(itertools.chain(*[v['aliases'].keys() for v in es.indices.get_aliases().itervalues() if 'aliases' in v]))
+        update_ids_in_index(mapping, [instance.id], tenant_ids=get_instance_tenant_ids(instance))
 
-        for index in [DEFAULT_INDEX, NEW_INDEX]:
-            try:
-                if index in aliases:
-                    tasks.index_objects(mapping, [instance.id], es=es, index=index)
-                    es.indices.refresh(index)
-            except Exception, e:
-                logger.error(traceback.format_exc(e))
+
+def update_ids_in_index(mapping, ids, tenant_ids=None):
+    """
+    Utility function to index multiple objects of one mapping to Elasticsearch.
+    Used where objects are saved without sending post_save signals, like with
+    bulk_create. All exceptions are caught, just like in update_in_index.
+    """
+    if settings.ES_DISABLED or not ids:
+        return
+    tenant_ids = get_tenant_ids(mapping, ids, tenant_ids)
+    if settings.ES_INDEX_QUEUE_ENABLED and enqueue(mapping, ids, INDEX_UPDATE, tenant_ids=tenant_ids):
+        return
+
+    index_ids(mapping, ids, get_aliases())
+    result_cache.invalidate_tenants(tenant_ids.values())
 
 
 def remove_from_index(instance, mapping):
     """
     Utility function for signal listeners to remove from Elasticsearch.
-    Currently uses synchronous tasks. And because of that all exceptions are
-    caught, so failures will not interfere with the regular model updates.
+    With the index queue enabled the instance is only queued, otherwise it is
+    removed synchronously. And because of that all exceptions are caught, so
+    failures will not interfere with the regular model updates.
     """
     if settings.ES_DISABLED:
         return
     logger.info(u'Removing instance %s: %s' % (instance.__class__.__name__, instance.pk))
-    # Extract all aliases available.
-    aliases = list(itertools.chain(*[v['aliases'].keys() for v in es.indices.get_aliases().itervalues() if 'aliases' in v]))
+    remove_ids_from_index(mapping, [instance.id], tenant_ids=get_instance_tenant_ids(instance))
+
+
+def remove_ids_from_index(mapping, ids, tenant_ids=None):
+    """
+    Utility function to remove multiple objects of one mapping from
+    Elasticsearch. All exceptions are caught, just like in remove_from_index.
+    """
+    if settings.ES_DISABLED or not ids:
+        return
+    tenant_ids = get_tenant_ids(mapping, ids, tenant_ids)
+    if settings.ES_INDEX_QUEUE_ENABLED and enqueue(mapping, ids, INDEX_REMOVE, tenant_ids=tenant_ids):
+        return
+
+    unindex_ids(mapping, ids, get_aliases())
+    result_cache.invalidate_tenants(tenant_ids.values())
+
+
+def get_instance_tenant_ids(instance):
+    """
+    Return the tenant id of an instance for get_tenant_ids, if it is needed.
+    """
+    if not settings.ES_SEARCH_CACHE_ENABLED:
+        return {}
+    return {instance.id: instance.tenant_id}
+
+
+def get_tenant_ids(mapping, ids, tenant_ids=None):
+    """
+    Return the tenant ids of objects, to invalidate their cached search
+    results after indexing them. Only looked up when the search cache is
+    enabled.
+
+    Returns:
+        dict with the tenant id per object id
+    """
+    if not settings.ES_SEARCH_CACHE_ENABLED:
+        return {}
+    if tenant_ids is None:
+        try:
+            tenant_ids = mapping.get_tenant_ids(ids)
+        except Exception, e:
+            logger.error(traceback.format_exc(e))
+            tenant_ids = {}
+    return tenant_ids
+
+
+def index_related(mapping, instances):
+    """
+    Index the related objects of a saved object.
+
+    Saving one object can change the documents of many related objects. They
+    are deduplicated and put in the index queue, which indexes them in bulk in
+    the background once the transaction is done. Without the queue large
+    numbers of objects are indexed by a task, so they don't hold up the
+    request, unless the task could run before the transaction is committed.
+
+    Args:
+        mapping (class): mapping type of the objects
+        instances (list): the related objects
+    """
+    if settings.ES_DISABLED or not instances:
+        return
+
+    actions = {}
+    tenant_ids = {}
+    for instance in instances:
+        actions[instance.pk] = INDEX_REMOVE if getattr(instance, 'is_deleted', False) else INDEX_UPDATE
+        tenant_ids.update(get_instance_tenant_ids(instance))
+
+    # Imported here, because the tasks import this module.
+    from lily.search.tasks import index_related_objects
+
+    for action in (INDEX_UPDATE, INDEX_REMOVE):
+        ids = [obj_id for obj_id, obj_action in actions.iteritems() if obj_action == action]
+        if not ids:
+            continue
+        if settings.ES_INDEX_QUEUE_ENABLED and enqueue(mapping, ids, action, tenant_ids=tenant_ids):
+            continue
+
+        if len(ids) > settings.ES_RELATED_INDEX_TASK_THRESHOLD and not connection.in_atomic_block:
+            logger.info(u'Indexing %s related %s objects in the background' % (
+                len(ids),
+                mapping.get_mapping_type_name(),
+            ))
+            index_related_objects.delay(mapping.get_mapping_type_name(), ids, action)
+        elif action == INDEX_REMOVE:
+            remove_ids_from_index(mapping, ids, tenant_ids=tenant_ids)
+        else:
+            update_ids_in_index(mapping, ids, tenant_ids=tenant_ids)
+
+
+def get_aliases():
+    """
+    Return the names of the aliases in use of the indexes we write to.
+
+    The aliases are cached for settings.ES_ALIAS_CACHE_TTL seconds, so writes
+    don't need a cluster metadata call. The index command invalidates the
+    cache when it changes the aliases.
+    """
+    aliases = cache.get(ALIASES_CACHE_KEY)
+    if aliases is None:
+        aliases = get_aliases_from_es()
+        cache.set(ALIASES_CACHE_KEY, aliases, settings.ES_ALIAS_CACHE_TTL)
+    return aliases
+
+
+def get_aliases_from_es():
+    """
+    Return the names of the aliases in use of the indexes we write to, as
+    known by Elasticsearch.
+    """
+    result = es.indices.get_aliases(name=','.join([DEFAULT_INDEX, NEW_INDEX]))
+    aliases = itertools.chain(*[v['aliases'].keys() for v in result.itervalues() if 'aliases' in v])
+    return [alias for alias in aliases if alias in (DEFAULT_INDEX, NEW_INDEX)]
+
+
+def invalidate_aliases():
+    """
+    Drop the cached aliases, call this after changing aliases.
+    """
+    cache.delete(ALIASES_CACHE_KEY)
+
+
+class IndexingError(Exception):
+    pass
+
+
+def index_ids(mapping, ids, aliases, refresh=True, raise_errors=False):
+    """
+    Index objects of one mapping in every index that is in use. All exceptions are caught and logged, unless
+    raise_errors is set.
+
+    Returns:
+        list with the indexes that were updated
+    """
+    indexes = []
     for index in [DEFAULT_INDEX, NEW_INDEX]:
         try:
             if index in aliases:
-                tasks.unindex_objects(mapping, [instance.id], es=es, index=index)
-                es.indices.refresh(index)
-        except NotFoundError, e:
-            logger.warn('Not found in index instance %s: %s' % (instance.__class__.__name__, instance.pk))
+                tasks.index_objects(mapping, ids, es=es, index=index)
+                indexes.append(index)
+                if refresh:
+                    es.indices.refresh(index)
+        except Exception, e:
+            if raise_errors:
+                raise
+            logger.error(traceback.format_exc(e))
+    return indexes
+
+
+def unindex_ids(mapping, ids, aliases, refresh=True, raise_errors=False):
+    """
+    Remove objects of one mapping from every index that is in use. All exceptions are caught and logged, unless
+    raise_errors is set.
+
+    Returns:
+        list with the indexes that were updated
+    """
+    indexes = []
+    for index in [DEFAULT_INDEX, NEW_INDEX]:
+        if index not in aliases:
+            continue
+        indexes.append(index)
+        try:
+            removed, not_found, failed = bulk_unindex(mapping, ids, index)
+            if failed:
+                raise IndexingError('Failed to remove %s objects from %s' % (failed, index))
         except Exception, e:
+            if raise_errors:
+                raise
             logger.error(traceback.format_exc(e))
+        if refresh:
+            try:
+                es.indices.refresh(index)
+            except Exception, e:
+                logger.error(traceback.format_exc(e))
+    return indexes
+
+
+def get_queue_connection():
+    global _queue_connection
+
+    if _queue_connection is None:
+        _queue_connection = get_redis_connection()
+    return _queue_connection
+
+
+def enqueue(mapping, ids, action, tenant_ids=None):
+    """
+    Queue objects for the background indexer instead of indexing them now.
+
+    The queue is a redis hash with an entry per object, so an object that is
+    changed several times before the queue is processed is indexed once, with
+    the last action. The tenant of the object is stored with the action, to
+    invalidate the cached search results of the tenant afterwards.
+
+    Inside a transaction the entries are kept until it's done, otherwise the
+    indexer could read the objects before they are committed. Django 1.7 has no
+    hooks to run after commit, so they are written by the next enqueue outside
+    a transaction or by flush_index_queue.
+
+    Returns:
+        True if the objects are queued, False if the queue isn't available
+    """
+    name = mapping.get_mapping_type_name()
+    tenant_ids = tenant_ids or {}
+    items = get_deferred()
+    for obj_id in ids:
+        items['%s:%s' % (name, obj_id)] = '%s:%s' % (action, tenant_ids[obj_id]) if obj_id in tenant_ids else action
+
+    if not flush_index_queue():
+        logger.warning('Index queue unavailable, indexing %s synchronously' % name)
+        return False
+    return True
+
+
+def get_deferred():
+    """
+    Return the index queue entries deferred in the current thread.
+    """
+    if not hasattr(_deferred, 'items'):
+        _deferred.items = {}
+    return _deferred.items
+
+
+def flush_index_queue():
+    """
+    Write the index queue entries deferred by enqueue to the queue, unless a
+    transaction is still going on. Called when a request or task is finished
+    and when the process exits.
+
+    Returns:
+        False if the queue isn't available, the entries are dropped then
+    """
+    items = get_deferred()
+    if not items or connection.in_atomic_block:
+        return True
+    _deferred.items = {}
+
+    try:
+        get_queue_connection().hmset(INDEX_QUEUE_KEY, items)
+    except RedisError:
+        logger.exception('Index queue unavailable, not indexing %s objects' % len(items))
+        return False
+    return True
 
 
-def index_objects(mapping, queryset, index, print_progress=False):
+def process_index_queue():
+    """
+    Index all objects in the index queue.
+
+    The queue is renamed first, so objects that are queued in the meantime end
+    up in a new queue. Objects are indexed in bulk per mapping and every index
+    is refreshed once. The objects of batches that fail are put back in the
+    queue unless they were queued again in the meantime.
+
+    The renamed queue is only removed after that, and is registered as being
+    processed, so a queue of a worker that crashed is put back by a later run.
+
+    Returns:
+        int with the number of processed objects
+    """
+    if settings.ES_DISABLED:
+        return 0
+
+    connection = get_queue_connection()
+    requeue_abandoned_queues(connection)
+
+    processing_key = '%s_%s' % (INDEX_QUEUE_KEY, uuid.uuid4().hex)
+    connection.zadd(INDEX_QUEUE_PROCESSING_KEY, **{processing_key: time.time()})
+    try:
+        connection.rename(INDEX_QUEUE_KEY, processing_key)
+    except ResponseError:
+        # Queue is empty.
+        connection.zrem(INDEX_QUEUE_PROCESSING_KEY, processing_key)
+        return 0
+
+    # Imported here, because the mappings import this module.
+    from lily.search.scan_search import ModelMappings
+
+    items = connection.hgetall(processing_key)
+    failed_keys = []
+    try:
+        mappings = {
+            mapping.get_mapping_type_name(): mapping for mapping in ModelMappings.get_model_mappings().values()
+        }
+        ids = defaultdict(list)
+        tenant_ids = set()
+        for key, value in items.iteritems():
+            name, obj_id = key.rsplit(':', 1)
+            action, _, tenant_id = value.partition(':')
+            if name in mappings:
+                ids[(name, action)].append(int(obj_id))
+                if tenant_id:
+                    tenant_ids.add(int(tenant_id))
+            else:
+                logger.warn('Unknown mapping in index queue: %s' % name)
+
+        aliases = get_aliases()
+        indexes = set()
+        batch_size = settings.ES_INDEX_QUEUE_BATCH_SIZE
+        for (name, action), obj_ids in ids.iteritems():
+            for i in range(0, len(obj_ids), batch_size):
+                batch = obj_ids[i:i + batch_size]
+                try:
+                    if action == INDEX_REMOVE:
+                        indexes.update(unindex_ids(mappings[name], batch, aliases, refresh=False, raise_errors=True))
+                    else:
+                        indexes.update(index_ids(mappings[name], batch, aliases, refresh=False, raise_errors=True))
+                except Exception, e:
+                    logger.error(traceback.format_exc(e))
+                    failed_keys.extend('%s:%s' % (name, obj_id) for obj_id in batch)
+
+        for index in indexes:
+            try:
+                es.indices.refresh(index)
+            except Exception, e:
+                # The objects are indexed, they show up after the next scheduled refresh.
+                logger.error(traceback.format_exc(e))
+        result_cache.invalidate_tenants(tenant_ids)
+    except Exception, e:
+        logger.error(traceback.format_exc(e))
+        failed_keys = items.keys()
+
+    requeue(connection, items, failed_keys)
+    # The failed objects are back in the queue, so the processed queue can go.
+    connection.delete(processing_key)
+    connection.zrem(INDEX_QUEUE_PROCESSING_KEY, processing_key)
+
+    return len(items) - len(failed_keys)
+
+
+def requeue(connection, items, keys):
+    """
+    Put objects back in the index queue, unless they were queued again in the meantime.
+
+    Args:
+        connection (instance): Redis instance
+        items (dict): actions by key of the processed queue
+        keys (list): keys of the objects to put back
+    """
+    if not keys:
+        return
+
+    pipe = connection.pipeline(transaction=False)
+    for key in keys:
+        pipe.hsetnx(INDEX_QUEUE_KEY, key, items[key])
+    pipe.execute()
+
+
+def requeue_abandoned_queues(connection):
+    """
+    Put the objects of queues that are processed for longer than INDEX_QUEUE_ABANDONED_AFTER seconds back in the
+    index queue, their worker crashed before it was done.
+
+    Args:
+        connection (instance): Redis instance
+    """
+    abandoned = connection.zrangebyscore(INDEX_QUEUE_PROCESSING_KEY, 0, time.time() - INDEX_QUEUE_ABANDONED_AFTER)
+    for processing_key in abandoned:
+        items = connection.hgetall(processing_key)
+        logger.warning('Putting %s objects of abandoned index queue %s back' % (len(items), processing_key))
+        requeue(connection, items, items.keys())
+        connection.delete(processing_key)
+        connection.zrem(INDEX_QUEUE_PROCESSING_KEY, processing_key)
+
+
+def index_objects(mapping, queryset, index, print_progress=False, chunk_size=None, bulk_size=100, estimate=False):
     """
     Index synchronously model specified mapping type with an optimized query.
+
+    Returns:
+        int with the number of indexed objects
     """
+    count = 0
     documents = []
-    for instance in queryset_iterator(mapping, queryset, print_progress=print_progress):
+    for instance in queryset_iterator(mapping, queryset, chunksize=chunk_size, print_progress=print_progress,
+                                      estimate=estimate):
         documents.append(mapping.extract_document(instance.id, instance))
+        count += 1
 
-        if len(documents) >= 100:
+        if len(documents) >= bulk_size:
             mapping.bulk_index(documents, id_field='id', index=index, es=es)
             documents = []
 
     mapping.bulk_index(documents, id_field='id', index=index, es=es)
-    documents = []
+    return count
+
 
+def get_index_queryset(mapping):
+    """
+    Return the queryset with all objects of a mapping that should be indexed.
+    """
+    model = mapping.get_model()
+    if mapping.has_deleted():
+        return model.objects.filter(is_deleted=False)
+    return model.objects.all()
+
+
+def index_objects_parallel(mapping, index, workers, print_progress=False, chunk_size=None, bulk_size=100,
+                           estimate=False):
+    """
+    Index all objects of a mapping with a pool of processes.
+
+    The pk range of the model is split into shards, which are indexed by the
+    processes with their own database and Elasticsearch connections. The
+    progress of the shards is added up in the main process.
 
-def unindex_objects(mapping, queryset, index, print_progress=False):
+    Args:
+        mapping (class): mapping type to index
+        index (string): name of the index
+        workers (int): number of processes
+        print_progress (boolean, optional): print a progress bar
+        chunk_size (int, optional): number of rows fetched per query
+        bulk_size (int, optional): number of documents per bulk request
+        estimate (boolean, optional): show progress against the estimated number of objects
+    """
+    queryset = get_index_queryset(mapping)
+    end = estimate_count(queryset) if estimate else queryset.count()
+    pk_range = queryset.aggregate(min_pk=Min('pk'), max_pk=Max('pk'))
+    if pk_range['min_pk'] is None:
+        return
+
+    # Use more shards than workers, so a worker with a dense shard doesn't hold up the others.
+    shard_count = workers * 4
+    shard_size = (pk_range['max_pk'] - pk_range['min_pk']) / shard_count + 1
+    shards = [
+        (mapping.get_mapping_type_name(), index, min_pk, min_pk + shard_size, chunk_size, bulk_size)
+        for min_pk in range(pk_range['min_pk'], pk_range['max_pk'] + 1, shard_size)
+    ]
+
+    # Forked processes can't share the connections of this process.
+    for conn in connections.all():
+        conn.close()
+
+    pool = multiprocessing.Pool(workers, initializer=_init_index_worker)
+    try:
+        progress = 0
+        started = time.time()
+        for count in pool.imap_unordered(_index_shard, shards):
+            progress += count
+            if print_progress:
+                logutil.print_progress(progress, max(end, progress), rate=progress / max(time.time() - started, 0.001))
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+
+def _init_index_worker():
+    global es
+
+    es = get_es_client(maxsize=1)
+
+
+def _index_shard(shard):
+    """
+    Index the objects of one mapping in a pk range, in a worker process.
+
+    Returns:
+        int with the number of indexed objects
+    """
+    name, index, min_pk, max_pk, chunk_size, bulk_size = shard
+
+    # Imported here, because the mappings import this module.
+    from lily.search.scan_search import ModelMappings
+
+    for mapping in ModelMappings.get_model_mappings().values():
+        if mapping.get_mapping_type_name() == name:
+            break
+
+    queryset = get_index_queryset(mapping).filter(pk__gte=min_pk, pk__lt=max_pk)
+    return index_objects(mapping, queryset, index, chunk_size=chunk_size, bulk_size=bulk_size)
+
+
+def index_modified_objects(mapping, since, index, print_progress=False, chunk_size=None, bulk_size=100):
+    """
+    Index the objects of a mapping modified since a point in time, and
+    remove the ones that are deleted since.
+
+    Args:
+        mapping (class): mapping type to index, its model needs a modified field
+        since (datetime): only objects modified at or after this are indexed
+        index (string): name of the index
+
+    Returns:
+        tuple with the number of indexed and removed objects
+    """
+    queryset = mapping.get_model().objects.filter(modified__gte=since)
+    removed = 0
+    if mapping.has_deleted():
+        deleted = queryset.filter(is_deleted=True)
+        removed = deleted.count()
+        unindex_objects(mapping, deleted, index)
+        queryset = queryset.filter(is_deleted=False)
+
+    indexed = index_objects(mapping, queryset, index, print_progress=print_progress, chunk_size=chunk_size,
+                            bulk_size=bulk_size)
+    return indexed, removed
+
+
+def unindex_objects(mapping, queryset, index, print_progress=False, bulk_size=500):
     """
     Remove synchronously model specified mapping type with an optimized query.
+
+    Only the pks are fetched, with keyset pagination in chunks of bulk_size,
+    and every chunk is removed with a single bulk request.
     """
-    queryset = queryset.only('pk')
+    queryset = queryset.order_by('pk').values_list('pk', flat=True)
+    total = queryset.count() if print_progress else None
 
-    for instance in queryset_iterator(mapping, queryset, print_progress=print_progress):
-        try:
-            mapping.unindex(instance.pk, index=index, es=es)
-        except NotFoundError:
+    count = 0
+    pk = None
+    while True:
+        subset = queryset if pk is None else queryset.filter(pk__gt=pk)
+        ids = list(subset[:bulk_size])
+        if not ids:
+            break
+
+        bulk_unindex(mapping, ids, index)
+        count += len(ids)
+        if print_progress:
+            logutil.print_progress(count, max(total, count))
+
+        pk = ids[-1]
+        if len(ids) < bulk_size:
+            break
+
+
+def bulk_unindex(mapping, ids, index):
+    """
+    Remove objects of one mapping from an index with a single bulk request.
+
+    Objects that are not in the index are ignored, other failures are logged
+    per object.
+
+    Args:
+        mapping (class): mapping type of the objects
+        ids (list): ids of the objects
+        index (string): name of the index
+
+    Returns:
+        tuple with the number of removed objects, objects not found and failures
+    """
+    if not ids:
+        return 0, 0, 0
+
+    doc_type = mapping.get_mapping_type_name()
+    body = [{'delete': {'_index': index, '_type': doc_type, '_id': obj_id}} for obj_id in ids]
+    response = es.bulk(body=body)
+
+    removed = not_found = failed = 0
+    for item in response['items']:
+        result = item['delete']
+        status = result.get('status', 500)
+        if 200 <= status < 300:
+            removed += 1
+        elif status == 404:
             # Not present in the first place? Just ignore.
-            pass
+            not_found += 1
+        else:
+            failed += 1
+            logger.error('Failed to remove instance %s: %s from %s: %s' % (
+                doc_type,
+                result.get('_id'),
+                index,
+                result.get('error'),
+            ))
+    return removed, not_found, failed
+
+
+def unindex_tenant(tenant_id, index, mappings=None):
+    """
+    Remove all documents of a tenant from an index with delete by query.
+
+    Args:
+        tenant_id (int): id of the tenant
+        index (string): name of the index
+        mappings (list, optional): mapping types to remove, defaults to all
+    """
+    doc_type = ','.join([mapping.get_mapping_type_name() for mapping in mappings]) if mappings else None
+    es.delete_by_query(index=index, doc_type=doc_type, body={
+        'query': {
+            'term': {'tenant': tenant_id},
+        },
+    })
+    es.indices.refresh(index)
+    result_cache.invalidate_tenants([tenant_id])
 
 
-def queryset_iterator(mapping, queryset, chunksize=100, print_progress=False):
+def queryset_iterator(mapping, queryset, chunksize=None, print_progress=False, estimate=False):
     """
     Returns an iterator that chops the queryset into chunks.
 
@@ -101,26 +687,11 @@ def queryset_iterator(mapping, queryset, chunksize=100, print_progress=False):
 
     - Supports prefetching.
     - Much faster because of batching.
-    """
-
-    queryset = mapping.prepare_batch(queryset)
 
-    pk = 0
-    progress = 0
-    end = queryset.count()
-    queryset = queryset.order_by('pk')
-    while True:
-        subset = queryset.filter(pk__gt=pk)[:chunksize]
-        len_subset = len(subset)
-        progress += len_subset
-        if not len_subset:
-            # Read all subsets until depleted.
-            break
-        if print_progress:
-            logutil.print_progress(progress, end)
-        for row in subset:
-            pk = row.pk
-            yield row
+    See QuerysetIterator for the arguments.
+    """
+    return iter(QuerysetIterator(mapping.prepare_batch(queryset), chunk_size=chunksize, estimate=estimate,
+                                 print_progress=print_progress))
 
 
 def prepare_dict(arg_dict):
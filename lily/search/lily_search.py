@@ -8,6 +8,7 @@ from elasticutils import S
 from lily.accounts.models import Account
 from lily.contacts.models import Contact
 from lily.messaging.email.models.models import EmailAccount
+from lily.search import result_cache
 from lily.search.connections_utils import get_es_client_kwargs
 
 
@@ -19,7 +20,7 @@ class LilySearch(object):
     Search API for Elastic search backend.
     """
 
-    def __init__(self, tenant_id, model_type=None, sort=None, page=0, size=10):
+    def __init__(self, tenant_id, model_type=None, sort=None, page=0, size=10, use_cache=False):
         """
         Setup of search.
 
@@ -29,7 +30,11 @@ class LilySearch(object):
             sort (string): sort option for results
             page (int): page number of pagination
             size (int): max number of returned results
+            use_cache (boolean): cache the results, until documents of the tenant change
         """
+        self.tenant_id = tenant_id
+        self.use_cache = use_cache and settings.ES_SEARCH_CACHE_ENABLED
+        self.prepared = False
         search_request = S().es(**get_es_client_kwargs()).indexes(settings.ES_INDEXES['default'])
         self.search = search_request.all()
 
@@ -66,9 +71,13 @@ class LilySearch(object):
         """
         if settings.ES_DISABLED:
             return [], 0, 0
-        self.search = self.search.filter_raw({'and': self.raw_filters})
-        if self.model_type:
-            self.search = self.search.doctypes(self.model_type)
+        self.prepare()
+
+        if self.use_cache:
+            cache_key = self.get_cache_key(return_fields)
+            result = result_cache.get_result(cache_key)
+            if result is not None:
+                return result
 
         # Fire off search.
         try:
@@ -89,6 +98,8 @@ class LilySearch(object):
                     else:
                         hit[field] = result[field]
                 hits.append(hit)
+            if self.use_cache:
+                result_cache.set_result(cache_key, (hits, execute.count, execute.took))
             return hits, execute.count, execute.took
         except RequestError as e:
             # This can happen when the query is malformed. For example:
@@ -100,6 +111,50 @@ class LilySearch(object):
             logger.error('request error %s' % e)
             return [], 0, 0
 
+    def prepare(self):
+        """
+        Apply the filters and model type to the search, before executing it.
+        """
+        if self.prepared:
+            return
+        self.search = self.search.filter_raw({'and': self.raw_filters})
+        if self.model_type:
+            self.search = self.search.doctypes(self.model_type)
+        self.prepared = True
+
+    def get_cache_key(self, return_fields=None):
+        """
+        Return the key of the results of this search in the result cache.
+        """
+        return result_cache.get_result_key(self.tenant_id, self.search, return_fields)
+
+    def parse_response(self, response, return_fields=None):
+        """
+        Convert a raw Elasticsearch search response to the results of do_search.
+
+        Arguments:
+            response (dict): response of the search
+            return_fields (list): strings of fieldnames to return from result
+
+        Returns:
+            tuple with hits, count and took, like do_search
+        """
+        hits = []
+        for result in response['hits']['hits']:
+            source = result.get('_source', {})
+            hit = {
+                'id': source.get('id'),
+            }
+            if not self.model_type:
+                # We will add type if not specifically searched on it.
+                hit['type'] = result['_type']
+            for field, value in source.iteritems():
+                # Add specified fields, or all fields when not specified.
+                if not return_fields or field in return_fields:
+                    hit[field] = value
+            hits.append(hit)
+        return hits, response['hits']['total'], response['took']
+
     def query_common_fields(self, query):
         """
         Set a raw_query based on common indexed fields.
@@ -254,3 +309,81 @@ class LilySearch(object):
             id_arg (string): the ID to add
         """
         self.raw_filters.append({'ids': {'values': [id_arg]}})
+
+
+class LilyMultiSearch(object):
+    """
+    Execute several LilySearch searches in one round-trip to Elastic search.
+
+    Example:
+        multi_search = LilyMultiSearch()
+        multi_search.add(contact_search)
+        multi_search.add(account_search, ['id', 'name'])
+        (contact_hits, total, took), (account_hits, total, took) = multi_search.do_search()
+    """
+
+    def __init__(self):
+        self.searches = []
+
+    def add(self, search, return_fields=None):
+        """
+        Queue a search.
+
+        Arguments:
+            search (LilySearch): the search
+            return_fields (list): strings of fieldnames to return from result
+        """
+        self.searches.append((search, return_fields))
+
+    def do_search(self):
+        """
+        Execute all queued searches with a single _msearch request.
+
+        Returns:
+            list with a tuple of hits, count and took per search, in the order
+            the searches were added. A search that fails returns no hits.
+        """
+        if settings.ES_DISABLED or not self.searches:
+            return [([], 0, 0) for search in self.searches]
+
+        results = [None] * len(self.searches)
+        cache_keys = {}
+        body = []
+        pending = []
+        for i, (search, return_fields) in enumerate(self.searches):
+            search.prepare()
+            if search.use_cache:
+                cache_keys[i] = search.get_cache_key(return_fields)
+                results[i] = result_cache.get_result(cache_keys[i])
+                if results[i] is not None:
+                    continue
+
+            header = {'index': search.search.get_indexes()}
+            doctypes = search.search.get_doctypes()
+            if doctypes:
+                header['type'] = doctypes
+            body.extend([header, search.search.build_search()])
+            pending.append(i)
+
+        if not pending:
+            return results
+
+        try:
+            responses = self.searches[pending[0]][0].search.get_es().msearch(body=body)['responses']
+        except RequestError as e:
+            logger.error('request error %s' % e)
+            responses = [{'error': e}] * len(pending)
+
+        for i, response in zip(pending, responses):
+            search, return_fields = self.searches[i]
+            if 'error' in response:
+                # See LilySearch.do_search for why errors are caught.
+                logger.error('request error %s' % response['error'])
+                results[i] = ([], 0, 0)
+                continue
+
+            results[i] = search.parse_response(response, return_fields)
+            if search.use_cache:
+                result_cache.set_result(cache_keys[i], results[i])
+
+        return results
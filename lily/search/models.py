@@ -0,0 +1,13 @@
+from django.db import models
+
+
+class IndexCheckpoint(models.Model):
+    """
+    High-water mark of the objects of a mapping that are indexed, used by the
+    delta mode of the index command to only index objects modified since.
+    """
+    mapping = models.CharField(max_length=255, unique=True)
+    modified = models.DateTimeField()
+
+    def __unicode__(self):
+        return u'%s: %s' % (self.mapping, self.modified)
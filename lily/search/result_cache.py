@@ -0,0 +1,149 @@
+import hashlib
+import json
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+
+GENERATION_KEY = 'SEARCH_GENERATION_%s'
+RESULT_KEY = 'SEARCH_RESULT_%s_%s_%s'
+HITS_KEY = 'SEARCH_CACHE_HITS'
+MISSES_KEY = 'SEARCH_CACHE_MISSES'
+
+# Hits and misses of this process that aren't added to the shared counters yet, see flush_stats.
+_counts = {HITS_KEY: 0, MISSES_KEY: 0}
+_counts_lock = threading.Lock()
+_last_flush = time.time()
+
+
+def get_generation(tenant_id):
+    """
+    Return the generation of the search results of a tenant.
+
+    The generation is part of the cache keys of the results, so changing it
+    invalidates all cached results of the tenant at once.
+    """
+    generation = cache.get(GENERATION_KEY % tenant_id)
+    if generation is None:
+        generation = 0
+        cache.add(GENERATION_KEY % tenant_id, generation, None)
+    return generation
+
+
+def invalidate_tenants(tenant_ids):
+    """
+    Invalidate the cached search results of tenants, call this after their
+    documents are changed in the index.
+
+    Args:
+        tenant_ids (iterable): ids of the tenants
+    """
+    if not settings.ES_SEARCH_CACHE_ENABLED:
+        return
+
+    for tenant_id in set(tenant_ids):
+        try:
+            cache.incr(GENERATION_KEY % tenant_id)
+        except ValueError:
+            # No results cached for this tenant yet.
+            pass
+
+
+def get_result_key(tenant_id, search, return_fields=None):
+    """
+    Return the cache key of the results of a search.
+
+    Args:
+        tenant_id (int): id of the tenant
+        search (instance): elasticutils S with the search
+        return_fields (list, optional): fields returned per result
+
+    Returns:
+        string with the cache key
+    """
+    # Sort the keys, so equal searches get the same key.
+    query = json.dumps({
+        'body': search.build_search(),
+        'doctypes': sorted(search.get_doctypes()),
+        'fields': sorted(return_fields or []),
+    }, sort_keys=True, default=str)
+    return RESULT_KEY % (tenant_id, get_generation(tenant_id), hashlib.sha1(query).hexdigest())
+
+
+def get_result(key):
+    """
+    Return the cached results for a key and count the hit or miss.
+
+    The hits and misses are counted per process and added to the shared
+    counters every settings.ES_SEARCH_CACHE_STATS_INTERVAL seconds, so a
+    search doesn't need another round-trip to the cache.
+
+    Returns:
+        tuple with hits, count and took, or None when not cached
+    """
+    global _last_flush
+
+    result = cache.get(key)
+    with _counts_lock:
+        _counts[HITS_KEY if result is not None else MISSES_KEY] += 1
+        flush = time.time() - _last_flush >= settings.ES_SEARCH_CACHE_STATS_INTERVAL
+        if flush:
+            _last_flush = time.time()
+    if flush:
+        flush_stats()
+    return result
+
+
+def set_result(key, result):
+    """
+    Cache the results of a search for settings.ES_SEARCH_CACHE_TTL seconds.
+    """
+    cache.set(key, result, settings.ES_SEARCH_CACHE_TTL)
+
+
+def flush_stats():
+    """
+    Add the hits and misses counted by this process to the shared counters.
+    """
+    with _counts_lock:
+        counts = dict(_counts)
+        for key in _counts:
+            _counts[key] = 0
+
+    for key, count in counts.iteritems():
+        if count:
+            _incr(key, count)
+
+
+def _incr(key, delta):
+    try:
+        cache.incr(key, delta)
+    except ValueError:
+        if not cache.add(key, delta, None):
+            # Added by another process in the meantime.
+            cache.incr(key, delta)
+
+
+def get_stats():
+    """
+    Return the hit and miss counters of the search result cache, of all
+    processes.
+    """
+    flush_stats()
+    hits = cache.get(HITS_KEY) or 0
+    misses = cache.get(MISSES_KEY) or 0
+    return {
+        'hits': hits,
+        'misses': misses,
+        'hit_rate': float(hits) / (hits + misses) if hits + misses else 0.0,
+    }
+
+
+def reset_stats():
+    """
+    Reset the hit and miss counters of the search result cache.
+    """
+    flush_stats()
+    cache.delete_many([HITS_KEY, MISSES_KEY])
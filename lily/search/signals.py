@@ -1,7 +1,11 @@
+import atexit
+
+from celery.signals import task_postrun
+from django.core.signals import request_finished
 from django.db.models.signals import post_save, post_delete, m2m_changed
 from django.dispatch.dispatcher import receiver
 
-from .indexing import update_in_index, remove_from_index
+from .indexing import flush_index_queue, index_related, update_in_index, remove_from_index
 from .scan_search import ModelMappings
 from django.conf import settings
 
@@ -39,18 +43,27 @@ def post_delete_generic(sender, instance, **kwargs):
     check_related(sender, instance)
 
 
+@receiver(request_finished)
+@receiver(task_postrun)
+def finished_generic(**kwargs):
+    # Queue the objects saved in a transaction.
+    flush_index_queue()
+
+
+# Management commands and scripts don't finish a request or task.
+atexit.register(flush_index_queue)
+
+
 def check_related(sender, instance):
     """
     Check related models by checking if the sender is in the relations of the
-    mappings.
+    mappings. The related objects of a mapping are indexed in bulk.
     """
     for mapping in ModelMappings.get_model_mappings().values():
         # Use type(instance) because of sender, because m2m sender differs
         # from type(instance).
         related = mapping.get_related_models().get(type(instance))
         if related:
-            for obj in related(instance):
-                # Some related objects are not specific to one model, such as
-                # 'subject' of Tag, so we do a double check to match the model.
-                if type(obj) is mapping.get_model():
-                    update_in_index(obj, mapping)
+            # Some related objects are not specific to one model, such as
+            # 'subject' of Tag, so we do a double check to match the model.
+            index_related(mapping, [obj for obj in related(instance) if type(obj) is mapping.get_model()])
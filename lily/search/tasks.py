@@ -0,0 +1,43 @@
+import logging
+
+from celery.task import task
+
+from .indexing import INDEX_REMOVE, process_index_queue, remove_ids_from_index, update_ids_in_index
+from .scan_search import ModelMappings
+
+
+logger = logging.getLogger(__name__)
+
+
+@task(name='process_search_index_queue')
+def process_search_index_queue():
+    """
+    Index the objects that were queued by the search signals.
+    """
+    processed = process_index_queue()
+    if processed:
+        logger.debug('Indexed %s queued objects', processed)
+
+
+@task(name='index_related_objects')
+def index_related_objects(mapping_name, ids, action):
+    """
+    Index or remove related objects in bulk, for fan-outs too large to index
+    during a request.
+
+    Args:
+        mapping_name (string): mapping type name of the objects
+        ids (list): ids of the objects
+        action (string): INDEX_UPDATE or INDEX_REMOVE
+    """
+    for mapping in ModelMappings.get_model_mappings().values():
+        if mapping.get_mapping_type_name() == mapping_name:
+            break
+    else:
+        logger.warning('Unknown mapping %s, not indexing related objects', mapping_name)
+        return
+
+    if action == INDEX_REMOVE:
+        remove_ids_from_index(mapping, ids)
+    else:
+        update_ids_in_index(mapping, ids)
@@ -0,0 +1,521 @@
+import time
+
+import anyjson
+from django.db import transaction
+from django.test import SimpleTestCase
+from django.test.client import RequestFactory
+from django.test.utils import override_settings
+from elasticsearch.exceptions import RequestError
+from redis.exceptions import ResponseError
+
+from lily.contacts.search import ContactMapping
+from lily.search import indexing, lily_search, result_cache, tasks
+from lily.search.indexing import INDEX_QUEUE_KEY, INDEX_QUEUE_PROCESSING_KEY, INDEX_REMOVE, INDEX_UPDATE
+from lily.search.lily_search import LilyMultiSearch, LilySearch
+from lily.search.views import MultiSearchView
+
+
+class FakeRedis(object):
+    """
+    Redis connection with only the hash and sorted set commands the index queue uses.
+    """
+    def __init__(self):
+        self.data = {}
+
+    def hmset(self, name, mapping):
+        self.data.setdefault(name, {}).update(mapping)
+
+    def hsetnx(self, name, key, value):
+        values = self.data.setdefault(name, {})
+        if key in values:
+            return 0
+        values[key] = value
+        return 1
+
+    def hgetall(self, name):
+        return dict(self.data.get(name, {}))
+
+    def rename(self, src, dst):
+        if src not in self.data:
+            raise ResponseError('no such key')
+        self.data[dst] = self.data.pop(src)
+
+    def delete(self, *names):
+        for name in names:
+            self.data.pop(name, None)
+
+    def zadd(self, name, **pairs):
+        self.data.setdefault(name, {}).update(pairs)
+
+    def zrem(self, name, *values):
+        for value in values:
+            self.data.get(name, {}).pop(value, None)
+
+    def zrangebyscore(self, name, min, max):
+        scores = self.data.get(name, {})
+        return [value for value in sorted(scores, key=scores.get) if min <= scores[value] <= max]
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+
+class FakePipeline(object):
+    def __init__(self, connection):
+        self.connection = connection
+        self.commands = []
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: self.commands.append((name, args, kwargs))
+
+    def execute(self):
+        return [getattr(self.connection, name)(*args, **kwargs) for name, args, kwargs in self.commands]
+
+
+@override_settings(ES_DISABLED=False, ES_SEARCH_CACHE_ENABLED=False, ES_INDEX_QUEUE_BATCH_SIZE=1)
+class IndexQueueTestCase(SimpleTestCase):
+
+    def setUp(self):
+        self.originals = indexing._queue_connection, indexing.get_aliases, indexing.index_ids
+        self.connection = indexing._queue_connection = FakeRedis()
+        indexing.get_aliases = lambda: []
+        indexing._deferred.items = {}
+        self.name = ContactMapping.get_mapping_type_name()
+
+    def tearDown(self):
+        indexing._queue_connection, indexing.get_aliases, indexing.index_ids = self.originals
+
+    def key(self, obj_id):
+        return '%s:%s' % (self.name, obj_id)
+
+    def test_last_action_wins(self):
+        indexing.enqueue(ContactMapping, [1, 2], INDEX_UPDATE)
+        indexing.enqueue(ContactMapping, [2], INDEX_REMOVE)
+        indexing.enqueue(ContactMapping, [3], INDEX_UPDATE, tenant_ids={3: 7})
+
+        self.assertEqual(self.connection.data[INDEX_QUEUE_KEY], {
+            self.key(1): INDEX_UPDATE,
+            self.key(2): INDEX_REMOVE,
+            self.key(3): '%s:7' % INDEX_UPDATE,
+        })
+
+    def test_entries_wait_for_the_transaction(self):
+        with transaction.atomic():
+            indexing.enqueue(ContactMapping, [1], INDEX_UPDATE)
+            self.assertEqual(self.connection.data, {})
+
+        # Written by the next enqueue outside a transaction, or when flushed.
+        indexing.enqueue(ContactMapping, [2], INDEX_UPDATE)
+        self.assertEqual(sorted(self.connection.data[INDEX_QUEUE_KEY]), [self.key(1), self.key(2)])
+
+        with transaction.atomic():
+            indexing.enqueue(ContactMapping, [3], INDEX_UPDATE)
+        indexing.flush_index_queue()
+        self.assertIn(self.key(3), self.connection.data[INDEX_QUEUE_KEY])
+
+    def test_failed_batches_are_put_back(self):
+        self.connection.hmset(INDEX_QUEUE_KEY, {
+            self.key(1): INDEX_UPDATE,
+            self.key(2): INDEX_UPDATE,
+            self.key(3): INDEX_UPDATE,
+        })
+        indexed = []
+
+        def index_ids(mapping, ids, aliases, refresh=True, raise_errors=False):
+            if ids == [3]:
+                # Removed while the queue is processed, so the newer action must be kept.
+                self.connection.hmset(INDEX_QUEUE_KEY, {self.key(3): INDEX_REMOVE})
+                raise indexing.IndexingError('Failed to index 3')
+            indexed.extend(ids)
+            return []
+
+        indexing.index_ids = index_ids
+
+        self.assertEqual(indexing.process_index_queue(), 2)
+        self.assertEqual(sorted(indexed), [1, 2])
+        self.assertEqual(self.connection.data[INDEX_QUEUE_KEY], {self.key(3): INDEX_REMOVE})
+        # The processed queue is gone once the failures are back in the queue.
+        self.assertEqual(self.connection.data.get(INDEX_QUEUE_PROCESSING_KEY, {}), {})
+        self.assertEqual(set(self.connection.data) - set([INDEX_QUEUE_KEY, INDEX_QUEUE_PROCESSING_KEY]), set())
+
+    def test_failed_objects_are_retried(self):
+        self.connection.hmset(INDEX_QUEUE_KEY, {self.key(1): INDEX_UPDATE})
+
+        def index_ids(mapping, ids, aliases, refresh=True, raise_errors=False):
+            raise indexing.IndexingError('Elasticsearch unavailable')
+
+        indexing.index_ids = index_ids
+
+        self.assertEqual(indexing.process_index_queue(), 0)
+        self.assertEqual(self.connection.data[INDEX_QUEUE_KEY], {self.key(1): INDEX_UPDATE})
+
+    def test_empty_queue(self):
+        self.assertEqual(indexing.process_index_queue(), 0)
+        self.assertEqual(self.connection.data.get(INDEX_QUEUE_PROCESSING_KEY, {}), {})
+
+    def test_abandoned_queues_are_put_back(self):
+        abandoned_key = '%s_abandoned' % INDEX_QUEUE_KEY
+        busy_key = '%s_busy' % INDEX_QUEUE_KEY
+        self.connection.hmset(abandoned_key, {self.key(1): INDEX_UPDATE, self.key(2): INDEX_UPDATE})
+        self.connection.hmset(busy_key, {self.key(3): INDEX_UPDATE})
+        self.connection.zadd(INDEX_QUEUE_PROCESSING_KEY, **{
+            abandoned_key: time.time() - indexing.INDEX_QUEUE_ABANDONED_AFTER - 1,
+            busy_key: time.time(),
+        })
+        # Queued again after the queue was abandoned.
+        self.connection.hmset(INDEX_QUEUE_KEY, {self.key(2): INDEX_REMOVE})
+
+        indexing.requeue_abandoned_queues(self.connection)
+
+        self.assertEqual(self.connection.data[INDEX_QUEUE_KEY], {
+            self.key(1): INDEX_UPDATE,
+            self.key(2): INDEX_REMOVE,
+        })
+        self.assertNotIn(abandoned_key, self.connection.data)
+        self.assertEqual(self.connection.data[INDEX_QUEUE_PROCESSING_KEY].keys(), [busy_key])
+
+
+class FakeTask(object):
+    """
+    Celery task that only records how it's called.
+    """
+    def __init__(self):
+        self.calls = []
+
+    def delay(self, *args):
+        self.calls.append(args)
+
+
+class FakeContact(object):
+    def __init__(self, pk, is_deleted=False):
+        self.pk = self.id = pk
+        self.is_deleted = is_deleted
+        self.tenant_id = 1
+
+
+@override_settings(ES_DISABLED=False, ES_SEARCH_CACHE_ENABLED=False, ES_RELATED_INDEX_TASK_THRESHOLD=2)
+class IndexRelatedTestCase(SimpleTestCase):
+
+    def setUp(self):
+        self.originals = (
+            indexing._queue_connection,
+            indexing.update_ids_in_index,
+            indexing.remove_ids_from_index,
+            tasks.index_related_objects,
+        )
+        self.connection = indexing._queue_connection = FakeRedis()
+        indexing._deferred.items = {}
+        self.indexed = []
+        indexing.update_ids_in_index = lambda mapping, ids, **kwargs: self.indexed.append((INDEX_UPDATE, ids))
+        indexing.remove_ids_from_index = lambda mapping, ids, **kwargs: self.indexed.append((INDEX_REMOVE, ids))
+        self.task = tasks.index_related_objects = FakeTask()
+        self.name = ContactMapping.get_mapping_type_name()
+
+    def tearDown(self):
+        (
+            indexing._queue_connection,
+            indexing.update_ids_in_index,
+            indexing.remove_ids_from_index,
+            tasks.index_related_objects,
+        ) = self.originals
+
+    @override_settings(ES_INDEX_QUEUE_ENABLED=True)
+    def test_related_objects_are_queued_once(self):
+        contact = FakeContact(1)
+        indexing.index_related(ContactMapping, [contact, FakeContact(2, is_deleted=True), contact])
+        indexing.index_related(ContactMapping, [contact])
+
+        self.assertEqual(self.connection.data[INDEX_QUEUE_KEY], {
+            '%s:1' % self.name: INDEX_UPDATE,
+            '%s:2' % self.name: INDEX_REMOVE,
+        })
+        self.assertEqual(self.indexed, [])
+        self.assertEqual(self.task.calls, [])
+
+    @override_settings(ES_INDEX_QUEUE_ENABLED=True)
+    def test_related_objects_are_queued_after_the_transaction(self):
+        with transaction.atomic():
+            indexing.index_related(ContactMapping, [FakeContact(1)])
+            self.assertEqual(self.connection.data, {})
+        indexing.flush_index_queue()
+
+        self.assertEqual(self.connection.data[INDEX_QUEUE_KEY], {'%s:1' % self.name: INDEX_UPDATE})
+
+    @override_settings(ES_INDEX_QUEUE_ENABLED=False)
+    def test_many_related_objects_are_indexed_by_a_task(self):
+        indexing.index_related(ContactMapping, [FakeContact(1), FakeContact(2)])
+        self.assertEqual(self.indexed, [(INDEX_UPDATE, [1, 2])])
+
+        indexing.index_related(ContactMapping, [FakeContact(1), FakeContact(2), FakeContact(3)])
+        self.assertEqual(self.task.calls, [(self.name, [1, 2, 3], INDEX_UPDATE)])
+
+    @override_settings(ES_INDEX_QUEUE_ENABLED=False)
+    def test_no_task_in_transaction(self):
+        # The task could run before the transaction is committed.
+        with transaction.atomic():
+            indexing.index_related(ContactMapping, [FakeContact(1), FakeContact(2), FakeContact(3)])
+
+        self.assertEqual(self.task.calls, [])
+        self.assertEqual(self.indexed, [(INDEX_UPDATE, [1, 2, 3])])
+
+
+class FakeElasticsearch(object):
+    """
+    Elasticsearch client of which the bulk requests return the given status per action.
+    """
+    def __init__(self, statuses):
+        self.statuses = statuses
+        self.requests = []
+
+    def bulk(self, body):
+        self.requests.append(body)
+        items = []
+        for action, status in zip(body, self.statuses):
+            result = {'_id': action['delete']['_id']}
+            if status is not None:
+                result['status'] = status
+            items.append({'delete': result})
+        return {'items': items}
+
+
+class BulkUnindexTestCase(SimpleTestCase):
+
+    def setUp(self):
+        self.original_es = indexing.es
+
+    def tearDown(self):
+        indexing.es = self.original_es
+
+    def test_results_are_counted(self):
+        es = indexing.es = FakeElasticsearch([200, 404, 500, 201, None])
+
+        self.assertEqual(indexing.bulk_unindex(ContactMapping, [1, 2, 3, 4, 5], 'index'), (2, 1, 2))
+        self.assertEqual(len(es.requests), 1)
+        self.assertEqual(es.requests[0][0], {
+            'delete': {'_index': 'index', '_type': ContactMapping.get_mapping_type_name(), '_id': 1},
+        })
+
+    def test_nothing_to_remove(self):
+        es = indexing.es = FakeElasticsearch([])
+
+        self.assertEqual(indexing.bulk_unindex(ContactMapping, [], 'index'), (0, 0, 0))
+        self.assertEqual(es.requests, [])
+
+
+class FakeUser(object):
+    tenant_id = 1
+
+    def is_authenticated(self):
+        return True
+
+
+@override_settings(ES_DISABLED=True)
+class MultiSearchViewTestCase(SimpleTestCase):
+
+    def post(self, body):
+        request = RequestFactory().post('/search/multi/', data=body, content_type='application/json')
+        request.user = FakeUser()
+        return MultiSearchView.as_view()(request)
+
+    def test_searches(self):
+        response = self.post(anyjson.dumps([
+            {'type': 'contacts_contact', 'q': 'John', 'size': 5, 'fields': ['id', 'name']},
+            {'type': 'accounts_account', 'page': '2', 'fields': 'id,name'},
+        ]))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(anyjson.loads(response.content), [
+            {'hits': [], 'total': 0, 'took': 0},
+            {'hits': [], 'total': 0, 'took': 0},
+        ])
+
+    def test_invalid_body(self):
+        self.assertEqual(self.post('not json').status_code, 400)
+        self.assertEqual(self.post(anyjson.dumps({'type': 'contacts_contact'})).status_code, 400)
+        self.assertEqual(self.post(anyjson.dumps(['contacts_contact'])).status_code, 400)
+
+    def test_invalid_params(self):
+        for params in [
+            {'account_related': True},
+            {'q': {'name': 'John'}},
+            {'sort': ['name']},
+            {'size': None},
+            {'size': 1.5},
+            {'fields': ['id', 1]},
+            {'fields': ['id', ['name']]},
+        ]:
+            response = self.post(anyjson.dumps([{'type': 'contacts_contact'}, params]))
+            self.assertEqual(response.status_code, 400, params)
+
+    def test_invalid_numbers(self):
+        self.assertEqual(self.post(anyjson.dumps([{'page': 'first'}])).status_code, 400)
+        self.assertEqual(self.post(anyjson.dumps([{'size': 'ten'}])).status_code, 400)
+
+    def test_clean_params(self):
+        view = MultiSearchView()
+
+        self.assertEqual(view.clean_params({'q': 'John', 'size': 5, 'page': 1L, 'fields': ['id', 'name']}), {
+            'q': u'John',
+            'size': u'5',
+            'page': u'1',
+            'fields': u'id,name',
+        })
+        self.assertEqual(view.clean_params({'fields': 'id,name'}), {'fields': u'id,name'})
+        self.assertIsNone(view.clean_params({'size': False}))
+        self.assertIsNone(view.clean_params([('q', 'John')]))
+
+
+SEARCH_RESPONSE = {
+    'took': 3,
+    'hits': {
+        'total': 12,
+        'hits': [
+            {
+                '_id': '1',
+                '_type': 'contacts_contact',
+                '_source': {'id': 1, 'name': 'John', 'email': 'john@example.com'},
+            },
+            {
+                '_id': '2',
+                '_type': 'accounts_account',
+                '_source': {'id': 2, 'name': 'Example'},
+            },
+        ],
+    },
+}
+
+
+class FakeSearchElasticsearch(object):
+    """
+    Elasticsearch client that answers every search with the given responses.
+    """
+    def __init__(self, responses=None, error=None):
+        self.responses = responses
+        self.error = error
+        self.searches = []
+        self.msearches = []
+
+    def search(self, body, index, doc_type, **kwargs):
+        self.searches.append(body)
+        return SEARCH_RESPONSE
+
+    def msearch(self, body):
+        self.msearches.append(body)
+        if self.error:
+            raise self.error
+        return {'responses': self.responses}
+
+
+@override_settings(ES_DISABLED=False, ES_SEARCH_CACHE_ENABLED=False)
+class LilyMultiSearchTestCase(SimpleTestCase):
+
+    def setUp(self):
+        self.original_get_es = lily_search.S.__dict__['get_es']
+        self.es = FakeSearchElasticsearch([SEARCH_RESPONSE, SEARCH_RESPONSE])
+        lily_search.S.get_es = lambda search, *args, **kwargs: self.es
+
+    def tearDown(self):
+        lily_search.S.get_es = self.original_get_es
+
+    def test_results_match_search(self):
+        for model_type, return_fields in [
+            (None, None),
+            (None, ['name']),
+            ('contacts_contact', None),
+            ('contacts_contact', ['id', 'email']),
+        ]:
+            expected = LilySearch(tenant_id=1, model_type=model_type).do_search(return_fields)
+
+            multi_search = LilyMultiSearch()
+            multi_search.add(LilySearch(tenant_id=1, model_type=model_type), return_fields)
+            self.assertEqual(multi_search.do_search(), [expected])
+
+    def test_type_without_model_type(self):
+        multi_search = LilyMultiSearch()
+        multi_search.add(LilySearch(tenant_id=1))
+        multi_search.add(LilySearch(tenant_id=1, model_type='contacts_contact'), ['name'])
+        (hits, total, took), (typed_hits, typed_total, typed_took) = multi_search.do_search()
+
+        self.assertEqual((total, took), (12, 3))
+        self.assertEqual(hits[0], {
+            'id': 1,
+            'type': 'contacts_contact',
+            'name': 'John',
+            'email': 'john@example.com',
+        })
+        self.assertEqual(typed_hits, [{'id': 1, 'name': 'John'}, {'id': 2, 'name': 'Example'}])
+
+        header, body, typed_header, typed_body = self.es.msearches[0]
+        self.assertNotIn('type', header)
+        self.assertEqual(typed_header['type'], ['contacts_contact'])
+
+    def test_failed_search(self):
+        self.es.responses = [{'error': 'SearchPhaseExecutionException[Failed to execute phase]'}, SEARCH_RESPONSE]
+        multi_search = LilyMultiSearch()
+        multi_search.add(LilySearch(tenant_id=1))
+        multi_search.add(LilySearch(tenant_id=1))
+        failed, results = multi_search.do_search()
+
+        self.assertEqual(failed, ([], 0, 0))
+        self.assertEqual(len(results[0]), 2)
+
+    def test_failed_request(self):
+        self.es.error = RequestError(400, 'SearchPhaseExecutionException', {})
+        multi_search = LilyMultiSearch()
+        multi_search.add(LilySearch(tenant_id=1))
+        multi_search.add(LilySearch(tenant_id=1))
+
+        self.assertEqual(multi_search.do_search(), [([], 0, 0), ([], 0, 0)])
+
+    @override_settings(ES_DISABLED=True)
+    def test_disabled(self):
+        multi_search = LilyMultiSearch()
+        multi_search.add(LilySearch(tenant_id=1))
+
+        self.assertEqual(multi_search.do_search(), [([], 0, 0)])
+        self.assertEqual(self.es.msearches, [])
+
+
+@override_settings(ES_DISABLED=False, ES_SEARCH_CACHE_ENABLED=True)
+class LilyMultiSearchCacheTestCase(SimpleTestCase):
+
+    def setUp(self):
+        self.originals = (
+            lily_search.S.__dict__['get_es'],
+            result_cache.get_result_key,
+            result_cache.get_result,
+            result_cache.set_result,
+        )
+        self.es = FakeSearchElasticsearch([SEARCH_RESPONSE])
+        self.cached = {'tenant-1': ([{'id': 5}], 1, 2)}
+        lily_search.S.get_es = lambda search, *args, **kwargs: self.es
+        result_cache.get_result_key = lambda tenant_id, search, return_fields=None: 'tenant-%s' % tenant_id
+        result_cache.get_result = self.cached.get
+        result_cache.set_result = self.cached.__setitem__
+
+    def tearDown(self):
+        (
+            lily_search.S.get_es,
+            result_cache.get_result_key,
+            result_cache.get_result,
+            result_cache.set_result,
+        ) = self.originals
+
+    def test_cache_hits_are_not_searched(self):
+        multi_search = LilyMultiSearch()
+        multi_search.add(LilySearch(tenant_id=1, use_cache=True))
+        multi_search.add(LilySearch(tenant_id=2, use_cache=True))
+        cached, searched = multi_search.do_search()
+
+        self.assertEqual(cached, ([{'id': 5}], 1, 2))
+        self.assertEqual(searched[1:], (12, 3))
+        self.assertEqual(self.cached['tenant-2'], searched)
+        # Only the search of the second tenant is in the request.
+        header, body = self.es.msearches[0]
+        self.assertIn({'term': {'tenant': 2}}, body['filter']['and'])
+
+    def test_all_cache_hits(self):
+        multi_search = LilyMultiSearch()
+        multi_search.add(LilySearch(tenant_id=1, use_cache=True))
+
+        self.assertEqual(multi_search.do_search(), [([{'id': 5}], 1, 2)])
+        self.assertEqual(self.es.msearches, [])
@@ -1,9 +1,10 @@
 from django.conf.urls import url, patterns
 
-from .views import SearchView, EmailAddressSearchView
+from .views import SearchView, MultiSearchView, EmailAddressSearchView
 
 
 urlpatterns = patterns('',
     url(r'^search/$', SearchView.as_view(), name='search_view'),
+    url(r'^search/multi/$', MultiSearchView.as_view(), name='multi_search_view'),
     url(r'^emailaddress/(?P<email_address>[-_\.\+\w]+@[-_\.\w]+)$', EmailAddressSearchView.as_view(), name='search_view'),
 )
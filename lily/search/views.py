@@ -1,10 +1,10 @@
 import anyjson
-from django.http.response import HttpResponse
+from django.http.response import HttpResponse, HttpResponseBadRequest
 from django.views.generic.base import View
 
 from lily.utils.views.mixins import LoginRequiredMixin
 
-from .lily_search import LilySearch
+from .lily_search import LilyMultiSearch, LilySearch
 
 
 class SearchView(LoginRequiredMixin, View):
@@ -21,58 +21,130 @@ class SearchView(LoginRequiredMixin, View):
                 total (int): total number of results
                 took (int): milliseconds Elastic search took to get the results
         """
+        search, return_fields = self.get_search(request.GET)
+        hits, total, took = search.do_search(return_fields)
+
+        results = {'hits': hits, 'total': total, 'took': took}
+        return HttpResponse(anyjson.dumps(results), content_type='application/json; charset=utf-8')
+
+    def get_search(self, params):
+        """
+        Create a search from the search parameters.
+
+        Args:
+            params (dict): parameters of the search, like the GET parameters
+
+        Returns:
+            tuple with the LilySearch and the fields to return
+        """
         kwargs = {}
-        model_type = request.GET.get('type')
+        model_type = params.get('type')
         if model_type:
             kwargs['model_type'] = model_type
-        sort = request.GET.get('sort')
+        sort = params.get('sort')
         if sort:
             kwargs['sort'] = sort
-        page = request.GET.get('page')
+        page = params.get('page')
         if page:
             kwargs['page'] = int(page)
-        size = request.GET.get('size')
+        size = params.get('size')
         if size:
             kwargs['size'] = int(size)
 
         # Passing arguments as **kwargs means we can use the defaults.
         search = LilySearch(
-            tenant_id=request.user.tenant_id,
+            tenant_id=self.request.user.tenant_id,
             **kwargs
         )
 
-        id_arg = request.GET.get('id', '')
+        id_arg = params.get('id', '')
         if id_arg:
             search.get_by_id(id_arg)
 
-        query = request.GET.get('q', '').lower()
+        query = params.get('q', '').lower()
         if query:
             search.query_common_fields(query)
 
-        account_related = request.GET.get('account_related', '')
+        account_related = params.get('account_related', '')
         if account_related:
             search.account_related(int(account_related))
 
-        contact_related = request.GET.get('contact_related', '')
+        contact_related = params.get('contact_related', '')
         if contact_related:
             search.contact_related(int(contact_related))
 
-        user_email_related = request.GET.get('user_email_related', '')
+        user_email_related = params.get('user_email_related', '')
         if user_email_related:
             search.user_email_related(self.request.user)
 
-        filterquery = request.GET.get('filterquery', '')
+        filterquery = params.get('filterquery', '')
         if filterquery:
             search.filter_query(filterquery)
 
-        return_fields = filter(None, request.GET.get('fields', '').split(','))
+        return_fields = filter(None, params.get('fields', '').split(','))
         if '*' in return_fields:
             return_fields = None
-        hits, total, took = search.do_search(return_fields)
 
-        results = {'hits': hits, 'total': total, 'took': took}
+        return search, return_fields
+
+
+class MultiSearchView(SearchView):
+    """
+    Execute several searches in one request, and one round-trip to Elastic search.
+    """
+    def post(self, request):
+        """
+        Parses the JSON body, a list with the parameters of every search as
+        accepted by SearchView, to create the searches.
+
+        Returns:
+            HttpResponse with a JSON list with a dict per search, like SearchView
+        """
+        try:
+            searches = anyjson.loads(request.body)
+        except ValueError:
+            return HttpResponseBadRequest()
+        if not isinstance(searches, list):
+            return HttpResponseBadRequest()
+
+        multi_search = LilyMultiSearch()
+        for params in searches:
+            params = self.clean_params(params)
+            if params is None:
+                return HttpResponseBadRequest()
+            try:
+                multi_search.add(*self.get_search(params))
+            except ValueError:
+                # A parameter that should be a number isn't.
+                return HttpResponseBadRequest()
+
+        results = [{'hits': hits, 'total': total, 'took': took} for hits, total, took in multi_search.do_search()]
         return HttpResponse(anyjson.dumps(results), content_type='application/json; charset=utf-8')
 
+    def clean_params(self, params):
+        """
+        Convert the parameters of a search in the JSON body to the GET parameters SearchView accepts.
+
+        Args:
+            params (dict): parameters of the search, values are strings or numbers and fields can also be a list
+
+        Returns:
+            dict with the parameters as strings, or None when they are invalid
+        """
+        if not isinstance(params, dict):
+            return None
+
+        cleaned = {}
+        for key, value in params.items():
+            if key == 'fields' and isinstance(value, list):
+                if not all(isinstance(field, basestring) for field in value):
+                    return None
+                value = ','.join(value)
+            elif isinstance(value, bool) or not isinstance(value, (basestring, int, long)):
+                return None
+            cleaned[key] = unicode(value)
+        return cleaned
+
 
 class EmailAddressSearchView(LoginRequiredMixin, View):
 
@@ -80,33 +152,54 @@ class EmailAddressSearchView(LoginRequiredMixin, View):
 
         email_address = kwargs.get('email_address', None)
 
+        # Search for contacts and accounts with the email address, and for
+        # accounts with the domain, in one go.
+        multi_search = LilyMultiSearch()
+        multi_search.add(self._get_search('contacts_contact', email_address))
+        multi_search.add(self._get_search('accounts_account', email_address))
+        multi_search.add(self._get_search('accounts_account', email_address.split('@')[1]))
+        contact_results, account_results, domain_results = multi_search.do_search()
+
         # 1: Search for Contact with given email address
-        results = self._search_contact(email_address)
+        results = self._search_contact(contact_results)
 
         # 2: Search for Account with given email address
         if not results:
-            results = self._search_account(email_address)
+            results = self._search_account(account_results, domain_results)
 
         return HttpResponse(anyjson.dumps(results), content_type='application/json; charset=utf-8')
 
-    def _search_contact(self, email_address):
+    def _get_search(self, model_type, email_address):
         """
-        Search for contact with given email address.
+        Create a search for the first object with an email address.
 
         Args:
-            email_address (string): string representation of an email address
+            model_type (string): type of the objects to search
+            email_address (string): email address or domain to search for
 
         Returns:
-            dict with search results or empty dict
+            LilySearch instance
         """
         search = LilySearch(
             tenant_id=self.request.user.tenant_id,
-            model_type='contacts_contact',
+            model_type=model_type,
             size=1,
+            use_cache=True,
         )
         search.filter_query('email_addresses.email_address:%s' % email_address)
+        return search
+
+    def _search_contact(self, contact_results):
+        """
+        Return the contact with given email address.
 
-        hits, total, took = search.do_search()
+        Args:
+            contact_results (tuple): results of the contact search
+
+        Returns:
+            dict with search results or empty dict
+        """
+        hits, total, took = contact_results
         if hits:
             return {
                 'type': 'contact',
@@ -114,24 +207,19 @@ class EmailAddressSearchView(LoginRequiredMixin, View):
             }
         return {}
 
-    def _search_account(self, email_address):
+    def _search_account(self, account_results, domain_results):
         """
-        Search for account with given email address.
+        Return the account with given email address, or else the only
+        account with its domain.
 
         Args:
-            email_address (string): string representation of an email address
+            account_results (tuple): results of the account search
+            domain_results (tuple): results of the account search on domain
 
         Returns:
             dict with search results or empty dict
         """
-        search = LilySearch(
-            tenant_id=self.request.user.tenant_id,
-            model_type='accounts_account',
-            size=1,
-        )
-        search.filter_query('email_addresses.email_address:%s' % email_address)
-
-        hits, total, took = search.do_search()
+        hits, total, took = account_results
         if hits:
             return {
                 'type': 'account',
@@ -139,14 +227,7 @@ class EmailAddressSearchView(LoginRequiredMixin, View):
                 'complete': True,
             }
         else:
-            search = LilySearch(
-                tenant_id=self.request.user.tenant_id,
-                model_type='accounts_account',
-                size=1,
-            )
-            search.filter_query('email_addresses.email_address:%s' % email_address.split('@')[1])
-
-            hits, total, took = search.do_search()
+            hits, total, took = domain_results
             if total > 1:
                 return {}
             if hits:
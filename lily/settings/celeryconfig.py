@@ -3,7 +3,9 @@ from datetime import timedelta
 
 from kombu import Queue
 
-from .settings import DEBUG, TIME_ZONE
+from lily.messaging.email.routers import LANES, get_queue_name
+
+from .settings import DEBUG, TIME_ZONE, ES_INDEX_QUEUE_INTERVAL, GMAIL_PUSH_ENABLED
 
 
 BROKER = os.environ.get('BROKER', 'DEV')
@@ -31,11 +33,20 @@ CELERY_TASK_SERIALIZER = 'json'
 CELERY_RESULT_BACKEND = os.environ.get('REDISTOGO_URL', 'redis://localhost:6379')
 CELERY_TASK_RESULT_EXPIRES = 300
 CELERY_TIMEZONE = TIME_ZONE
+# Number of queues per lane of email tasks, see lily.messaging.email.routers. With 0 the routes below apply.
+# Workers get their queues from the emailqueues command, so they follow this setting. To enable it, first scale up
+# the first_sync, sync and actions dynos of the Procfile and then set it, the workers of queue1 and queue2 don't
+# consume the email queues.
+EMAIL_QUEUE_SHARDS = int(os.environ.get('EMAIL_QUEUE_SHARDS', 0))
 CELERY_QUEUES = (
     Queue('queue1', routing_key='email_async_tasks'),
     Queue('queue2', routing_key='email_scheduled_tasks'),
+) + tuple(
+    Queue(get_queue_name(lane, shard), routing_key=get_queue_name(lane, shard))
+    for lane in LANES for shard in range(EMAIL_QUEUE_SHARDS)
 )
 CELERY_ROUTES = (
+    'lily.messaging.email.routers.EmailTaskRouter',
     {'synchronize_email_account_scheduler': {  # schedule priority email tasks without interference
         'queue': 'queue2'
     }},
@@ -45,10 +56,30 @@ CELERY_ROUTES = (
     {'first_synchronize_email_account': {  # schedule priority email tasks without interference
         'queue': 'queue2'
     }},
+    {'handle_gmail_push_notification': {  # schedule priority email tasks without interference
+        'queue': 'queue2'
+    }},
 )
 CELERYBEAT_SCHEDULE = {
     'synchronize_email_account_scheduler': {
         'task': 'synchronize_email_account_scheduler',
         'schedule': timedelta(seconds=int(os.environ.get('EMAIL_SYNC_INTERVAL', 60))),
     },
+    'process_search_index_queue': {
+        'task': 'process_search_index_queue',
+        'schedule': timedelta(seconds=ES_INDEX_QUEUE_INTERVAL),
+        'options': {
+            'expires': ES_INDEX_QUEUE_INTERVAL,  # a later run picks up the queue anyway
+        },
+    },
+    'prune_task_statuses': {
+        'task': 'prune_task_statuses',
+        'schedule': timedelta(days=1),
+    },
 }
+
+if GMAIL_PUSH_ENABLED:
+    CELERYBEAT_SCHEDULE['watch_email_accounts'] = {
+        'task': 'watch_email_accounts',
+        'schedule': timedelta(days=1),  # watches expire after 7 days
+    }
@@ -121,6 +121,10 @@ FILE_UPLOAD_HANDLERS = (
 ACCOUNT_UPLOAD_TO = 'images/profile/account'
 CONTACT_UPLOAD_TO = 'images/profile/contact'
 EMAIL_ATTACHMENT_UPLOAD_TO = 'messaging/email/attachments/%(tenant_id)d/%(message_id)d/%(filename)s'
+# Synced attachments are stored once per tenant by content hash
+EMAIL_ATTACHMENT_BLOB_UPLOAD_TO = 'messaging/email/attachments/%(tenant_id)d/blobs/%(prefix)s/%(hash)s%(extension)s'
+# Max size in bytes of an attachment that is decoded in memory, larger ones go through a temporary file
+EMAIL_ATTACHMENT_SPOOL_SIZE = int(os.environ.get('EMAIL_ATTACHMENT_SPOOL_SIZE', 5 * 1024 * 1024))
 EMAIL_TEMPLATE_ATTACHMENT_UPLOAD_TO = 'messaging/email/templates/attachments/%(tenant_id)d/%(template_id)d/%(filename)s'
 
 STATICI18N_ROOT = local_path('static/')
@@ -539,6 +543,24 @@ ES_MAXSIZE = os.environ.get('ES_MAXSIZE', 2)  # Default is 10
 
 ES_BLOCK = os.environ.get('ES_BLOCK', True)  # Default is False
 
+# Queue objects to index in redis and index them in bulk every ES_INDEX_QUEUE_INTERVAL seconds, instead of indexing
+# them while saving
+ES_INDEX_QUEUE_ENABLED = boolean(os.environ.get('ES_INDEX_QUEUE_ENABLED', 1))
+ES_INDEX_QUEUE_INTERVAL = int(os.environ.get('ES_INDEX_QUEUE_INTERVAL', 5))
+ES_INDEX_QUEUE_BATCH_SIZE = int(os.environ.get('ES_INDEX_QUEUE_BATCH_SIZE', 100))
+# Seconds to cache the aliases of the indexes writes go to, the index command invalidates them when it changes them.
+ES_ALIAS_CACHE_TTL = int(os.environ.get('ES_ALIAS_CACHE_TTL', 60))
+# Without the index queue, related objects changed by a save are indexed by a task when there are more than this number
+# of them.
+ES_RELATED_INDEX_TASK_THRESHOLD = int(os.environ.get('ES_RELATED_INDEX_TASK_THRESHOLD', 200))
+# Default number of rows fetched per query by lily.utils.querysets.QuerysetIterator.
+QUERYSET_ITERATOR_CHUNK_SIZE = int(os.environ.get('QUERYSET_ITERATOR_CHUNK_SIZE', 500))
+# Cache search results of searches that opt in, per tenant until the documents of the tenant change.
+ES_SEARCH_CACHE_ENABLED = boolean(os.environ.get('ES_SEARCH_CACHE_ENABLED', 0))
+ES_SEARCH_CACHE_TTL = int(os.environ.get('ES_SEARCH_CACHE_TTL', 300))
+# Seconds between adding the hits and misses of the search cache counted per process to the shared counters
+ES_SEARCH_CACHE_STATS_INTERVAL = int(os.environ.get('ES_SEARCH_CACHE_STATS_INTERVAL', 60))
+
 #######################################################################################################################
 # Gmail API settings                                                                                                  #
 #######################################################################################################################
@@ -552,8 +574,70 @@ GMAIL_PARTIAL_SYNC_LIMIT = os.environ.get('GMAIL_PARTIAL_SYNC_LIMIT', 899)
 GMAIL_CALLBACK_URL = os.environ.get('GMAIL_CALLBACK_URL', 'http://localhost:8000/messaging/email/callback/')
 GMAIL_SYNC_DELAY_INTERVAL = 1
 GMAIL_SYNC_LOCK_LIFETIME = 300
+
+# Sync accounts more or less often depending on how often they change: after a sync without changes the interval
+# (in seconds) grows by BACKOFF_FACTOR up to MAX_INTERVAL, next syncs are jittered by a fraction JITTER of the interval
+# and scheduled syncs are spread randomly over SCHEDULE_SPREAD seconds
+GMAIL_SYNC_CADENCE_ENABLED = boolean(os.environ.get('GMAIL_SYNC_CADENCE_ENABLED', 1))
+GMAIL_SYNC_MIN_INTERVAL = int(os.environ.get('EMAIL_SYNC_INTERVAL', 60))
+GMAIL_SYNC_MAX_INTERVAL = int(os.environ.get('GMAIL_SYNC_MAX_INTERVAL', 900))
+GMAIL_SYNC_BACKOFF_FACTOR = float(os.environ.get('GMAIL_SYNC_BACKOFF_FACTOR', 2))
+GMAIL_SYNC_JITTER = float(os.environ.get('GMAIL_SYNC_JITTER', 0.1))
+GMAIL_SYNC_SCHEDULE_SPREAD = int(os.environ.get('GMAIL_SYNC_SCHEDULE_SPREAD', 30))
+
+# Sync on push notifications of the gmail api, published to Cloud Pub/Sub TOPIC and pushed to the gmail_push view
+# with TOKEN as token parameter. Polling then only happens every POLL_INTERVAL seconds as a safety net.
+GMAIL_PUSH_ENABLED = boolean(os.environ.get('GMAIL_PUSH_ENABLED', 0))
+GMAIL_PUSH_TOPIC = os.environ.get('GMAIL_PUSH_TOPIC', '')
+GMAIL_PUSH_TOKEN = os.environ.get('GMAIL_PUSH_TOKEN', '')
+GMAIL_PUSH_POLL_INTERVAL = int(os.environ.get('GMAIL_PUSH_POLL_INTERVAL', 900))
 GMAIL_CHUNK_SIZE = 1024 * 1024
 
+# Save full message batches with bulk queries instead of one message at a time
+GMAIL_SYNC_BULK_SAVE_ENABLED = boolean(os.environ.get('GMAIL_SYNC_BULK_SAVE_ENABLED', 1))
+
+# Max number of recipients cached during a sync, shared by all syncs of a worker if PER_WORKER is enabled
+GMAIL_RECIPIENT_CACHE_SIZE = int(os.environ.get('GMAIL_RECIPIENT_CACHE_SIZE', 10000))
+GMAIL_RECIPIENT_CACHE_PER_WORKER = boolean(os.environ.get('GMAIL_RECIPIENT_CACHE_PER_WORKER', 0))
+
+# Pipelined full sync: fetching, parsing and saving of messages run concurrently
+GMAIL_SYNC_PIPELINE_ENABLED = boolean(os.environ.get('GMAIL_SYNC_PIPELINE_ENABLED', 0))
+GMAIL_SYNC_FETCH_WORKERS = int(os.environ.get('GMAIL_SYNC_FETCH_WORKERS', 2))
+GMAIL_SYNC_PARSE_WORKERS = int(os.environ.get('GMAIL_SYNC_PARSE_WORKERS', 2))
+GMAIL_SYNC_SAVE_WORKERS = int(os.environ.get('GMAIL_SYNC_SAVE_WORKERS', 1))
+# Max number of messages waiting between two stages of the pipeline
+GMAIL_SYNC_QUEUE_SIZE = int(os.environ.get('GMAIL_SYNC_QUEUE_SIZE', 300))
+
+# Garbage collect during a sync only after RSS (in MB) or the number of tracked objects grew past the threshold,
+# measured every CHECK_INTERVAL messages
+GMAIL_SYNC_GC_RSS_THRESHOLD = int(os.environ.get('GMAIL_SYNC_GC_RSS_THRESHOLD', 200))
+GMAIL_SYNC_GC_OBJECT_THRESHOLD = int(os.environ.get('GMAIL_SYNC_GC_OBJECT_THRESHOLD', 1000000))
+GMAIL_SYNC_GC_CHECK_INTERVAL = int(os.environ.get('GMAIL_SYNC_GC_CHECK_INTERVAL', 100))
+
+# Update unread counts of labels with the changes made by syncs and actions instead of counting all messages,
+# a full count is still done after every full sync
+GMAIL_UNREAD_COUNT_INCREMENTAL = boolean(os.environ.get('GMAIL_UNREAD_COUNT_INCREMENTAL', 1))
+
+# Pace Gmail api calls with token buckets in redis, rates in quota units per second per account and for the project.
+# A rate limit error multiplies the rate with the BACKOFF_FACTOR (down to MIN_FACTOR of the max rate), after which
+# it recovers with RECOVERY times the max rate per second.
+GMAIL_RATE_GOVERNOR_ENABLED = boolean(os.environ.get('GMAIL_RATE_GOVERNOR_ENABLED', 1))
+GMAIL_RATE_ACCOUNT_UNITS = float(os.environ.get('GMAIL_RATE_ACCOUNT_UNITS', 250))
+GMAIL_RATE_PROJECT_UNITS = float(os.environ.get('GMAIL_RATE_PROJECT_UNITS', 10000))
+GMAIL_RATE_BACKOFF_FACTOR = float(os.environ.get('GMAIL_RATE_BACKOFF_FACTOR', 0.5))
+GMAIL_RATE_MIN_FACTOR = float(os.environ.get('GMAIL_RATE_MIN_FACTOR', 0.1))
+GMAIL_RATE_RECOVERY = float(os.environ.get('GMAIL_RATE_RECOVERY', 0.01))
+# Quota units of a call, a batch request costs this for every message
+GMAIL_RATE_DEFAULT_COST = 5
+GMAIL_RATE_SEND_COST = 100
+# Max number of messages in one batch request
+GMAIL_BATCH_REQUEST_SIZE = int(os.environ.get('GMAIL_BATCH_REQUEST_SIZE', 100))
+
+# Download attachments in a separate task after the message is saved, instead of while parsing the message
+GMAIL_ATTACHMENT_DOWNLOAD_ASYNC = boolean(os.environ.get('GMAIL_ATTACHMENT_DOWNLOAD_ASYNC', 1))
+# Seconds before an unreferenced attachment file is removed, so a message that is saved again can reuse it
+EMAIL_ATTACHMENT_DELETE_DELAY = 300
+
 #######################################################################################################################
 # Django rest settings                                                                                                #
 #######################################################################################################################
@@ -593,6 +677,12 @@ MESSAGE_STORAGE = 'django.contrib.messages.storage.fallback.FallbackStorage'
 # Tenant support
 MULTI_TENANT = boolean(os.environ.get('MULTI_TENANT', 0))
 
+# Task monitor: backend that locks monitored tasks, number of end statuses the redis backend keeps and days after
+# which prune_task_statuses removes the statuses of the database backend
+TASKMONITOR_LOCK_BACKEND = os.environ.get('TASKMONITOR_LOCK_BACKEND', 'taskmonitor.backends.RedisLockBackend')
+TASKMONITOR_HISTORY_SIZE = int(os.environ.get('TASKMONITOR_HISTORY_SIZE', 1000))
+TASKMONITOR_STATUS_RETENTION = int(os.environ.get('TASKMONITOR_STATUS_RETENTION', 7))
+
 # Settings for 3rd party apps
 
 # django debug toolbar
@@ -1,11 +1,14 @@
 import datetime
 import operator
+import os
 import re
 from itertools import chain
+from urlparse import urlparse
 
 from django import forms
 from django.contrib import messages
 from django.db.models import Q
+from redis import ConnectionPool, Redis
 
 
 def autostrip(cls):
@@ -277,3 +280,20 @@ def add_business_days(date, days, days_of_business=None):
              (7 * multiplier))
 
     return date + datetime.timedelta(days=delta)
+
+
+_redis_pool = None
+
+
+def get_redis_connection():
+    """
+    Return a connection to the redis server, used for locks, rate limits and queues.
+
+    All connections share one connection pool per process, so creating one is cheap.
+    """
+    global _redis_pool
+
+    if _redis_pool is None:
+        redis_path = urlparse(os.environ.get('REDISTOGO_URL', 'redis://localhost:6379'))
+        _redis_pool = ConnectionPool(host=redis_path.hostname, port=redis_path.port, password=redis_path.password)
+    return Redis(connection_pool=_redis_pool)
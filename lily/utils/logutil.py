@@ -1,12 +1,14 @@
 import sys
 
 
-def print_progress(progress, end):
+def print_progress(progress, end, rate=None):
     """
     Print a progress bar on a single line to monitor `progress` reaching `end`.
+    When `rate` is given, the throughput per second is printed after the bar.
 
     Example output:
         Progress: [ =======                                  ]  280/1594
+        Progress: [ =======                                  ]  280/1594 (93/s)
     """
     if isinstance(progress, int):
         progress = float(progress)
@@ -21,11 +23,12 @@ def print_progress(progress, end):
     line_width = 70
     bar_size = (line_width - 7) - len(text_before) - len(status.rstrip('\r\n')) - (len(str(end)) * 2 + 1)
     blocks = int(round(bar_size * (progress / end)))
-    text = "\r%(before)s [ %(bar)s ] %(progress)s/%(end)s %(status)s" % {
+    text = "\r%(before)s [ %(bar)s ] %(progress)s/%(end)s %(rate)s%(status)s" % {
         'before': text_before,
         'bar': '=' * blocks + ' ' * (bar_size - blocks),
         'progress': str(int(round(progress))).rjust(len(str(end))),
         'end': end,
+        'rate': '(%d/s) ' % rate if rate is not None else '',
         'status': status
     }
     sys.stdout.write(text)
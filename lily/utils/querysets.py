@@ -0,0 +1,109 @@
+import logging
+import re
+import time
+
+from django.conf import settings
+from django.db import connections
+
+from lily.utils import logutil
+
+
+logger = logging.getLogger(__name__)
+
+
+def estimate_count(queryset):
+    """
+    Return the number of rows of a queryset as estimated by the query planner.
+
+    Counting a large table is slow, the estimate is good enough for progress
+    reporting. Falls back to a real count on databases other than PostgreSQL.
+
+    Args:
+        queryset (instance): QuerySet to count
+
+    Returns:
+        int with the (estimated) number of rows
+    """
+    connection = connections[queryset.db]
+    if connection.vendor != 'postgresql':
+        return queryset.count()
+
+    sql, params = queryset.order_by().query.sql_with_params()
+    cursor = connection.cursor()
+    try:
+        cursor.execute('EXPLAIN %s' % sql, params)
+        match = re.search(r'rows=(\d+)', cursor.fetchone()[0])
+    finally:
+        cursor.close()
+
+    return int(match.group(1)) if match else queryset.count()
+
+
+class QuerysetIterator(object):
+    """
+    Iterate over a large queryset in chunks, without loading it all at once.
+
+    Rows are fetched with keyset pagination on the primary key, so every
+    chunk is a cheap index range scan instead of an increasing offset.
+    Prefetches and select_related of the queryset are applied once per chunk.
+
+    Attributes:
+        count (int): number of rows iterated so far
+        total (int): (estimated) number of rows, None until iterated
+        elapsed (float): seconds spent iterating
+    """
+    def __init__(self, queryset, chunk_size=None, estimate=False, print_progress=False):
+        """
+        Args:
+            queryset (instance): QuerySet to iterate, its ordering is replaced by the pk
+            chunk_size (int, optional): rows per query, defaults to settings.QUERYSET_ITERATOR_CHUNK_SIZE
+            estimate (boolean, optional): use the query planner estimate as total instead of counting
+            print_progress (boolean, optional): print a progress bar with the throughput
+        """
+        self.queryset = queryset.order_by('pk')
+        self.chunk_size = chunk_size or settings.QUERYSET_ITERATOR_CHUNK_SIZE
+        self.estimate = estimate
+        self.print_progress = print_progress
+        self.count = 0
+        self.total = None
+        self.elapsed = 0.0
+
+    @property
+    def rate(self):
+        """
+        Return the throughput in rows per second.
+        """
+        return self.count / self.elapsed if self.elapsed else 0.0
+
+    def __iter__(self):
+        if self.print_progress:
+            self.total = estimate_count(self.queryset) if self.estimate else self.queryset.count()
+
+        started = time.time()
+        pk = None
+        while True:
+            subset = self.queryset if pk is None else self.queryset.filter(pk__gt=pk)
+            rows = list(subset[:self.chunk_size])
+            if not rows:
+                break
+
+            self.count += len(rows)
+            self.elapsed = time.time() - started
+            if self.print_progress:
+                # An estimate can be too low.
+                logutil.print_progress(self.count, max(self.total, self.count), rate=self.rate)
+
+            pk = rows[-1].pk
+            for row in rows:
+                yield row
+
+            if len(rows) < self.chunk_size:
+                break
+
+        self.elapsed = time.time() - started
+        logger.info('Iterated %s %s rows in %.1f seconds (%.1f rows/sec)' % (
+            self.count,
+            self.queryset.model.__name__,
+            self.elapsed,
+            self.rate,
+        ))
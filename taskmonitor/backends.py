@@ -0,0 +1,159 @@
+import hashlib
+import json
+import time
+from datetime import datetime, timedelta
+
+from celery.states import PENDING, RECEIVED, STARTED, REVOKED, RETRY, IGNORED, REJECTED
+from dateutil.tz import tzutc
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.utils.module_loading import import_string
+
+from lily.utils.functions import get_redis_connection
+from taskmonitor.models import TaskStatus
+
+
+# States of tasks that still hold their lock.
+LOCKED_STATES = [PENDING, RECEIVED, STARTED, REVOKED, RETRY, IGNORED, REJECTED]
+
+_backend = None
+
+
+def get_lock_backend():
+    """
+    Return the lock backend configured with settings.TASKMONITOR_LOCK_BACKEND, one instance per process.
+    """
+    global _backend
+
+    if _backend is None:
+        _backend = import_string(settings.TASKMONITOR_LOCK_BACKEND)()
+    return _backend
+
+
+class BaseLockBackend(object):
+    """
+    Store the locks and statuses of monitored tasks.
+
+    A lock is taken for the signature of a task before it's queued and is held until the task is finished or its
+    time limit has passed, so a task with the same signature can't be queued twice.
+    """
+
+    def acquire(self, sig, timelimit):
+        """
+        Take the lock of a signature if nobody holds it.
+
+        Args:
+            sig (string): signature of the task
+            timelimit (float): seconds before the lock expires
+
+        Returns:
+            id of the lock, or None when the lock is already held
+        """
+        raise NotImplementedError
+
+    def start(self, lock_id, task_id, timelimit):
+        """
+        Mark the task of a lock as started, the lock expires after the time limit from now.
+
+        Args:
+            lock_id: id of the lock returned by acquire
+            task_id (string): id of the celery task
+            timelimit (float): time limit of the task in seconds
+        """
+        raise NotImplementedError
+
+    def finish(self, lock_id, task_id, task_name, status):
+        """
+        Release the lock of a finished task and record its end status.
+
+        Args:
+            lock_id: id of the lock returned by acquire
+            task_id (string): id of the celery task
+            task_name (string): name of the task
+            status (string): SUCCESS or FAILURE
+        """
+        raise NotImplementedError
+
+
+class DatabaseLockBackend(BaseLockBackend):
+    """
+    Locks are TaskStatus rows, which are kept as history until prune_task_statuses removes them.
+    """
+
+    @transaction.atomic
+    def acquire(self, sig, timelimit):
+        if TaskStatus.objects.filter(
+            Q(expires_at__gte=datetime.now(tzutc())) | Q(expires_at__isnull=True),
+            signature=sig,
+            status__in=LOCKED_STATES,
+        ).exists():
+            return None
+
+        status = TaskStatus.objects.create(
+            status=PENDING,
+            signature=sig,
+            expires_at=datetime.now(tzutc()) + timedelta(seconds=timelimit),
+        )
+        return status.pk
+
+    def start(self, lock_id, task_id, timelimit):
+        TaskStatus.objects.filter(pk=lock_id).update(
+            task_id=task_id,
+            status=STARTED,
+            expires_at=datetime.now(tzutc()) + timedelta(seconds=timelimit),
+        )
+
+    def finish(self, lock_id, task_id, task_name, status):
+        TaskStatus.objects.filter(pk=lock_id).update(status=status)
+
+
+class RedisLockBackend(BaseLockBackend):
+    """
+    Locks are redis keys with the hash of the signature, that expire by themselves.
+
+    Taking a lock is a single SET NX EX, so it's atomic and doesn't get slower as history accumulates. The end statuses
+    of tasks are kept in a list capped at settings.TASKMONITOR_HISTORY_SIZE entries.
+    """
+    LOCK_PREFIX = 'TASK_LOCK_'
+    HISTORY_KEY = 'TASK_STATUS_HISTORY'
+
+    def __init__(self, connection=None):
+        """
+        Args:
+            connection (instance, optional): Redis instance
+        """
+        self.connection = connection or get_redis_connection()
+
+    def acquire(self, sig, timelimit):
+        lock_id = self.LOCK_PREFIX + hashlib.sha1(sig).hexdigest()
+        if self.connection.set(lock_id, PENDING, ex=int(timelimit), nx=True):
+            return lock_id
+        return None
+
+    def start(self, lock_id, task_id, timelimit):
+        self.connection.set(lock_id, STARTED, ex=int(timelimit))
+
+    def finish(self, lock_id, task_id, task_name, status):
+        pipe = self.connection.pipeline(transaction=False)
+        pipe.delete(lock_id)
+        pipe.lpush(self.HISTORY_KEY, json.dumps({
+            'task_id': task_id,
+            'task_name': task_name,
+            'status': status,
+            'finished_at': time.time(),
+        }))
+        pipe.ltrim(self.HISTORY_KEY, 0, settings.TASKMONITOR_HISTORY_SIZE - 1)
+        pipe.execute()
+
+    def get_history(self, limit=100):
+        """
+        Return the end statuses of the last finished tasks, newest first.
+
+        Args:
+            limit (int, optional): max number of statuses
+
+        Returns:
+            list with a dict per task
+        """
+        return [json.loads(entry) for entry in self.connection.lrange(self.HISTORY_KEY, 0, limit - 1)]
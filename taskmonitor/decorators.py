@@ -1,10 +1,9 @@
 import functools
-from datetime import datetime, timedelta
+import time
 
-from celery.states import STARTED, SUCCESS, FAILURE
-from dateutil.tz import tzutc
+from celery.states import SUCCESS, FAILURE
 
-from taskmonitor.models import TaskStatus
+from taskmonitor.backends import DatabaseLockBackend, get_lock_backend
 
 
 def monitor_task(method=None, logger=None):
@@ -19,17 +18,19 @@ def monitor_task(method=None, logger=None):
 
     @functools.wraps(method)
     def f(self, *args, **kwargs):
-        task_status = TaskStatus.objects.get(id=kwargs.pop('status_id'))
-        task_status.task_id = self.request.id
-
-        # Update expires_at
-        utc_before = datetime.now(tzutc())
-        expires_at = utc_before + timedelta(seconds=self.request.timelimit[0])
-        task_status.expires_at = expires_at
+        if 'status_id' in kwargs:
+            # Tasks queued before the lock backends were added have a TaskStatus.
+            lock_id = kwargs.pop('status_id')
+            backend = DatabaseLockBackend()
+        else:
+            lock_id = kwargs.pop('lock_id', None)
+            backend = get_lock_backend()
 
-        # Run the task
-        task_status.status = STARTED
-        task_status.save()
+        # Run the task, the lock expires after the time limit from now
+        timelimit = self.request.timelimit[0]
+        started_at = time.time()
+        if lock_id is not None:
+            backend.start(lock_id, self.request.id, timelimit)
 
         result = None
         end_status = SUCCESS
@@ -41,12 +42,11 @@ def monitor_task(method=None, logger=None):
             end_status = FAILURE
         else:
             # Update status afterwards
-            utc_after = datetime.now(tzutc())
-            if task_status.expires_at and utc_after > task_status.expires_at:
+            if timelimit and time.time() - started_at > timelimit:
                 end_status = FAILURE
 
-        task_status.status = end_status
-        task_status.save()
+        if lock_id is not None:
+            backend.finish(lock_id, self.request.id, self.name, end_status)
 
         return result
     return f
@@ -16,7 +16,7 @@ class TaskStatus(models.Model):
     task_id = models.CharField(max_length=50, unique=True, blank=True, null=True, db_index=True)
     signature = models.CharField(max_length=255, db_index=True)
     created_at = models.DateTimeField(auto_now_add=True)
-    updated_at = models.DateTimeField(auto_now=True)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
     expires_at = models.DateTimeField(null=True)
 
     def __unicode__(self):
@@ -0,0 +1,41 @@
+import logging
+from datetime import datetime, timedelta
+
+from celery.task import task
+from dateutil.tz import tzutc
+from django.conf import settings
+from django.db.models import Q
+
+from taskmonitor.backends import LOCKED_STATES
+from taskmonitor.models import TaskStatus
+
+
+logger = logging.getLogger(__name__)
+
+
+@task(name='prune_task_statuses')
+def prune_task_statuses(batch_size=1000):
+    """
+    Remove task statuses that haven't been updated for settings.TASKMONITOR_STATUS_RETENTION days, unless they still
+    lock a task.
+
+    Args:
+        batch_size (int, optional): number of statuses removed per query
+    """
+    now = datetime.now(tzutc())
+    statuses = TaskStatus.objects.filter(
+        Q(expires_at__lt=now) | (Q(expires_at__isnull=True) & ~Q(status__in=LOCKED_STATES)),
+        updated_at__lt=now - timedelta(days=settings.TASKMONITOR_STATUS_RETENTION),
+    )
+
+    removed = 0
+    while True:
+        # Delete in batches, to keep the transactions short.
+        ids = list(statuses.values_list('pk', flat=True)[:batch_size])
+        if not ids:
+            break
+        TaskStatus.objects.filter(pk__in=ids).delete()
+        removed += len(ids)
+
+    if removed:
+        logger.info('Removed %s task statuses', removed)
@@ -0,0 +1,160 @@
+from datetime import datetime, timedelta
+import json
+
+from celery.states import PENDING, STARTED, SUCCESS, FAILURE
+from dateutil.tz import tzutc
+from django.test import TestCase
+from django.test.utils import override_settings
+
+from taskmonitor import backends
+from taskmonitor.backends import DatabaseLockBackend, RedisLockBackend
+from taskmonitor.decorators import monitor_task
+from taskmonitor.models import TaskStatus
+from taskmonitor.tasks import prune_task_statuses
+
+
+class FakeRedis(object):
+    """
+    Redis connection with only the commands the lock backend uses, without expiry.
+    """
+    def __init__(self):
+        self.data = {}
+
+    def set(self, key, value, ex=None, nx=False):
+        if nx and key in self.data:
+            return None
+        self.data[key] = value
+        return True
+
+    def delete(self, key):
+        self.data.pop(key, None)
+
+    def lpush(self, key, value):
+        self.data.setdefault(key, []).insert(0, value)
+
+    def ltrim(self, key, start, end):
+        self.data[key] = self.data.get(key, [])[start:end + 1]
+
+    def lrange(self, key, start, end):
+        return self.data.get(key, [])[start:end + 1]
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+
+class FakePipeline(object):
+    def __init__(self, connection):
+        self.connection = connection
+        self.commands = []
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: self.commands.append((name, args, kwargs))
+
+    def execute(self):
+        return [getattr(self.connection, name)(*args, **kwargs) for name, args, kwargs in self.commands]
+
+
+class FakeRequest(object):
+    id = 'task-id'
+    timelimit = (60, None)
+
+
+class FakeTask(object):
+    name = 'fake_task'
+    request = FakeRequest()
+
+
+class RedisLockBackendTestCase(TestCase):
+
+    def setUp(self):
+        self.connection = FakeRedis()
+        self.backend = RedisLockBackend(connection=self.connection)
+
+    def test_lock_is_taken_once(self):
+        lock_id = self.backend.acquire('fake_task(1)', 60)
+
+        self.assertIsNotNone(lock_id)
+        self.assertIsNone(self.backend.acquire('fake_task(1)', 60))
+        self.assertIsNotNone(self.backend.acquire('fake_task(2)', 60))
+
+    def test_finish_releases_lock_and_caps_history(self):
+        with override_settings(TASKMONITOR_HISTORY_SIZE=2):
+            for i in range(3):
+                lock_id = self.backend.acquire('fake_task(1)', 60)
+                self.backend.start(lock_id, 'task-%s' % i, 60)
+                self.assertEqual(self.connection.data[lock_id], STARTED)
+                self.backend.finish(lock_id, 'task-%s' % i, 'fake_task', SUCCESS)
+
+        history = self.backend.get_history()
+        self.assertEqual([entry['task_id'] for entry in history], ['task-2', 'task-1'])
+        self.assertNotIn(lock_id, self.connection.data)
+
+
+class DatabaseLockBackendTestCase(TestCase):
+
+    def test_lock_is_taken_until_finished(self):
+        backend = DatabaseLockBackend()
+        lock_id = backend.acquire('fake_task(1)', 60)
+
+        self.assertEqual(TaskStatus.objects.get(pk=lock_id).status, PENDING)
+        self.assertIsNone(backend.acquire('fake_task(1)', 60))
+
+        backend.start(lock_id, 'task-id', 60)
+        self.assertEqual(TaskStatus.objects.get(pk=lock_id).task_id, 'task-id')
+
+        backend.finish(lock_id, 'task-id', 'fake_task', SUCCESS)
+        self.assertEqual(TaskStatus.objects.get(pk=lock_id).status, SUCCESS)
+        self.assertIsNotNone(backend.acquire('fake_task(1)', 60))
+
+
+class MonitorTaskTestCase(TestCase):
+
+    def setUp(self):
+        self.connection = FakeRedis()
+        backends._backend = RedisLockBackend(connection=self.connection)
+
+    def tearDown(self):
+        backends._backend = None
+
+    def test_lock_is_released_with_status(self):
+        @monitor_task
+        def failing_task():
+            raise ValueError()
+
+        lock_id = backends._backend.acquire('failing_task()', 60)
+        failing_task(FakeTask(), lock_id=lock_id)
+
+        self.assertNotIn(lock_id, self.connection.data)
+        self.assertEqual(json.loads(self.connection.data['TASK_STATUS_HISTORY'][0])['status'], FAILURE)
+
+    def test_legacy_status_id_uses_database(self):
+        @monitor_task
+        def legacy_task(value):
+            return value
+
+        status = TaskStatus.objects.create(signature='legacy_task(1)')
+
+        self.assertEqual(legacy_task(FakeTask(), 1, status_id=status.pk), 1)
+        self.assertEqual(TaskStatus.objects.get(pk=status.pk).status, SUCCESS)
+        self.assertEqual(self.connection.data, {})
+
+
+class PruneTaskStatusesTestCase(TestCase):
+
+    def test_only_old_unlocked_statuses_are_removed(self):
+        now = datetime.now(tzutc())
+        TaskStatus.objects.create(signature='finished()', status=SUCCESS, expires_at=now)
+        TaskStatus.objects.create(signature='expired()', status=PENDING, expires_at=now)
+        locked = TaskStatus.objects.create(signature='locked()', status=PENDING)
+        TaskStatus.objects.create(signature='unlocked()', status=SUCCESS)
+        recent = TaskStatus.objects.create(signature='recent()', status=SUCCESS)
+        # updated_at is set on every save, so age the statuses with an update.
+        TaskStatus.objects.exclude(pk=recent.pk).update(updated_at=now - timedelta(days=30))
+
+        with override_settings(TASKMONITOR_STATUS_RETENTION=7):
+            prune_task_statuses(batch_size=1)
+
+        self.assertEqual(
+            set(TaskStatus.objects.values_list('pk', flat=True)),
+            set([locked.pk, recent.pk]),
+        )
@@ -1,13 +1,7 @@
-from datetime import datetime, timedelta
-
 from celery import signature
-from celery.states import PENDING, SUCCESS, FAILURE, RECEIVED, STARTED, REVOKED, RETRY, IGNORED, REJECTED
-from dateutil.tz import tzutc
 from django.conf import settings
-from django.db import transaction
-from django.db.models import Q
 
-from taskmonitor.models import TaskStatus
+from taskmonitor.backends import get_lock_backend
 
 
 def resolve_annotations(task_name):
@@ -20,43 +14,22 @@ def resolve_annotations(task_name):
     return annotations_for_task
 
 
-@transaction.atomic
 def lock_task(task_name, *args, **kwargs):
     """
-    Try to lock a task: check whether or not a status entry exists for given
-    parameters or create one (preventing others from being created).
+    Try to lock a task: take the lock for given parameters with the lock
+    backend, preventing others from being taken until the task is finished.
 
-    Returns whether or not the task was locked and a status instance.
+    Returns whether or not the task was locked and the id of the lock, which
+    should be passed to the task as lock_id.
     """
-    locked, status = False, None
-
     # MUST use `str()`, otherwise it will invoke the task instead in the
     # query up ahead!
     sig = str(signature(task_name, args=args, kwargs=kwargs))
 
-    # Create a status if allowed
-    if not TaskStatus.objects\
-            .filter(Q(expires_at__gte=datetime.now(tzutc())) | Q(expires_at__isnull=True),
-                    signature=sig)\
-            .filter(status__in=[PENDING, RECEIVED, STARTED, REVOKED, RETRY, IGNORED, REJECTED])\
-            .exists():
-
-        # Set status to PENDING since it's not running yet
-        init_status = PENDING
-
-        # Check for timelimit
-        annotations_for_task = resolve_annotations(task_name)
-        timelimit = annotations_for_task.get('time_limit')
-
-        # Determine when this task should expire
-        utc_before = datetime.now(tzutc())
-        expires_at = utc_before + timedelta(seconds=timelimit)
+    # Check for timelimit, the lock expires with it
+    annotations_for_task = resolve_annotations(task_name)
+    timelimit = annotations_for_task.get('time_limit')
 
-        status = TaskStatus.objects.create(
-            status=init_status,
-            signature=sig,
-            expires_at=expires_at,
-        )
-        locked = True
+    lock_id = get_lock_backend().acquire(sig, timelimit)
 
-    return locked, status
+    return lock_id is not None, lock_id